@@ -0,0 +1,67 @@
+import numpy as np
+
+FUSIONS = ("sum", "max", "mean")
+
+
+def aggregate_arrays(business_keys, scores, masks=None, fusion="sum", top_n=None, max_evidence=None):
+    """
+    Groups candidate documents by business.
+
+    business_keys: int array, one entry per candidate document
+    scores: float array, the candidate's (fused) document score
+    masks: optional tag mask per candidate, OR-ed per business
+
+    Returns (keys, totals, first_seen, evidence, tag_masks) for the returned
+    businesses, best first: first_seen is the index of the business's first
+    candidate and evidence[i] holds its candidate indices, best first.
+    Businesses are ranked by total score; ties keep first-appearance order.
+    """
+    if fusion not in FUSIONS:
+        raise ValueError(f"Unknown fusion {fusion!r}; expected one of {FUSIONS}")
+    keys = np.asarray(business_keys, dtype=np.int64)
+    scores = np.asarray(scores, dtype=np.float64)
+    n = len(keys)
+    if n == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, np.zeros(0), empty, [], empty
+
+    groups, inverse = np.unique(keys, return_inverse=True)
+    # Candidates in input order, so sums accumulate in the same order as a loop
+    sums = np.bincount(inverse, weights=scores, minlength=len(groups))
+    if fusion == "sum":
+        totals = sums
+    elif fusion == "mean":
+        totals = sums / np.bincount(inverse, minlength=len(groups))
+    else:
+        totals = np.full(len(groups), -np.inf)
+        np.maximum.at(totals, inverse, scores)
+    first_seen = np.full(len(groups), n, dtype=np.int64)
+    np.minimum.at(first_seen, inverse, np.arange(n))
+    tag_masks = np.zeros(len(groups), dtype=np.int64)
+    if masks is not None:
+        np.bitwise_or.at(tag_masks, inverse, np.asarray(masks, dtype=np.int64))
+
+    # Top-N businesses by partial selection
+    candidates = np.arange(len(groups))
+    if top_n is not None and top_n < len(groups):
+        part = np.argpartition(-totals, top_n - 1)[:top_n] if top_n > 0 else candidates[:0]
+        # Include everything tied with the cut-off so first-seen order decides
+        if len(part):
+            candidates = np.flatnonzero(totals >= totals[part].min())
+        else:
+            candidates = part
+    order = candidates[np.lexsort((first_seen[candidates], -totals[candidates]))]
+    if top_n is not None:
+        order = order[:top_n]
+
+    # Evidence: per business, candidates by score (ties keep input order)
+    returned = np.zeros(len(groups), dtype=bool)
+    returned[order] = True
+    picked = np.flatnonzero(returned[inverse])
+    picked = picked[np.lexsort((picked, -scores[picked], inverse[picked]))]
+    bounds = np.searchsorted(inverse[picked], np.arange(len(groups) + 1))
+    evidence = []
+    for g in order.tolist():
+        rows = picked[bounds[g]:bounds[g + 1]]
+        evidence.append(rows if max_evidence is None else rows[:max_evidence])
+    return groups[order], totals[order], first_seen[order], evidence, tag_masks[order]
@@ -0,0 +1,140 @@
+import os
+import queue
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+
+# Every live scheduler. Threads do not survive fork(): in a forked child
+# each gets a fresh lock and queue, and its worker thread is started again
+# by the first encode() there.
+_schedulers = weakref.WeakSet()
+
+
+def _after_fork():
+    for scheduler in list(_schedulers):
+        scheduler._lock = threading.Lock()
+        scheduler._queue = queue.Queue()
+        scheduler._worker = None
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+class EncodeScheduler:
+    """
+    Dynamic micro-batching in front of a SentenceTransformer.
+
+    Concurrent callers submit encode jobs; a single worker thread takes the
+    first waiting job, keeps collecting jobs for up to `max_wait_ms` or until
+    `max_batch_size` texts are gathered, and runs them as one padded forward
+    pass. Each caller gets back its own rows. Bigger jobs are encoded
+    `max_batch_size` texts per forward pass.
+    """
+
+    def __init__(self, model, max_batch_size=64, max_wait_ms=2.0, history=10000):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.history = history
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+        self.batches = self.jobs = self.texts = 0
+        # Recent samples for percentiles
+        self.batch_sizes = deque(maxlen=self.history)
+        self.queue_waits = deque(maxlen=self.history)
+        _schedulers.add(self)
+        self._ensure_worker()
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="encode-scheduler", daemon=True)
+                self._worker.start()
+
+    def stop(self):
+        """Finishes the jobs already queued and stops the worker thread (e.g. before a fork)."""
+        with self._lock:
+            worker, self._worker = self._worker, None
+        if worker is not None:
+            self._queue.put(None)
+            worker.join()
+
+    def encode(self, texts):
+        """Normalized embeddings for `texts`, shape (len(texts), dim)."""
+        texts = list(texts)
+        if self._worker is None:
+            # Forked (or stopped): this process has no worker thread yet
+            self._ensure_worker()
+        future = Future()
+        self._queue.put((texts, future, time.perf_counter()))
+        return future.result()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            jobs = [job]
+            size = len(job[0])
+            deadline = time.perf_counter() + self.max_wait
+            while size < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    job = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if job is None:
+                    # Stopping: encode what was collected, then exit
+                    self._queue.put(None)
+                    break
+                jobs.append(job)
+                size += len(job[0])
+            self._encode(jobs)
+
+    def _encode(self, jobs):
+        started = time.perf_counter()
+        texts = [t for job_texts, _, _ in jobs for t in job_texts]
+        try:
+            vectors = self.model.encode(texts, batch_size=min(max(len(texts), 1), self.max_batch_size),
+                                        normalize_embeddings=True, convert_to_numpy=True)
+            vectors = np.asarray(vectors).reshape(len(texts), -1)
+        except Exception as e:
+            for _, future, _ in jobs:
+                future.set_exception(e)
+            return
+        with self._lock:
+            self.batches += 1
+            self.jobs += len(jobs)
+            self.texts += len(texts)
+            self.batch_sizes.append(len(texts))
+            self.queue_waits.extend(started - submitted for _, _, submitted in jobs)
+        start = 0
+        for job_texts, future, _ in jobs:
+            future.set_result(vectors[start:start + len(job_texts)])
+            start += len(job_texts)
+
+    def stats(self):
+        with self._lock:
+            sizes = np.array(self.batch_sizes, dtype=np.float64)
+            waits = np.array(self.queue_waits, dtype=np.float64) * 1000
+            stats = {
+                "batches": self.batches,
+                "jobs": self.jobs,
+                "texts": self.texts,
+                "queued": self._queue.qsize(),
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000,
+            }
+        if len(sizes):
+            stats["batch_size"] = {"mean": float(sizes.mean()), "p50": float(np.percentile(sizes, 50)),
+                                   "max": float(sizes.max())}
+            stats["queue_wait_ms"] = {"mean": float(waits.mean()), "p50": float(np.percentile(waits, 50)),
+                                      "p99": float(np.percentile(waits, 99))}
+        return stats
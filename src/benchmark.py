@@ -0,0 +1,312 @@
+"""
+Performance benchmarks on synthetic corpora.
+
+Each corpus is resampled from the processed violations and reviews, indexed
+and searched in fresh processes, so build and serving memory are measured
+separately. Reports index build time and peak memory, engine load time and
+resident memory, p50/p95/p99 latency of search_bm25, rerank and
+aggregate_results, and QPS under concurrent load, as JSON:
+
+    python3 src/benchmark.py --sizes 10k,100k,1m --output bench.json
+    python3 src/benchmark.py --sizes 10k --baseline bench.json
+
+The reranker defaults to the deterministic "hash" encoder stub, so runs need
+no model download; `--encoder torch` benchmarks the real model.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from index_store import INDEX_DIRNAME, SOURCES, build_snapshot, read_processed
+from normalize import DATA_DIR
+from tagger import KEYWORDS, tag_masks, tag_strings
+
+STAGES = ("search_bm25", "rerank", "aggregate_results")
+# Metrics where a higher value is better; everything else is a time or a size
+HIGHER_IS_BETTER = ("qps",)
+# Changes smaller than these absolute amounts are run-to-run noise, whatever
+# their relative size (sub-millisecond stages easily move 50%)
+NOISE_FLOORS = {"latency_ms": 0.5, "seconds": 0.05, "phases": 0.05, "_mb": 5.0}
+
+
+def parse_size(size):
+    size = size.strip().lower()
+    scale = {"k": 1000, "m": 1000000}.get(size[-1:], 1)
+    return int(float(size.rstrip("km")) * scale)
+
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentiles(seconds):
+    ms = np.asarray(seconds, dtype=np.float64) * 1000
+    if not len(ms):
+        return {}
+    return {"mean": float(ms.mean()), "p50": float(np.percentile(ms, 50)), "p95": float(np.percentile(ms, 95)),
+            "p99": float(np.percentile(ms, 99))}
+
+
+def dir_size_mb(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return total / 2 ** 20
+
+
+def _mix_reviews(df, n, rng):
+    # Resampled reviews would all be exact duplicates, which the index
+    # stores once; splice two reviews instead so most texts are new
+    words = df["text"].str.split().tolist()
+    a, b = rng.integers(0, len(words), n), rng.integers(0, len(words), n)
+    texts = []
+    for i, j in zip(a.tolist(), b.tolist()):
+        wa, wb = words[i], words[j]
+        texts.append(" ".join(wa[:(len(wa) + 1) // 2] + wb[len(wb) // 2:]))
+    out = df.iloc[a].reset_index(drop=True)
+    out["text"] = out["original_text"] = texts
+    masks = tag_masks(out["text"])
+    out["tag_mask"], out["tags"] = masks, tag_strings(masks)
+    return out
+
+
+def synthesize(data_dir, out_dir, n_docs, seed=0):
+    """
+    Writes processed CSVs with about n_docs documents to out_dir, in the
+    same violation/review mix as data_dir. Business ids get a copy suffix,
+    so a 10x corpus also has about 10x the businesses.
+    """
+    rng = np.random.default_rng(seed)
+    frames = {source: read_processed(os.path.join(data_dir, filename)) for source, filename in SOURCES.items()
+              if os.path.exists(os.path.join(data_dir, filename))}
+    if not frames:
+        raise FileNotFoundError(f"No processed CSVs in {data_dir}; run normalize.py first.")
+    total = sum(len(df) for df in frames.values())
+    os.makedirs(out_dir, exist_ok=True)
+    counts = {}
+    for source, df in frames.items():
+        n = max(1, round(n_docs * len(df) / total))
+        if source == "review":
+            out = _mix_reviews(df, n, rng)
+        else:
+            out = df.iloc[rng.integers(0, len(df), n)].reset_index(drop=True)
+        copy = (np.arange(n) // len(df)).astype(str)
+        out["business_id"] = out["business_id"].astype(str) + "_" + copy
+        out["doc_id"] = f"{source}_" + pd.Series(np.arange(n)).astype(str)
+        out.to_csv(os.path.join(out_dir, SOURCES[source]), index=False)
+        counts[source] = n
+    return counts
+
+
+def make_queries(data_dir, n, seed=0):
+    """The labeled queries, topped up with random 1-3 keyword queries."""
+    rng = np.random.default_rng(seed)
+    queries = []
+    labels = os.path.join(data_dir, "labeled_queries.csv")
+    if os.path.exists(labels):
+        queries = pd.read_csv(labels)["query"].astype(str).tolist()[:n]
+    words = [w for ws in KEYWORDS.values() for w in ws] + ["kitchen", "food", "dirty", "floor", "staff"]
+    while len(queries) < n:
+        queries.append(" ".join(rng.choice(words, rng.integers(1, 4), replace=False)))
+    return queries
+
+
+def _build(corpus_dir):
+    # Runs in its own process: build time and the peak memory of building
+    start = time.perf_counter()
+    manifest = build_snapshot(corpus_dir)
+    seconds = time.perf_counter() - start
+    snapshot_dir = os.path.join(corpus_dir, INDEX_DIRNAME, manifest["path"])
+    return {"seconds": seconds, "peak_rss_mb": peak_rss_mb(), "index_mb": dir_size_mb(snapshot_dir),
+            "texts": sum(s["num_texts"] for s in manifest["sources"].values())}
+
+
+def _serve(corpus_dir, queries, encoder, top_k, threads, concurrent_queries):
+    # Runs in its own process: engine load, per-stage latency and QPS
+    from retrieval import SaferBitesEngine
+
+    base_rss = rss_mb()
+    start = time.perf_counter()
+    engine = SaferBitesEngine(corpus_dir, result_cache_size=0, embedding_cache_size=0, encode_wait_ms=None,
+                              encoder_backend=encoder)
+    load = {"seconds": time.perf_counter() - start, "phases": dict(engine.timings),
+            "rss_mb": rss_mb() - base_rss}
+
+    for q in queries[:10]:
+        # Warm-up: page in the memory-mapped index
+        engine.search(q, top_k=top_k)
+    stage_times = {stage: [] for stage in STAGES + ("total",)}
+    for q in queries:
+        t0 = time.perf_counter()
+        hits = engine.search_bm25(q, top_k)
+        t1 = time.perf_counter()
+        hits = engine.rerank(q, hits)
+        t2 = time.perf_counter()
+        engine.aggregate_results(hits, q)
+        t3 = time.perf_counter()
+        for stage, seconds in zip(STAGES + ("total",), (t1 - t0, t2 - t1, t3 - t2, t3 - t0)):
+            stage_times[stage].append(seconds)
+
+    batch = [queries[i % len(queries)] for i in range(concurrent_queries)]
+    latencies = []
+
+    def one(q):
+        t = time.perf_counter()
+        engine.search(q, top_k=top_k)
+        latencies.append(time.perf_counter() - t)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(one, batch))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "load": load,
+        "latency_ms": {stage: percentiles(times) for stage, times in stage_times.items()},
+        "concurrent": {"threads": threads, "queries": len(batch), "qps": len(batch) / elapsed,
+                       "latency_ms": percentiles(latencies)},
+        "rss_mb": rss_mb(),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def _in_process(func, *args):
+    # A fresh interpreter per measurement keeps memory numbers independent
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(func, args)
+
+
+def bench_corpus(n_docs, data_dir=DATA_DIR, work_dir=None, queries=200, encoder="hash", top_k=30, threads=8,
+                 concurrent_queries=1000, seed=0):
+    corpus_dir = os.path.join(work_dir, f"corpus-{n_docs}")
+    start = time.perf_counter()
+    counts = synthesize(data_dir, corpus_dir, n_docs, seed)
+    result = {"docs": sum(counts.values()), "sources": counts, "synthesize_seconds": time.perf_counter() - start}
+    print(f"[{n_docs}] synthesized {result['docs']} documents in {result['synthesize_seconds']:.1f}s")
+    result["build"] = _in_process(_build, corpus_dir)
+    print(f"[{n_docs}] index built in {result['build']['seconds']:.1f}s "
+          f"(peak {result['build']['peak_rss_mb']:.0f} MB)")
+    result["serve"] = _in_process(_serve, corpus_dir, make_queries(data_dir, queries, seed), encoder, top_k,
+                                  threads, concurrent_queries)
+    lat = result["serve"]["latency_ms"]["total"]
+    print(f"[{n_docs}] search p50 {lat['p50']:.2f} ms, p99 {lat['p99']:.2f} ms, "
+          f"{result['serve']['concurrent']['qps']:.0f} QPS with {threads} threads")
+    return result
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(sizes, data_dir=DATA_DIR, work_dir=None, keep=False, **kwargs):
+    """Benchmarks every corpus size; returns the JSON-serializable report."""
+    report = {
+        "meta": {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": _git_commit(),
+                 "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+                 "settings": kwargs},
+        "corpora": {},
+    }
+    work_dir = work_dir or tempfile.mkdtemp(prefix="saferbites-bench-")
+    try:
+        for n_docs in sizes:
+            report["corpora"][str(n_docs)] = bench_corpus(n_docs, data_dir, work_dir, **kwargs)
+    finally:
+        if not keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+def flatten(report, prefix=""):
+    """{"corpora.10000.serve.latency_ms.total.p99": value, ...} for the numeric metrics."""
+    items = {}
+    for key, value in report.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            items.update(flatten(value, path + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            items[path] = value
+    return items
+
+
+def compare(report, baseline, max_regression=0.10):
+    """
+    Prints every metric shared with the baseline and its relative change;
+    returns the metrics that got worse by more than max_regression (and by
+    more than their noise floor).
+    """
+    current, previous = flatten(report["corpora"]), flatten(baseline["corpora"])
+    regressions = []
+    print(f"{'metric':<60} {'baseline':>12} {'current':>12} {'change':>8}")
+    for key in sorted(current.keys() & previous.keys()):
+        if key.endswith("synthesize_seconds"):
+            # The harness's own setup, not something a change is judged by
+            continue
+        old, new = previous[key], current[key]
+        change = (new - old) / old if old else 0.0
+        worse = -change if key.rsplit(".", 1)[-1] in HIGHER_IS_BETTER else change
+        floor = next((v for unit, v in NOISE_FLOORS.items() if unit in key), 0.0)
+        flag = ""
+        # Counts (docs, threads, ...) are settings, not measurements
+        if worse > max_regression and abs(new - old) > floor and isinstance(new, float):
+            regressions.append(key)
+            flag = "  REGRESSION"
+        print(f"{key:<60} {old:>12.3f} {new:>12.3f} {change:>+7.1%}{flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark indexing and search on synthetic corpora.")
+    parser.add_argument("--sizes", default="10k,100k,1m", help="Comma-separated corpus sizes (e.g. 10k,100k,1m)")
+    parser.add_argument("--data-dir", default=DATA_DIR, help="Processed CSVs to resample")
+    parser.add_argument("--work-dir", default=None, help="Where to write the corpora (default: a temp dir)")
+    parser.add_argument("--keep", action="store_true", help="Keep the synthesized corpora and indexes")
+    parser.add_argument("--queries", type=int, default=200, help="Queries timed per stage")
+    parser.add_argument("--encoder", default="hash", help="Encoder backend for reranking (hash is the offline stub)")
+    parser.add_argument("--top-k", type=int, default=30)
+    parser.add_argument("--threads", type=int, default=8, help="Client threads for the QPS run")
+    parser.add_argument("--concurrent-queries", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Write the JSON report here")
+    parser.add_argument("--baseline", default=None, help="JSON report to diff against")
+    parser.add_argument("--max-regression", type=float, default=0.10,
+                        help="Relative slowdown that counts as a regression (exit status 1)")
+    args = parser.parse_args()
+
+    report = run([parse_size(s) for s in args.sizes.split(",") if s.strip()], args.data_dir, args.work_dir,
+                 args.keep, queries=args.queries, encoder=args.encoder, top_k=args.top_k, threads=args.threads,
+                 concurrent_queries=args.concurrent_queries, seed=args.seed)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.max_regression)
+        if regressions:
+            print(f"{len(regressions)} metrics regressed by more than {args.max_regression:.0%}.")
+            sys.exit(1)
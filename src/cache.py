@@ -0,0 +1,111 @@
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+# Every live cache. A lock held by another thread when the process forks
+# stays locked forever in the child, so each cache gets a fresh one there;
+# its counters start over too, as each server worker reports its own.
+_caches = weakref.WeakSet()
+
+
+def _reset_locks():
+    for cache in list(_caches):
+        cache._lock = threading.Lock()
+        cache.hits = cache.misses = cache.evictions = cache.expirations = cache.invalidations = 0
+
+
+os.register_at_fork(after_in_child=_reset_locks)
+
+
+class LRUCache:
+    """
+    Thread-safe, size-bounded LRU cache with an optional time-to-live.
+
+    Entries belong to a version (e.g. the index version they were computed
+    from); `sync(version)` drops everything when the version changes.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, version=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version = version
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        _caches.add(self)
+        self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                return default
+            self._data.move_to_end(key)
+            return entry[0]
+
+    def pop(self, key, default=None):
+        """
+        Removes and returns an entry, for values that one caller at a time
+        may use: of concurrent pops of a key, only one gets its value.
+        """
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                return default
+            del self._data[key]
+            return entry[0]
+
+    def _lookup(self, key):
+        # Live entry of key, counting the hit or miss; the lock is held
+        entry = self._data.get(key)
+        if entry is not None and self.ttl is not None and time.monotonic() > entry[1]:
+            del self._data[key]
+            self.expirations += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def sync(self, version):
+        """Invalidates every entry if `version` differs from the cache's."""
+        with self._lock:
+            if version == self.version:
+                return
+            self.version = version
+            if self._data:
+                self._data.clear()
+                self.invalidations += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
@@ -0,0 +1,118 @@
+import os
+
+import numpy as np
+
+from lexical_index import select_top_k
+
+# Below this many documents a brute-force scan is fast enough and exact
+EXACT_MAX_DOCS = 50000
+DEFAULT_NPROBE = 8
+
+
+class DenseIndex:
+    """
+    First-stage dense retriever over an EmbeddingStore's vectors.
+
+    Without an IVF layout it scores every document (exact). With one, the
+    vectors are bucketed by nearest k-means centroid and a query only scans
+    the `nprobe` closest buckets.
+    """
+
+    def __init__(self, vectors, centroids=None, list_offsets=None, list_rows=None):
+        self.vectors = vectors
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+
+    @property
+    def is_approximate(self):
+        return self.centroids is not None
+
+    def search(self, query_emb, k, nprobe=DEFAULT_NPROBE, exact=False, doc_filter=None):
+        """doc_filter: optional packed bitmap of rows allowed to be scored."""
+        query_emb = np.asarray(query_emb, dtype=np.float32)
+        if doc_filter is not None:
+            rows = np.flatnonzero(np.unpackbits(doc_filter, count=len(self.vectors), bitorder="little"))
+            if self.is_approximate and not exact:
+                probes = np.argsort(self.centroids @ query_emb)[::-1][:nprobe]
+                probed = np.concatenate([self.list_rows[self.list_offsets[c]:self.list_offsets[c + 1]] for c in probes])
+                rows = np.intersect1d(rows, probed)
+            rows = rows.astype(np.int64)
+            scores = np.asarray(self.vectors[rows], dtype=np.float32) @ query_emb
+        elif exact or not self.is_approximate:
+            rows = np.arange(len(self.vectors), dtype=np.int64)
+            scores = _dot_chunked(self.vectors, query_emb)
+        else:
+            probes = np.argsort(self.centroids @ query_emb)[::-1][:nprobe]
+            rows = np.concatenate([self.list_rows[self.list_offsets[c]:self.list_offsets[c + 1]] for c in probes])
+            rows = np.sort(rows).astype(np.int64)
+            scores = np.asarray(self.vectors[rows], dtype=np.float32) @ query_emb
+        return select_top_k(rows, scores.astype(np.float64), k)
+
+    @classmethod
+    def build_ivf(cls, vectors, nlist=None, iters=10, sample_size=100000, seed=0):
+        n = len(vectors)
+        nlist = nlist or max(1, int(4 * np.sqrt(n)))
+        rng = np.random.default_rng(seed)
+        sample = np.asarray(vectors[np.sort(rng.choice(n, min(n, max(sample_size, nlist)), replace=False))],
+                            dtype=np.float32)
+
+        # Spherical k-means on a sample of the corpus
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+        for _ in range(iters):
+            assign = _nearest(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            counts = np.bincount(assign, minlength=nlist)
+            empty = counts == 0
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+
+        assign = _nearest(vectors, centroids)
+        list_rows = np.argsort(assign, kind="stable").astype(np.int32)
+        list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assign, minlength=nlist), out=list_offsets[1:])
+        return cls(vectors, centroids.astype(np.float32), list_offsets, list_rows)
+
+    def save_ivf(self, source_dir):
+        np.save(os.path.join(source_dir, "ivf_centroids.npy"), self.centroids)
+        np.save(os.path.join(source_dir, "ivf_offsets.npy"), self.list_offsets)
+        np.save(os.path.join(source_dir, "ivf_rows.npy"), self.list_rows)
+
+    @classmethod
+    def load(cls, source_dir, vectors):
+        path = os.path.join(source_dir, "ivf_centroids.npy")
+        if not os.path.exists(path):
+            return cls(vectors)
+        return cls(vectors, np.load(path),
+                   np.load(os.path.join(source_dir, "ivf_offsets.npy"), mmap_mode="r"),
+                   np.load(os.path.join(source_dir, "ivf_rows.npy"), mmap_mode="r"))
+
+
+def _dot_chunked(vectors, query_emb, chunk=65536):
+    out = np.empty(len(vectors), dtype=np.float32)
+    for start in range(0, len(vectors), chunk):
+        out[start:start + chunk] = np.asarray(vectors[start:start + chunk], dtype=np.float32) @ query_emb
+    return out
+
+
+def _nearest(vectors, centroids, chunk=65536):
+    out = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk):
+        block = np.asarray(vectors[start:start + chunk], dtype=np.float32)
+        out[start:start + chunk] = np.argmax(block @ centroids.T, axis=1)
+    return out
+
+
+def reciprocal_rank_fusion(ranked_lists, k=60):
+    """
+    Fuses several ranked lists of row ids. Returns (rows, scores) ordered
+    by sum(1 / (k + rank)), rank starting at 1.
+    """
+    fused = {}
+    for rows in ranked_lists:
+        for rank, row in enumerate(rows, start=1):
+            fused[row] = fused.get(row, 0.0) + 1.0 / (k + rank)
+    rows = np.fromiter(fused.keys(), dtype=np.int64, count=len(fused))
+    scores = np.fromiter(fused.values(), dtype=np.float64, count=len(fused))
+    return select_top_k(rows, scores, len(rows))
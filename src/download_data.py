@@ -2,23 +2,220 @@ import requests
 import pandas as pd
 import os
 import io
+import json
+import gzip
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 DATA_DIR = "saferbites/data"
 os.makedirs(DATA_DIR, exist_ok=True)
 
-def download_nyc_inspections():
-    print("Downloading NYC DOHMH Restaurant Inspections (limit 5000)...")
-    url = "https://data.cityofnewyork.us/resource/43nn-pn8j.csv?$limit=5000&$order=inspection_date DESC"
-    try:
-        response = requests.get(url)
+# NYC DOHMH Restaurant Inspections (Socrata SODA API); override to point at a mirror or a local stand-in
+SODA_URL = os.environ.get("SAFERBITES_SODA_URL", "https://data.cityofnewyork.us/resource/43nn-pn8j.csv")
+PAGE_SIZE = 50000
+# :id is the row identifier; a stable order is required for $offset paging
+PAGE_ORDER = ":id"
+STATE_FILE = "download_state.json"
+
+def make_session(workers):
+    # One pooled session shared by the workers, retrying throttled/failed requests
+    session = requests.Session()
+    retry = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=["GET"])
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def _open(path, mode):
+    return gzip.open(path, mode) if path.endswith(".gz") else open(path, mode)
+
+def _tmp_path(path):
+    # Same extension, so it is compressed the same way
+    return os.path.join(os.path.dirname(path), "." + os.path.basename(path))
+
+def count_rows(session, url, where=None):
+    params = {"$select": "count(*) AS n"}
+    if where:
+        params["$where"] = where
+    response = session.get(url, params=params, timeout=60)
+    response.raise_for_status()
+    return int(pd.read_csv(io.StringIO(response.text))["n"].iloc[0])
+
+def fetch_page(session, url, params, path):
+    # Streamed to a temporary file and renamed when complete, so a page file
+    # on disk is always a whole page
+    tmp = _tmp_path(path)
+    with session.get(url, params=params, stream=True, timeout=300) as response:
         response.raise_for_status()
-        # Save raw
-        with open(f"{DATA_DIR}/inspections_raw.csv", "wb") as f:
-            f.write(response.content)
-        print("NYC Inspections downloaded.")
+        with _open(tmp, "wb") as f:
+            for chunk in response.iter_content(chunk_size=1 << 16):
+                f.write(chunk)
+    os.replace(tmp, path)
+    return path
+
+def assemble(parts, output):
+    """Concatenates page files into one CSV, keeping the first header only."""
+    tmp = _tmp_path(output)
+    with _open(tmp, "wb") as out:
+        for i, part in enumerate(parts):
+            with _open(part, "rb") as f:
+                header = f.readline()
+                if i == 0:
+                    out.write(header)
+                last = b"\n"
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    out.write(chunk)
+                    last = chunk[-1:]
+                if last != b"\n":
+                    out.write(b"\n")
+    os.replace(tmp, output)
+
+def soql_timestamp(value):
+    """
+    An inspection date as a SoQL floating timestamp literal
+    (2024-01-31T00:00:00.000). The value is parsed and re-formatted, so
+    nothing from the state file or a page ends up in $where as is. Raises
+    ValueError if it is not an ISO date without a time zone.
+    """
+    when = datetime.fromisoformat(str(value))
+    if when.tzinfo is not None:
+        raise ValueError(f"expected a floating timestamp, got {value!r}")
+    return when.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+
+def max_inspection_date(parts):
+    dates = [pd.read_csv(p, usecols=["inspection_date"], dtype=str)["inspection_date"].max() for p in parts]
+    dates = [d for d in dates if isinstance(d, str)]
+    return max(dates) if dates else None
+
+def download_pages(output, where=None, url=SODA_URL, page_size=PAGE_SIZE, workers=4, max_rows=None):
+    """
+    Pages through the dataset with $offset/$limit on `workers` threads,
+    streaming each page to its own file next to `output`. Finished pages are
+    the checkpoint: re-running the same download after an interruption only
+    fetches the missing ones. Pages are gzip-compressed when `output` ends in
+    .gz. Returns the page files in order, or None if there are no rows.
+    """
+    session = make_session(workers)
+    parts_dir = output + ".parts"
+    os.makedirs(parts_dir, exist_ok=True)
+    checkpoint_path = os.path.join(parts_dir, "checkpoint.json")
+    job = {"url": url, "where": where, "page_size": page_size, "order": PAGE_ORDER, "max_rows": max_rows}
+
+    checkpoint = None
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+    if checkpoint is not None and checkpoint["job"] == job:
+        total = checkpoint["total"]
+        print(f"Resuming download into {output}...")
+    else:
+        # A different download was interrupted here; start over
+        for name in os.listdir(parts_dir):
+            os.remove(os.path.join(parts_dir, name))
+        total = count_rows(session, url, where)
+        if max_rows is not None:
+            total = min(total, max_rows)
+        with open(checkpoint_path, "w") as f:
+            json.dump({"job": job, "total": total}, f)
+    if total == 0:
+        return None
+
+    ext = ".csv.gz" if output.endswith(".gz") else ".csv"
+    pages = []
+    for offset in range(0, total, page_size):
+        params = {"$limit": min(page_size, total - offset), "$offset": offset, "$order": PAGE_ORDER}
+        if where:
+            params["$where"] = where
+        pages.append((params, os.path.join(parts_dir, f"page-{offset // page_size:06d}{ext}")))
+    todo = [(params, path) for params, path in pages if not os.path.exists(path)]
+    print(f"{total} rows in {len(pages)} pages; {len(pages) - len(todo)} already downloaded.")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(fetch_page, session, url, params, path) for params, path in todo]
+        for done, future in enumerate(futures, start=1):
+            future.result()
+            print(f"  page {done}/{len(todo)} ({time.perf_counter() - start:.1f}s)")
+    return [path for _, path in pages]
+
+def _finish(parts, output):
+    assemble(parts, output)
+    last_date = max_inspection_date(parts)
+    parts_dir = os.path.dirname(parts[0])
+    for name in os.listdir(parts_dir):
+        os.remove(os.path.join(parts_dir, name))
+    os.rmdir(parts_dir)
+    return last_date
+
+def read_state():
+    path = os.path.join(DATA_DIR, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def write_state(state):
+    with open(os.path.join(DATA_DIR, STATE_FILE), "w") as f:
+        json.dump(state, f, indent=2)
+
+def download_nyc_inspections(workers=4, page_size=PAGE_SIZE, compress=False, url=SODA_URL, max_rows=None):
+    print("Downloading NYC DOHMH Restaurant Inspections...")
+    output = f"{DATA_DIR}/inspections_raw.csv" + (".gz" if compress else "")
+    try:
+        parts = download_pages(output, url=url, page_size=page_size, workers=workers, max_rows=max_rows)
+        if parts is None:
+            print("No inspection rows returned.")
+            return
+        last_date = _finish(parts, output)
+        # A leftover file in the other format would shadow the fresh download
+        other = output[:-3] if compress else output + ".gz"
+        if os.path.exists(other):
+            os.remove(other)
+        if last_date is not None:
+            last_date = soql_timestamp(last_date)
+        write_state({**read_state(), "last_inspection_date": last_date})
+        print(f"NYC Inspections downloaded to {output}.")
     except Exception as e:
         print(f"Error downloading NYC data: {e}")
 
+def sync_nyc_inspections(workers=4, page_size=PAGE_SIZE, compress=False, url=SODA_URL):
+    """
+    Incremental mode: fetches the rows inspected on or after the last seen
+    inspection_date into a new feed file under data/feeds/ and returns its
+    path. The last day is fetched again because rows for it can be published
+    late; ingest.py skips the records it already has.
+    """
+    last_date = read_state().get("last_inspection_date")
+    if last_date is None:
+        print("No previous download recorded; run a full download first.")
+        return None
+    try:
+        last_date = soql_timestamp(last_date)
+    except ValueError:
+        print(f"Invalid last_inspection_date {last_date!r} in {STATE_FILE}; run a full download first.")
+        return None
+    print(f"Fetching inspections since {last_date}...")
+    os.makedirs(f"{DATA_DIR}/feeds", exist_ok=True)
+    # Named after the starting date so an interrupted sync resumes into the same file
+    stamp = last_date[:10].replace("-", "")
+    output = f"{DATA_DIR}/feeds/inspections_since_{stamp}.csv" + (".gz" if compress else "")
+    parts = download_pages(output, where=f"inspection_date >= '{last_date}'", url=url,
+                           page_size=page_size, workers=workers)
+    if parts is None:
+        print("No new inspection rows.")
+        return None
+    new_last = _finish(parts, output)
+    if new_last is not None:
+        last_date = max(last_date, soql_timestamp(new_last))
+    write_state({**read_state(), "last_inspection_date": last_date})
+    print(f"Saved {output}; index it with: python3 src/ingest.py {output}")
+    return output
+
 def download_generic_reviews():
     print("Downloading Generic Restaurant Reviews...")
     urls = [
@@ -73,5 +270,18 @@ def download_generic_reviews():
     df.to_csv(f"{DATA_DIR}/reviews_raw.csv", index=False)
 
 if __name__ == "__main__":
-    download_nyc_inspections()
-    download_generic_reviews()
+    parser = argparse.ArgumentParser(description="Download NYC inspections and sample reviews.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only fetch inspections since the last download, as a feed for ingest.py")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent page requests")
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE, help="Rows per request ($limit)")
+    parser.add_argument("--max-rows", type=int, default=None, help="Stop after this many inspection rows")
+    parser.add_argument("--gzip", action="store_true", help="Store downloaded CSVs gzip-compressed")
+    parser.add_argument("--base-url", default=SODA_URL, help="SODA resource URL (e.g. a local stand-in)")
+    args = parser.parse_args()
+
+    if args.incremental:
+        sync_nyc_inspections(args.workers, args.page_size, args.gzip, args.base_url)
+    else:
+        download_nyc_inspections(args.workers, args.page_size, args.gzip, args.base_url, args.max_rows)
+        download_generic_reviews()
@@ -0,0 +1,137 @@
+import json
+import os
+import sys
+
+import numpy as np
+
+from dense_index import EXACT_MAX_DOCS, DenseIndex
+from index_store import load_snapshot, read_manifest, snapshot_path
+
+MODEL_NAME = 'sentence-transformers/all-MiniLM-L6-v2'
+
+
+class EmbeddingStore:
+    """
+    L2-normalized vectors, one per distinct text of a source, stored as a
+    plain .npy so it can be memory-mapped read-only. `row_map` maps DocTable
+    rows to their text's vector.
+    """
+
+    def __init__(self, vectors, row_map):
+        self.vectors = vectors
+        self.row_map = row_map
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def similarities(self, query_emb, rows):
+        # One gather + one matrix-vector product; vectors are unit length so
+        # the dot product is the cosine similarity.
+        docs = np.asarray(self.vectors[self.row_map[rows]], dtype=np.float32)
+        return docs @ np.asarray(query_emb, dtype=np.float32)
+
+    @classmethod
+    def load(cls, source_dir, mmap=True):
+        mode = "r" if mmap else None
+        return cls(np.load(os.path.join(source_dir, "embeddings.npy"), mmap_mode=mode),
+                   np.load(os.path.join(source_dir, "text_of_row.npy"), mmap_mode=mode))
+
+
+def build_embeddings(data_dir, model=None, batch_size=256, dtype="float16"):
+    """Encodes every distinct document text in the index snapshot once."""
+    manifest = read_manifest(data_dir)
+    snapshot = load_snapshot(data_dir, manifest)
+    if snapshot is None:
+        print("Index snapshot missing or stale. Run index_store.py first.")
+        return
+    embed_snapshot(snapshot_path(data_dir, manifest), manifest, snapshot, model, batch_size=batch_size, dtype=dtype)
+    print("Embeddings written.")
+
+
+def embed_snapshot(snapshot_dir, manifest, tables, model=None, reuse=None, batch_size=256, dtype="float16"):
+    """
+    Writes the embeddings of a snapshot's {source: (docs, index)} into its
+    directory, e.g. before its manifest is published. reuse maps texts to
+    vectors already computed (see text_vectors); only the other texts are
+    encoded, and the model is only loaded if there are any.
+    """
+    reuse = reuse or {}
+    for source, (docs, index) in tables.items():
+        # Each distinct text is represented by its first document
+        rows = index.groups.first_rows().tolist()
+        texts = [docs.columns["original_text"][i] for i in rows]
+        missing = [i for i, text in enumerate(texts) if text not in reuse]
+        print(f"Encoding {len(missing)} of {len(rows)} distinct {source} texts ({len(docs)} documents)...")
+        vectors = None
+        if missing:
+            if model is None:
+                from sentence_transformers import SentenceTransformer
+                model = SentenceTransformer(MODEL_NAME)
+            encoded = model.encode([texts[i] for i in missing], batch_size=batch_size, normalize_embeddings=True,
+                                   show_progress_bar=True, convert_to_numpy=True)
+            encoded = np.asarray(encoded, dtype=dtype).reshape(len(missing), -1)
+            vectors = np.zeros((len(rows), encoded.shape[1]), dtype=dtype)
+            vectors[missing] = encoded
+        elif reuse:
+            vectors = np.zeros((len(rows), len(next(iter(reuse.values())))), dtype=dtype)
+        known = [i for i, text in enumerate(texts) if text in reuse]
+        if known:
+            vectors[known] = np.stack([reuse[texts[i]] for i in known])
+        if vectors is None:
+            continue
+        source_dir = os.path.join(snapshot_dir, source)
+        np.save(os.path.join(source_dir, "embeddings.npy"), vectors)
+        for name in ("ivf_centroids.npy", "ivf_offsets.npy", "ivf_rows.npy"):
+            if os.path.exists(os.path.join(source_dir, name)):
+                os.remove(os.path.join(source_dir, name))
+        if len(rows) > EXACT_MAX_DOCS:
+            print(f"Building IVF index for {source}...")
+            DenseIndex.build_ivf(vectors).save_ivf(source_dir)
+        with open(os.path.join(source_dir, "embeddings.json"), "w") as f:
+            json.dump({
+                "model": MODEL_NAME,
+                "dtype": dtype,
+                "dim": int(vectors.shape[1]),
+                "num_texts": len(rows),
+                "snapshot_created": manifest["created"],
+            }, f, indent=2)
+
+
+def text_vectors(tables, stores):
+    """{text: vector} of the texts covered by a snapshot's embedding stores."""
+    vectors = {}
+    for source, store in stores.items():
+        docs, index = tables[source]
+        rows = index.groups.first_rows().tolist()
+        for text, vector in zip((docs.columns["original_text"][i] for i in rows), np.asarray(store.vectors)):
+            vectors.setdefault(text, vector)
+    return vectors
+
+
+def load_embeddings(data_dir, manifest=None):
+    """
+    Returns {source: EmbeddingStore} for sources whose embeddings were built
+    against the current snapshot. Out-of-date stores are skipped.
+    """
+    if manifest is None:
+        manifest = read_manifest(data_dir)
+    stores = {}
+    if manifest is None or "path" not in manifest:
+        return stores
+    for source, entry in manifest["sources"].items():
+        source_dir = os.path.join(snapshot_path(data_dir, manifest), source)
+        meta_path = os.path.join(source_dir, "embeddings.json")
+        if not os.path.exists(meta_path):
+            continue
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if (meta["model"] != MODEL_NAME or meta.get("num_texts") != entry["num_texts"]
+                or meta["snapshot_created"] != manifest["created"]):
+            print(f"Embeddings for {source} are stale; rerank will encode candidates.")
+            continue
+        stores[source] = EmbeddingStore.load(source_dir)
+    return stores
+
+
+if __name__ == "__main__":
+    build_embeddings(sys.argv[1] if len(sys.argv) > 1 else "saferbites/data")
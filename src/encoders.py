@@ -0,0 +1,144 @@
+import argparse
+import os
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from embeddings import MODEL_NAME
+
+BACKENDS = ("torch", "int8", "onnx", "hash")
+
+
+class HashEncoder:
+    """
+    Deterministic stand-in for the SentenceTransformer: a signed hashed
+    bag of words. No model download or torch, so benchmarks and offline
+    runs exercise the whole reranking path; the scores only reflect word
+    overlap.
+    """
+
+    def __init__(self, dim=384):
+        self.dim = dim
+
+    def encode(self, texts, batch_size=32, normalize_embeddings=True, convert_to_numpy=True, **kwargs):
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in str(text).lower().split():
+                h = zlib.crc32(word.encode("utf-8"))
+                vectors[i, h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        if normalize_embeddings:
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors /= np.maximum(norms, 1e-12)
+        return vectors[0] if single else vectors
+
+
+def load_encoder(backend="torch", model_name=MODEL_NAME, threads=None):
+    """
+    The reranker's SentenceTransformer on one of the CPU backends:
+
+    torch: float32 PyTorch, the reference
+    int8:  PyTorch with dynamic int8 quantization of the Linear layers
+    onnx:  the model exported to an ONNX graph and run by ONNX Runtime
+           (needs `optimum[onnxruntime]`)
+    hash:  HashEncoder, a deterministic offline stub (benchmarks)
+
+    threads caps the intra-op thread pool, so that several serving workers
+    on one machine do not oversubscribe its cores.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown encoder backend {backend!r}; expected one of {BACKENDS}")
+    if backend == "hash":
+        return HashEncoder()
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    if threads:
+        torch.set_num_threads(threads)
+    if backend == "onnx":
+        model_kwargs = {}
+        if threads:
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+            model_kwargs["session_options"] = options
+        return SentenceTransformer(model_name, backend="onnx", model_kwargs=model_kwargs)
+    if backend == "int8":
+        # Quantized kernels are CPU-only
+        model = SentenceTransformer(model_name, device="cpu")
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return SentenceTransformer(model_name)
+
+
+def _encode_ms(model, texts, batch_size=32, repeat=3):
+    # Best of a few runs, per text
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        model.encode(texts, batch_size=batch_size, normalize_embeddings=True, convert_to_numpy=True)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000 / max(len(texts), 1)
+
+
+def check_agreement(data_dir="data", backends=("int8", "onnx"), threads=None, top_k=30):
+    """
+    Ranking agreement of each backend with the float32 model on the labeled
+    queries: overlap of the top-10 businesses, how often the top-10 order is
+    identical, query-embedding cosine to float32, P@10/NDCG@10 against the
+    labels, and encode time per text.
+    """
+    # Imported here so the backends can be loaded without the evaluation stack
+    from evaluate import compute_metrics
+    from retrieval import SaferBitesEngine
+
+    labels = pd.read_csv(os.path.join(data_dir, "labeled_queries.csv"))
+    queries = labels["query"].tolist()
+    relevant = [set(str(x) for x in str(ids).split()) for ids in labels["relevant_business_ids"]]
+
+    runs = {}
+    for backend in ("torch",) + tuple(b for b in backends if b != "torch"):
+        try:
+            engine = SaferBitesEngine(data_dir, encoder_backend=backend, encoder_threads=threads,
+                                      result_cache_size=0, embedding_cache_size=0, encode_wait_ms=None)
+        except ImportError as e:
+            print(f"Skipping {backend}: {e}")
+            continue
+        ranked = [[str(b["business_id"]) for b in engine.search(q, top_k=top_k)] for q in queries]
+        texts = list({str(h["text"]) for q in queries[:10] for h in engine.search_bm25(q, top_k)})
+        runs[backend] = {
+            "ranked": ranked,
+            "query_embs": np.array([engine.encode_query(q) for q in queries], dtype=np.float32),
+            "encode_ms": _encode_ms(engine.model, texts),
+            "metrics": [compute_metrics(r, rel, k=10) for r, rel in zip(ranked, relevant)],
+        }
+
+    reference = runs["torch"]
+    print(f"{'backend':>8} {'overlap@10':>11} {'same top10':>11} {'query cos':>10} {'P@10':>7} {'NDCG@10':>8} "
+          f"{'ms/text':>8} {'speedup':>8}")
+    report = {}
+    for backend, run in runs.items():
+        overlap = np.mean([len(set(a[:10]) & set(b[:10])) / max(min(len(b), 10), 1)
+                           for a, b in zip(run["ranked"], reference["ranked"])])
+        same = np.mean([a[:10] == b[:10] for a, b in zip(run["ranked"], reference["ranked"])])
+        cosine = float(np.mean(np.sum(run["query_embs"] * reference["query_embs"], axis=1)))
+        p10 = np.mean([m[0] for m in run["metrics"]])
+        ndcg = np.mean([m[2] for m in run["metrics"]])
+        speedup = reference["encode_ms"] / run["encode_ms"]
+        report[backend] = {"overlap@10": overlap, "same_top10": same, "query_cosine": cosine, "p@10": p10,
+                           "ndcg@10": ndcg, "encode_ms_per_text": run["encode_ms"], "speedup": speedup}
+        print(f"{backend:>8} {overlap:>11.3f} {same:>11.3f} {cosine:>10.4f} {p10:>7.4f} {ndcg:>8.4f} "
+              f"{run['encode_ms']:>8.3f} {speedup:>7.2f}x")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare encoder backends against the float32 model.")
+    parser.add_argument("backends", nargs="*", default=["int8", "onnx"], choices=BACKENDS)
+    parser.add_argument("--data-dir", default="data")
+    parser.add_argument("--threads", type=int, default=None, help="Intra-op threads per encoder")
+    args = parser.parse_args()
+    check_agreement(args.data_dir, args.backends, args.threads)
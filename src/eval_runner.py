@@ -0,0 +1,314 @@
+"""
+Parameter sweeps over the search pipeline on the labeled queries.
+
+    python3 src/eval_runner.py --top-k 10,30,100 --k1 1.2,1.5,2.0 --b 0.5,0.75 \
+        --rerank off,on --fusion sum,max --workers 4 --output sweep.csv
+
+Each stage is computed once and reused by every configuration it does not
+depend on, and cached on disk under <data-dir>/eval_cache (per index version
+and query set):
+
+    first stage   one BM25 run per (k1, b) at the deepest top_k, in TREC run
+                  format; a smaller top_k is a prefix of it
+    embeddings    query vectors and vectors of candidates without precomputed
+                  embeddings (.npy), shared by every reranked configuration
+    rerank        cosine of each query with each of its candidates
+
+BM25 runs and the per-configuration scoring are spread over a pool of forked
+processes sharing the loaded index. Latency is measured separately, live, on
+a sample of queries for every configuration.
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from embeddings import MODEL_NAME
+from evaluate import average_precision, compute_metrics
+from lexical_index import B, K1
+from retrieval import SaferBitesEngine
+
+# The engine the pool's forked workers inherit
+_engine = None
+
+
+def read_labels(path):
+    df = pd.read_csv(path)
+    queries = df["query"].astype(str).tolist()
+    relevant = [set(str(x) for x in str(ids).split()) for ids in df["relevant_business_ids"]]
+    return queries, relevant
+
+
+def write_run(path, run, tag):
+    """{qid: [(docno, score), ...]} as a TREC run file."""
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        for qid, entries in run.items():
+            for rank, (docno, score) in enumerate(entries, 1):
+                f.write(f"{qid} Q0 {docno} {rank} {score!r} {tag}\n")
+    os.replace(tmp, path)
+
+
+def read_run(path):
+    run = {}
+    with open(path) as f:
+        for line in f:
+            qid, _, docno, _, score, _ = line.split()
+            run.setdefault(int(qid), []).append((docno, float(score)))
+    return run
+
+
+def _docno(source, row):
+    return f"{source}/{row}"
+
+
+def _parse_docno(docno):
+    source, row = docno.split("/")
+    return source, int(row)
+
+
+def _first_stage(k1, b, depth, chunk):
+    # Pool task: BM25 candidates (per source, best first) for some queries
+    _engine.set_bm25_params(k1, b)
+    out = []
+    for qid, query in chunk:
+        hits = _engine.search_bm25(query, depth)
+        out.append((qid, [(_docno(h["source"], h["row"]), h["score"]) for h in hits]))
+    return out
+
+
+def _score(config, chunk):
+    # Pool task: P@10, NDCG@10 and AP of one configuration on some queries
+    top_k, rerank, fusion = config["top_k"], config["rerank"], config["fusion"]
+    sources = {"violation": _engine.violations, "review": _engine.reviews}
+    out = []
+    for qid, query, relevant, entries, rerank_scores in chunk:
+        hits, per_source = [], {}
+        for docno, score in entries:
+            source, row = _parse_docno(docno)
+            per_source[source] = per_source.get(source, 0) + 1
+            if per_source[source] > top_k:
+                continue
+            hit = sources[source].hit(row, score, source)
+            if rerank:
+                hit["rerank_score"] = rerank_scores[docno]
+            hits.append(hit)
+        if rerank:
+            hits = sorted(hits, key=lambda x: x["rerank_score"], reverse=True)
+        ranked = [str(r["business_id"]) for r in _engine.aggregate_results(hits, query, fusion=fusion)]
+        p10, _, ndcg = compute_metrics(ranked, relevant, k=10)
+        out.append((qid, p10, ndcg, average_precision(ranked, relevant)))
+    return out
+
+
+class EvalRunner:
+    def __init__(self, data_dir="data", labels=None, cache_dir=None, workers=None, encoder_backend="torch",
+                 use_reranker=True):
+        global _engine
+        self.data_dir = data_dir
+        self.queries, self.relevant = read_labels(labels or os.path.join(data_dir, "labeled_queries.csv"))
+        self.workers = workers or os.cpu_count() or 1
+        self.encoder_backend = encoder_backend
+        # No result or query-embedding caches: latencies are measured cold
+        self.engine = _engine = SaferBitesEngine(data_dir, use_reranker=use_reranker, result_cache_size=0,
+                                                 embedding_cache_size=0, encode_wait_ms=None,
+                                                 encoder_backend=encoder_backend)
+        self.cache_dir = None
+        version = self.engine.index_version
+        if version is None:
+            print("No index snapshot; intermediate results are not cached on disk.")
+        else:
+            key = hashlib.sha1(json.dumps([list(version), self.queries]).encode()).hexdigest()[:12]
+            self.cache_dir = os.path.join(cache_dir or os.path.join(data_dir, "eval_cache"), key)
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, name) if self.cache_dir else None
+
+    def _map(self, func, tasks):
+        if self.workers <= 1 or len(tasks) <= 1:
+            return [func(*task) for task in tasks]
+        # Forked workers share the loaded index copy-on-write
+        with multiprocessing.get_context("fork").Pool(self.workers) as pool:
+            return pool.starmap(func, tasks)
+
+    def _chunks(self, items):
+        size = max(1, -(-len(items) // (self.workers * 4)))
+        return [items[i:i + size] for i in range(0, len(items), size)]
+
+    def first_stage(self, params, depth):
+        """{(k1, b): {qid: [(docno, score)]}} at `depth` per source, from the cache where possible."""
+        runs, missing = {}, []
+        for k1, b in params:
+            path = self._path(f"bm25_k1={k1}_b={b}_depth={depth}.run")
+            if path and os.path.exists(path):
+                runs[(k1, b)] = read_run(path)
+            else:
+                missing.append((k1, b))
+        if missing:
+            print(f"Running BM25 for {len(missing)} (k1, b) settings...")
+            queries = list(enumerate(self.queries))
+            tasks = [(k1, b, depth, chunk) for k1, b in missing for chunk in self._chunks(queries)]
+            results = self._map(_first_stage, tasks)
+            for (k1, b, _, _), result in zip(tasks, results):
+                runs.setdefault((k1, b), {}).update(result)
+            for k1, b in missing:
+                run = {qid: runs[(k1, b)].get(qid, []) for qid in range(len(self.queries))}
+                runs[(k1, b)] = run
+                if self.cache_dir:
+                    write_run(self._path(f"bm25_k1={k1}_b={b}_depth={depth}.run"), run, f"bm25_k1={k1}_b={b}")
+        return runs
+
+    def _cached_vectors(self, name, keys, encode):
+        """Vectors for `keys`, encoding (and caching) only those not cached yet."""
+        vectors = {}
+        npy, index = self._path(f"{name}.npy"), self._path(f"{name}.json")
+        if npy and os.path.exists(npy) and os.path.exists(index):
+            with open(index) as f:
+                cached_keys = json.load(f)
+            cached = np.load(npy)
+            vectors = dict(zip(cached_keys, cached))
+        missing = [k for k in dict.fromkeys(keys) if k not in vectors]
+        if missing:
+            for k, v in zip(missing, encode(missing)):
+                vectors[k] = v
+            if self.cache_dir:
+                all_keys = list(vectors)
+                np.save(npy, np.array([vectors[k] for k in all_keys], dtype=np.float32))
+                with open(index, "w") as f:
+                    json.dump(all_keys, f)
+        return vectors
+
+    def rerank_scores(self, runs):
+        """{qid: {docno: cosine}} for every candidate of every run."""
+        tag = f"{MODEL_NAME.replace('/', '_')}-{self.encoder_backend}"
+        engine = self.engine
+        query_vecs = self._cached_vectors(f"queries-{tag}", self.queries,
+                                          lambda qs: engine._encode(qs))
+        candidates = {qid: list(dict.fromkeys(d for run in runs.values() for d, _ in run[qid]))
+                      for qid in range(len(self.queries))}
+
+        # Candidates covered by the precomputed embeddings need no encoding
+        def embedded(docno):
+            source, row = _parse_docno(docno)
+            store = engine.doc_embeddings.get(source)
+            return store is not None and row < len(store.row_map)
+
+        texts = {}
+        for docnos in candidates.values():
+            for d in docnos:
+                if d not in texts and not embedded(d):
+                    source, row = _parse_docno(d)
+                    docs = engine.violations if source == "violation" else engine.reviews
+                    texts[d] = docs.hit(row, 0.0, source)["text"]
+        doc_vecs = self._cached_vectors(f"docs-{tag}", list(texts),
+                                        lambda ds: engine._encode([texts[d] for d in ds]))
+
+        scores = {}
+        for qid, docnos in candidates.items():
+            q = query_vecs[self.queries[qid]]
+            scores[qid] = {}
+            for source in ("violation", "review"):
+                stored = [d for d in docnos if d.startswith(source + "/") and embedded(d)]
+                if stored:
+                    rows = [_parse_docno(d)[1] for d in stored]
+                    sims = engine.doc_embeddings[source].similarities(q, rows)
+                    scores[qid].update(zip(stored, np.asarray(sims).tolist()))
+            for d in docnos:
+                if d in doc_vecs:
+                    scores[qid][d] = float(np.dot(doc_vecs[d], q))
+        return scores
+
+    def latency(self, config, sample):
+        """Live per-query milliseconds of search_bm25 -> rerank -> aggregate_results."""
+        engine = self.engine
+        times = []
+        for query in sample:
+            start = time.perf_counter()
+            hits = engine.search_bm25(query, config["top_k"])
+            if config["rerank"]:
+                hits = engine.rerank(query, hits)
+            engine.aggregate_results(hits, query, fusion=config["fusion"])
+            times.append((time.perf_counter() - start) * 1000)
+        return times
+
+    def sweep(self, top_ks=(30,), k1s=(K1,), bs=(B,), reranks=(True,), fusions=("sum",), latency_queries=20):
+        """One row per configuration: quality (P@10, NDCG@10, MAP) and latency (ms/query)."""
+        configs = [dict(top_k=t, k1=k1, b=b, rerank=r, fusion=f)
+                   for k1, b, t, r, f in itertools.product(k1s, bs, top_ks, reranks, fusions)]
+        params = list(dict.fromkeys((c["k1"], c["b"]) for c in configs))
+        depth = max(top_ks)
+
+        start = time.perf_counter()
+        runs = self.first_stage(params, depth)
+        scores = self.rerank_scores(runs) if any(reranks) else {}
+        print(f"Candidates ready in {time.perf_counter() - start:.1f}s; scoring {len(configs)} configurations...")
+
+        tasks = []
+        for i, config in enumerate(configs):
+            run = runs[(config["k1"], config["b"])]
+            items = [(qid, q, self.relevant[qid], run[qid], scores.get(qid) if config["rerank"] else None)
+                     for qid, q in enumerate(self.queries)]
+            tasks += [(config, chunk) for chunk in self._chunks(items)]
+        results = self._map(_score, tasks)
+        per_config = {}
+        for (config, _), result in zip(tasks, results):
+            per_config.setdefault(id(config), []).extend(result)
+
+        sample = self.queries[:latency_queries]
+        rows = []
+        current = None
+        for config in configs:
+            if (config["k1"], config["b"]) != current:
+                current = (config["k1"], config["b"])
+                self.engine.set_bm25_params(*current)
+            self.latency(config, sample[:3])  # warm-up
+            times = self.latency(config, sample)
+            metrics = np.array([m[1:] for m in per_config[id(config)]])
+            rows.append({**config, "p@10": metrics[:, 0].mean(), "ndcg@10": metrics[:, 1].mean(),
+                         "map": metrics[:, 2].mean(), "ms_mean": float(np.mean(times)),
+                         "ms_p95": float(np.percentile(times, 95))})
+        self.engine.set_bm25_params(K1, B)
+        return pd.DataFrame(rows)
+
+
+def _floats(text):
+    return [float(x) for x in text.split(",")]
+
+
+def _flags(text):
+    return [x.strip().lower() in ("on", "true", "1", "yes") for x in text.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep search settings on the labeled queries.")
+    parser.add_argument("--data-dir", default="data")
+    parser.add_argument("--labels", default=None, help="Defaults to <data-dir>/labeled_queries.csv")
+    parser.add_argument("--cache-dir", default=None, help="Defaults to <data-dir>/eval_cache")
+    parser.add_argument("--top-k", default="30", help="Comma-separated candidate depths per source")
+    parser.add_argument("--k1", default=str(K1))
+    parser.add_argument("--b", default=str(B))
+    parser.add_argument("--rerank", default="on", help="on, off or on,off")
+    parser.add_argument("--fusion", default="sum", help="Business score fusion: sum, max, mean")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--encoder", default="torch", help="Encoder backend for reranking")
+    parser.add_argument("--latency-queries", type=int, default=20, help="Queries timed per configuration")
+    parser.add_argument("--output", default=None, help="Also write the table as CSV")
+    args = parser.parse_args()
+
+    reranks = _flags(args.rerank)
+    runner = EvalRunner(args.data_dir, args.labels, args.cache_dir, args.workers, args.encoder,
+                        use_reranker=any(reranks))
+    table = runner.sweep([int(x) for x in args.top_k.split(",")], _floats(args.k1), _floats(args.b), reranks,
+                         args.fusion.split(","), args.latency_queries)
+    table["rerank"] = table["rerank"].map({True: "on", False: "off"})
+    print(table.to_string(index=False, float_format=lambda x: f"{x:.4f}"))
+    if args.output:
+        table.to_csv(args.output, index=False)
+        print(f"Written to {args.output}")
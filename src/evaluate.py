@@ -1,8 +1,11 @@
 import pandas as pd
 import numpy as np
 from retrieval import SaferBitesEngine
+from dense_index import DenseIndex
 from sklearn.metrics import ndcg_score
 import os
+import sys
+import time
 
 def compute_metrics(retrieved_ids, relevant_ids, k=10):
     # retrieved_ids: list of business_ids returned
@@ -37,6 +40,56 @@ def compute_metrics(retrieved_ids, relevant_ids, k=10):
         
     return precision, recall, ndcg
 
+def average_precision(retrieved_ids, relevant_ids):
+    # Mean of the precision at each relevant hit, over all relevant ids (for MAP)
+    hits, total = 0, 0.0
+    for i, bid in enumerate(retrieved_ids):
+        if bid in relevant_ids:
+            hits += 1
+            total += hits / (i + 1)
+    return total / len(relevant_ids) if len(relevant_ids) > 0 else 0.0
+
+def evaluate_dense_tradeoff(engine, df, nprobes=(1, 2, 4, 8, 16, 32), depths=(30, 100)):
+    # Latency vs recall of the approximate dense stage, measured against
+    # the exact brute-force scan, plus end-to-end quality of the hybrid.
+    if not engine.dense_indexes:
+        print("No document embeddings found. Run embeddings.py first.")
+        return
+    exact = {s: DenseIndex(d.vectors) for s, d in engine.dense_indexes.items()}
+    approx = {s: d if d.is_approximate else DenseIndex.build_ivf(d.vectors) for s, d in engine.dense_indexes.items()}
+    query_embs = {q: engine.encode_query(q) for q in df["query"]}
+
+    print(f"{'depth':>6} {'nprobe':>7} {'recall':>8} {'dense ms':>9} {'P@10':>7} {'NDCG@10':>8}")
+    for depth in depths:
+        truth = {(q, s): set(d.search(emb, depth)[0].tolist())
+                 for q, emb in query_embs.items() for s, d in exact.items()}
+        for nprobe in nprobes:
+            recalls, latencies, p10s, ndcgs = [], [], [], []
+            for q, emb in query_embs.items():
+                for s, d in approx.items():
+                    start = time.perf_counter()
+                    rows, _ = d.search(emb, depth, nprobe=nprobe)
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    expected = truth[(q, s)]
+                    if expected:
+                        recalls.append(len(expected.intersection(rows.tolist())) / len(expected))
+
+            engine.state, saved = engine.state.replace(dense_indexes=approx), engine.state
+            for idx, row in df.iterrows():
+                query = row["query"]
+                rel_ids = set(str(x) for x in str(row["relevant_business_ids"]).split())
+                res = engine.search_hybrid(query, dense_k=depth, nprobe=nprobe, query_emb=query_embs[query])
+                res = engine.rerank(query, res, query_emb=query_embs[query])
+                retrieved_ids = [str(b["business_id"]) for b in engine.aggregate_results(res, query)]
+                p10, _, ndcg = compute_metrics(retrieved_ids, rel_ids, k=10)
+                p10s.append(p10)
+                ndcgs.append(ndcg)
+            engine.state = saved
+
+            print(f"{depth:>6} {nprobe:>7} {np.mean(recalls):>8.3f} {np.mean(latencies):>9.3f} "
+                  f"{np.mean(p10s):>7.4f} {np.mean(ndcgs):>8.4f}")
+
+
 def main():
     engine = SaferBitesEngine()
     
@@ -60,18 +113,13 @@ def main():
     
     print(f"Evaluating on {len(df)} queries...")
     
-    for idx, row in df.iterrows():
+    # BM25 -> Rerank -> Aggregate for all queries in one batch
+    batch_res = engine.search_batch(df["query"].tolist())
+    
+    for (idx, row), agg_res in zip(df.iterrows(), batch_res):
         query = row["query"]
         rel_ids = set(str(x) for x in str(row["relevant_business_ids"]).split())
         
-        # Run System
-        # 1. BM25
-        res = engine.search_bm25(query)
-        # 2. Rerank
-        res = engine.rerank(query, res)
-        # 3. Aggregate
-        agg_res = engine.aggregate_results(res, query)
-        
         retrieved_ids = [str(b["business_id"]) for b in agg_res]
         
         p10, r10, ndcg = compute_metrics(retrieved_ids, rel_ids, k=10)
@@ -84,5 +132,10 @@ def main():
     print(f"Mean P@10: {np.mean(metrics['p@10']):.4f}")
     print(f"Mean NDCG@10: {np.mean(metrics['ndcg@10']):.4f}")
 
+    if "--dense-sweep" in sys.argv:
+        print("-" * 30)
+        print("Dense retrieval latency/recall tradeoff:")
+        evaluate_dense_tradeoff(engine, df)
+
 if __name__ == "__main__":
     main()
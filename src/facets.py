@@ -0,0 +1,141 @@
+import json
+import os
+
+import numpy as np
+
+from cache import LRUCache
+from tagger import TAG_BITS, TAG_CATEGORIES
+
+FACET_FIELDS = ["boro", "zipcode"]
+# Values matching fewer than 1 in SPARSE_RATIO rows are stored as sorted row
+# ids instead of a bitmap
+SPARSE_RATIO = 32
+# Sparse values expanded to bitmaps, kept per index for repeated filters
+EXPANDED_CACHE_SIZE = 64
+
+
+def normalize_value(value):
+    return str(value).strip().lower()
+
+
+def bitmap_from_rows(rows, size):
+    bits = np.zeros(size, dtype=bool)
+    bits[rows] = True
+    return np.packbits(bits, bitorder="little")
+
+
+def test_bits(bitmap, rows):
+    """Boolean array: whether each row is set in a packed bitmap."""
+    rows = np.asarray(rows, dtype=np.int64)
+    return ((bitmap[rows >> 3] >> (rows & 7)) & 1).astype(bool)
+
+
+class FacetIndex:
+    """
+    Per-value row sets for a source's facets (boro, zipcode, tag), stored
+    compressed: a packed bitmap for common values, sorted row ids for rare
+    ones. Each value has a document-level set and a text-level set (texts
+    with at least one matching document) used to prune postings before
+    scoring.
+    """
+
+    def __init__(self, entries, data, num_rows, num_texts):
+        self.entries = entries
+        self.data = data
+        self.num_rows = num_rows
+        self.num_texts = num_texts
+        self._expanded = LRUCache(EXPANDED_CACHE_SIZE)
+
+    @classmethod
+    def build(cls, df, groups):
+        num_rows, num_texts = len(df), len(groups)
+        entries, chunks, offset = {}, [], 0
+
+        def add(field, value, rows):
+            nonlocal offset
+            text_rows = np.unique(groups.text_of_row[rows])
+            for level, ids, size in (("row", rows, num_rows), ("text", text_rows, num_texts)):
+                if len(ids) * SPARSE_RATIO < size:
+                    kind, blob = "rows", np.asarray(ids, dtype=np.int32).view(np.uint8)
+                else:
+                    kind, blob = "bits", bitmap_from_rows(ids, size)
+                entries.setdefault(field, {}).setdefault(value, {})[level] = (kind, offset, offset + len(blob))
+                chunks.append(blob)
+                offset += len(blob)
+
+        for field in FACET_FIELDS:
+            values = df[field].map(normalize_value).to_numpy()
+            codes, uniques = _factorize(values)
+            order = np.argsort(codes, kind="stable")
+            bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+            for i, value in enumerate(uniques):
+                if value:
+                    add(field, value, order[bounds[i]:bounds[i + 1]])
+
+        masks = df["tag_mask"].to_numpy()
+        for category in TAG_CATEGORIES:
+            add("tag", category, np.flatnonzero(masks & TAG_BITS[category]))
+
+        data = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.uint8)
+        return cls(entries, data, num_rows, num_texts)
+
+    def values(self, field):
+        return sorted(self.entries.get(field, {}))
+
+    def _bitmap(self, field, value, level):
+        value = normalize_value(value)
+        entry = self.entries.get(field, {}).get(value)
+        if entry is not None and entry[level][0] == "bits":
+            return np.asarray(self.data[entry[level][1]:entry[level][2]])
+        # Row lists (and unknown values) would cost a pass over the whole
+        # corpus to expand on every query; the index never changes, so the
+        # bitmaps of recently used values are kept.
+        key = (field, value, level)
+        bitmap = self._expanded.get(key)
+        if bitmap is None:
+            size = self.num_rows if level == "row" else self.num_texts
+            if entry is None:
+                bitmap = np.zeros((size + 7) // 8, dtype=np.uint8)
+            else:
+                _, start, end = entry[level]
+                bitmap = bitmap_from_rows(np.asarray(self.data[start:end]).view(np.int32), size)
+            bitmap.flags.writeable = False
+            self._expanded.put(key, bitmap)
+        return bitmap
+
+    def bitmaps(self, filters):
+        """
+        (row_bitmap, text_bitmap) for a {field: value or [values]} filter:
+        values within a field are OR-ed, fields are AND-ed. Returns
+        (None, None) when no facet filter applies.
+        """
+        row_bitmap = text_bitmap = None
+        for field, wanted in filters.items():
+            if field not in FACET_FIELDS and field != "tag":
+                continue
+            if wanted is None or wanted == "" or wanted == []:
+                continue
+            if isinstance(wanted, str):
+                wanted = [wanted]
+            rows = np.bitwise_or.reduce([self._bitmap(field, v, "row") for v in wanted])
+            texts = np.bitwise_or.reduce([self._bitmap(field, v, "text") for v in wanted])
+            row_bitmap = rows if row_bitmap is None else row_bitmap & rows
+            text_bitmap = texts if text_bitmap is None else text_bitmap & texts
+        return row_bitmap, text_bitmap
+
+    def save(self, path):
+        with open(os.path.join(path, "facets.json"), "w") as f:
+            json.dump({"num_rows": self.num_rows, "num_texts": self.num_texts, "entries": self.entries}, f)
+        np.save(os.path.join(path, "facets.npy"), self.data)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, "facets.json")) as f:
+            meta = json.load(f)
+        data = np.load(os.path.join(path, "facets.npy"), mmap_mode="r" if mmap else None)
+        return cls(meta["entries"], data, meta["num_rows"], meta["num_texts"])
+
+
+def _factorize(values):
+    uniques, codes = np.unique(values.astype(str), return_inverse=True)
+    return codes.reshape(-1), uniques.tolist()
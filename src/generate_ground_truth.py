@@ -1,11 +1,16 @@
-import pandas as pd
+import argparse
 import os
-import re
-from rank_bm25 import BM25Okapi
-import glob
+import time
+
+import numpy as np
+import pandas as pd
+
+from facets import test_bits
+from index_store import build_tables, read_sources
+from lexical_index import tokenize
+from segments import BASE_SEGMENT, combine_segments, load_segments
 
 DATA_DIR = "saferbites/data"
-LABELS_FILE = f"{DATA_DIR}/labeled_queries.csv"
 
 # 50 Queries covering safety topics
 QUERIES = [
@@ -25,69 +30,203 @@ QUERIES = [
     "bad smell", "sewage odor", "plumbing issues", "water leak", "no hot water"
 ]
 
-def tokenize(text):
-    return re.findall(r'\w+', str(text).lower())
 
-def generate_ground_truth():
+def intersect_sorted(a, b):
+    """
+    Common values of two sorted unique non-negative arrays and their
+    positions in each. Binary-searches the shorter array in the longer one,
+    so a rare term costs little against a common one; two long arrays go
+    through a position table instead.
+    """
+    if len(a) > len(b):
+        common, ib, ia = intersect_sorted(b, a)
+        return common, ia, ib
+    if len(a) == 0:
+        return a, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if len(a) * 16 > len(b):
+        position = np.full(int(max(a[-1], b[-1])) + 1, -1, dtype=np.int64)
+        position[b] = np.arange(len(b))
+        ib = position[a]
+        ia = np.flatnonzero(ib >= 0)
+        return a[ia], ia, ib[ia]
+    ib = np.minimum(np.searchsorted(b, a), len(b) - 1)
+    found = b[ib] == a
+    ia = np.flatnonzero(found)
+    return a[ia], ia, ib[ia]
+
+
+class BusinessPostings:
+    """
+    Term -> sorted array of business codes with at least one live document
+    containing the term (plus how many such documents), read off the
+    engine's own postings: each source's text postings are mapped to
+    businesses through a text -> businesses table built once per segment.
+    Codes index the business table shared by all sources.
+    """
+
+    def __init__(self, tables):
+        self.businesses = next(iter(tables.values()))[0].businesses
+        self.parts = []
+        for docs, index in tables.values():
+            for s, (table, segment) in enumerate(zip(docs.tables, index.indexes)):
+                self.parts.append((segment.lexical, *self._text_businesses(table, segment, docs.code_maps[s])))
+        self._cache = {}
+
+    def _text_businesses(self, table, segment, code_map):
+        # CSR: the businesses (and document counts) of every distinct text
+        rows = np.arange(len(table), dtype=np.int64)
+        if segment.live_rows is not None:
+            rows = rows[test_bits(segment.live_rows, rows)]
+        codes = np.asarray(table.business_code)[rows].astype(np.int64)
+        if code_map is not None:
+            codes = code_map[codes].astype(np.int64)
+        texts = np.asarray(segment.groups.text_of_row)[rows].astype(np.int64)
+        n = max(len(self.businesses), 1)
+        pairs, counts = np.unique(texts * n + codes, return_counts=True)
+        offsets = np.searchsorted(pairs // n, np.arange(len(segment.groups) + 1))
+        return offsets, pairs % n, counts
+
+    def term(self, token):
+        """(sorted business codes, documents per business) for one token."""
+        if token in self._cache:
+            return self._cache[token]
+        codes, counts = [], []
+        for lexical, offsets, text_codes, text_counts in self.parts:
+            tid = lexical.term_index.get(token)
+            if tid is None:
+                continue
+            texts = np.asarray(lexical.doc_ids[lexical.offsets[tid]:lexical.offsets[tid + 1]], dtype=np.int64)
+            starts, lens = offsets[texts], offsets[texts + 1] - offsets[texts]
+            shift = np.repeat(starts - np.concatenate([[0], np.cumsum(lens)[:-1]]), lens)
+            idx = shift + np.arange(lens.sum())
+            codes.append(text_codes[idx])
+            counts.append(text_counts[idx])
+        if codes:
+            merged, inverse = np.unique(np.concatenate(codes), return_inverse=True)
+            result = merged, np.bincount(inverse, weights=np.concatenate(counts)).astype(np.int64)
+        else:
+            result = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        self._cache[token] = result
+        return result
+
+    def match_all(self, tokens):
+        """Boolean AND: businesses having every token (in some document), with summed document counts."""
+        codes, counts = None, None
+        # Rarest term first, so the running intersection stays small
+        for t_codes, t_counts in sorted((self.term(t) for t in dict.fromkeys(tokens)), key=lambda p: len(p[0])):
+            if codes is None:
+                codes, counts = t_codes, t_counts
+                continue
+            codes, a, b = intersect_sorted(codes, t_codes)
+            counts = counts[a] + t_counts[b]
+            if not len(codes):
+                break
+        if codes is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return codes, counts, np.full(len(codes), len(dict.fromkeys(tokens)))
+
+    def match_any(self, tokens):
+        """Boolean OR: businesses having any token, with matched-token and document counts."""
+        parts = [self.term(t) for t in dict.fromkeys(tokens)]
+        if not parts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        codes, inverse = np.unique(np.concatenate([c for c, _ in parts]), return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate([n for _, n in parts]), minlength=len(codes))
+        terms = np.bincount(inverse, minlength=len(codes))
+        return codes, counts.astype(np.int64), terms
+
+    def relevant(self, query, limit=50):
+        """
+        Business ids for a query, most relevant first: businesses matching
+        every query term, or, if there are none, any of them. Ranked by
+        terms matched, then matching documents, then business id.
+        """
+        tokens = tokenize(query)
+        codes, counts, terms = self.match_all(tokens)
+        if not len(codes):
+            # Relaxed Boolean OR ("partial match") so tough queries still get labels
+            codes, counts, terms = self.match_any(tokens)
+        if len(codes) > limit:
+            # Only businesses scoring at least the limit-th best need sorting
+            score = terms * (int(counts.max()) + 1) + counts
+            keep = score >= np.partition(score, len(score) - limit)[len(score) - limit]
+            codes, counts, terms = codes[keep], counts[keep], terms[keep]
+        # Business codes follow business id order, so the last key breaks ties by id
+        order = np.lexsort((codes, -counts, -terms))[:limit]
+        return [str(b) for b in self.businesses[codes[order]]]
+
+
+def load_tables(data_dir):
+    tables = load_segments(data_dir)
+    if tables is None:
+        print("Index snapshot missing or stale; building BM25 indices from CSVs...")
+        tables = combine_segments({source: [(BASE_SEGMENT, docs, index)]
+                                   for source, (docs, index) in build_tables(read_sources(data_dir)).items()})
+    return tables
+
+
+def mine_queries(tables, n, seed=0, max_words=3):
+    """
+    n distinct 1-3 word queries cut from random documents (words of at
+    least three letters), in a fixed order for a given seed.
+    """
+    rng = np.random.default_rng(seed)
+    sources = [docs for docs, _ in tables.values() if not docs.empty]
+    queries = {}
+    for _ in range(n * 20):
+        if len(queries) >= n:
+            break
+        docs = sources[rng.integers(len(sources))]
+        s, row = docs.locate(int(rng.integers(len(docs))))
+        words = [w for w in tokenize(docs.tables[s].columns["original_text"][row]) if len(w) >= 3 and w.isalpha()]
+        if not words:
+            continue
+        size = int(rng.integers(1, max_words + 1))
+        start = int(rng.integers(max(len(words) - size, 0) + 1))
+        queries.setdefault(" ".join(words[start:start + size]), None)
+    return list(queries)
+
+
+def generate_ground_truth(data_dir=DATA_DIR, output=None, queries=None, mine=0, limit=50, seed=0):
     print("Generating 'Silver Standard' Ground Truth from Real Data...")
-    
-    # Load processed documents
-    try:
-        viol_df = pd.read_csv(f"{DATA_DIR}/violations_processed.csv").fillna("")
-        rev_df = pd.read_csv(f"{DATA_DIR}/reviews_processed.csv").fillna("")
-        all_docs = pd.concat([viol_df, rev_df], ignore_index=True)
-    except Exception as e:
-        print(f"Error loading data: {e}")
-        return
-
-    print(f"Scanning {len(all_docs)} documents for query matches...")
-    
+    start = time.perf_counter()
+    tables = load_tables(data_dir)
+    postings = BusinessPostings(tables)
+    print(f"Loaded postings for {sum(len(docs) for docs, _ in tables.values())} documents "
+          f"in {time.perf_counter() - start:.2f}s.")
+
+    queries = list(QUERIES if queries is None else queries)
+    if mine:
+        queries += mine_queries(tables, mine, seed)
+    queries = list(dict.fromkeys(queries))
+
+    start = time.perf_counter()
     ground_truth = []
-    
-    # Build a simple inverted index for faster lookup
-    # Word -> Set of business_ids
-    index = {}
-    for _, row in all_docs.iterrows():
-        bid = str(row["business_id"])
-        tokens = tokenize(row["text"])
-        for t in tokens:
-            if t not in index:
-                index[t] = set()
-            index[t].add(bid)
-            
-    for query in QUERIES:
-        q_tokens = tokenize(query)
-        relevant_bids = None
-        
-        # Boolean AND
-        for t in q_tokens:
-            if t in index:
-                if relevant_bids is None:
-                    relevant_bids = index[t].copy()
-                else:
-                    relevant_bids.intersection_update(index[t])
-            else:
-                # If a query term is missing from corpus, result is empty for AND
-                relevant_bids = set()
-                break
-        
-        # If empty, try Boolean OR (relaxed) for "Partial Match" relevance
-        # This prevents having 0 results for tough queries
-        if not relevant_bids:
-             relevant_bids = set()
-             for t in q_tokens:
-                 if t in index:
-                     relevant_bids.update(index[t])
-        
-        if relevant_bids:
-            ground_truth.append({
-                "query": query,
-                "relevant_business_ids": " ".join(list(relevant_bids)[:50]) # Limit to 50
-            })
-
-    gt_df = pd.DataFrame(ground_truth)
-    gt_df.to_csv(LABELS_FILE, index=False)
-    print(f"Generated labels for {len(gt_df)} queries. Saved to {LABELS_FILE}.")
+    for query in queries:
+        relevant = postings.relevant(query, limit)
+        if relevant:
+            ground_truth.append({"query": query, "relevant_business_ids": " ".join(relevant)})
+    print(f"Labeled {len(queries)} queries in {time.perf_counter() - start:.2f}s.")
+
+    output = output or os.path.join(data_dir, "labeled_queries.csv")
+    gt_df = pd.DataFrame(ground_truth, columns=["query", "relevant_business_ids"])
+    gt_df.to_csv(output, index=False)
+    print(f"Generated labels for {len(gt_df)} queries. Saved to {output}.")
+    return gt_df
+
 
 if __name__ == "__main__":
-    generate_ground_truth()
+    parser = argparse.ArgumentParser(description="Generate silver-standard relevance labels.")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--output", default=None, help="Defaults to <data-dir>/labeled_queries.csv")
+    parser.add_argument("--queries", default=None, help="File with one query per line (default: built-in list)")
+    parser.add_argument("--mine", type=int, default=0, help="Add this many queries mined from the documents")
+    parser.add_argument("--limit", type=int, default=50, help="Relevant businesses kept per query")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    queries = None
+    if args.queries:
+        with open(args.queries) as f:
+            queries = [line.strip() for line in f if line.strip()]
+    generate_ground_truth(args.data_dir, args.output, queries, args.mine, args.limit, args.seed)
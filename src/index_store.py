@@ -0,0 +1,620 @@
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+from lexical_index import LexicalIndex, select_top_k, tokenize
+from facets import FacetIndex, test_bits
+from tagger import mask_from_tags
+
+# Bump when the on-disk layout changes; older snapshots are treated as stale.
+FORMAT_VERSION = 8
+INDEX_DIRNAME = "index"
+
+SOURCES = {
+    "violation": "violations_processed.csv",
+    "review": "reviews_processed.csv",
+}
+META_COLUMNS = ["doc_id", "business_id", "business_name", "original_text", "tags", "boro", "zipcode", "street",
+                "inspection_date", "violation_code"]
+# Numeric metadata stored as plain arrays
+ARRAY_COLUMNS = {"tag_mask": np.uint32}
+# A violation record is identified by camis + inspection date + violation code
+KEY_COLUMNS = ["business_id", "inspection_date", "violation_code"]
+CONTENT_COLUMNS = ["business_name", "original_text", "boro", "zipcode", "street"]
+
+
+class StringColumn:
+    """Strings packed into one utf-8 byte blob plus an offsets array."""
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    @classmethod
+    def from_strings(cls, values):
+        encoded = [str(v).encode("utf-8") for v in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return cls(offsets, data)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+    def save(self, prefix):
+        np.save(f"{prefix}.offsets.npy", self.offsets)
+        np.save(f"{prefix}.data.npy", self.data)
+
+    @classmethod
+    def load(cls, prefix, mmap=True):
+        mode = "r" if mmap else None
+        return cls(np.load(f"{prefix}.offsets.npy", mmap_mode=mode),
+                   np.load(f"{prefix}.data.npy", mmap_mode=mode))
+
+
+def _code_dtype(n):
+    return np.uint8 if n <= 1 << 8 else np.uint16 if n <= 1 << 16 else np.int32
+
+
+class InternedColumn:
+    """Low-cardinality strings as small integer codes into a value table."""
+
+    def __init__(self, codes, values):
+        self.codes = codes
+        self.values = values
+
+    @classmethod
+    def from_strings(cls, values):
+        codes, uniques = pd.factorize(pd.Series(values, dtype=object).astype(str), sort=True)
+        return cls(codes.astype(_code_dtype(len(uniques))), list(uniques))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        return self.values[self.codes[i]]
+
+    def save(self, prefix):
+        np.save(f"{prefix}.codes.npy", self.codes)
+        with open(f"{prefix}.values.json", "w") as f:
+            json.dump(self.values, f)
+
+    @classmethod
+    def load(cls, prefix, mmap=True):
+        with open(f"{prefix}.values.json") as f:
+            values = json.load(f)
+        return cls(np.load(f"{prefix}.codes.npy", mmap_mode="r" if mmap else None), values)
+
+
+class Hit(dict):
+    """
+    A search hit. doc_id and text are decoded from the document store on
+    first access, so only hits that are actually displayed pay for it.
+    """
+
+    LAZY = {"doc_id": "doc_id", "text": "original_text"}
+
+    def __init__(self, docs, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._docs = docs
+        # Row within `docs`; "row" itself may be renumbered by a segmented view
+        self._row = self["row"]
+
+    def __missing__(self, key):
+        column = self.LAZY.get(key)
+        if column is None:
+            raise KeyError(key)
+        value = self._docs.columns[column][self._row]
+        self[key] = value
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def materialize(self):
+        for key in self.LAZY:
+            self[key]
+        return self
+
+
+class DocTable:
+    """
+    Columnar document metadata (one entry per indexed document).
+
+    doc_id and original_text are offset+blob StringColumns, memory-mapped and
+    decoded lazily; low-cardinality strings are interned; business ids are
+    codes into a business table shared by all sources; tag masks are a plain
+    uint32 array.
+    """
+
+    STRING_COLUMNS = ["doc_id", "original_text"]
+    INTERNED_COLUMNS = ["business_name", "tags", "boro", "zipcode", "street", "inspection_date", "violation_code"]
+
+    def __init__(self, columns, business_code, businesses):
+        self.columns = columns
+        self.business_code = business_code
+        self.businesses = businesses
+
+    @classmethod
+    def from_frame(cls, df, businesses):
+        columns = {c: StringColumn.from_strings(df[c]) for c in cls.STRING_COLUMNS}
+        for c in cls.INTERNED_COLUMNS:
+            columns[c] = InternedColumn.from_strings(df[c])
+        for c, dtype in ARRAY_COLUMNS.items():
+            columns[c] = df[c].to_numpy(dtype=dtype)
+        business_code = np.searchsorted(businesses, df["business_id"].astype(str).to_numpy()).astype(np.int32)
+        return cls(columns, business_code, businesses)
+
+    def __len__(self):
+        return len(self.business_code)
+
+    @property
+    def empty(self):
+        return len(self) == 0
+
+    def business_id(self, i):
+        return str(self.businesses[self.business_code[i]])
+
+    def row(self, i):
+        row = {c: col[i] for c, col in self.columns.items()}
+        row["business_id"] = self.business_id(i)
+        return row
+
+    def hit(self, i, score, source):
+        return Hit(self, {
+            "row": i,
+            "business_id": self.business_id(i),
+            "business_code": int(self.business_code[i]),
+            "business_name": self.columns["business_name"][i],
+            "score": score,
+            "source": source,
+            "tags": self.columns["tags"][i],
+            "tag_mask": int(self.columns["tag_mask"][i]),
+            "boro": self.columns["boro"][i],
+            "zipcode": self.columns["zipcode"][i],
+        })
+
+    def save(self, path):
+        for c in self.STRING_COLUMNS + self.INTERNED_COLUMNS:
+            self.columns[c].save(os.path.join(path, c))
+        for c in ARRAY_COLUMNS:
+            np.save(os.path.join(path, f"{c}.npy"), self.columns[c])
+        np.save(os.path.join(path, "business_code.npy"), self.business_code)
+
+    @classmethod
+    def load(cls, path, businesses, mmap=True):
+        mode = "r" if mmap else None
+        columns = {c: StringColumn.load(os.path.join(path, c), mmap) for c in cls.STRING_COLUMNS}
+        for c in cls.INTERNED_COLUMNS:
+            columns[c] = InternedColumn.load(os.path.join(path, c), mmap)
+        for c in ARRAY_COLUMNS:
+            columns[c] = np.load(os.path.join(path, f"{c}.npy"), mmap_mode=mode)
+        return cls(columns, np.load(os.path.join(path, "business_code.npy"), mmap_mode=mode), businesses)
+
+
+def business_table(frames):
+    """Sorted distinct business ids across all sources."""
+    ids = [df["business_id"].astype(str).to_numpy() for df in frames]
+    return np.unique(np.concatenate(ids)) if ids else np.zeros(0, dtype=str)
+
+
+def build_tables(frames):
+    """{source: DataFrame} -> {source: (DocTable, SourceIndex)}"""
+    businesses = business_table(frames.values())
+    return {source: (DocTable.from_frame(df, businesses), SourceIndex.build(df)) for source, df in frames.items()}
+
+
+def record_keys(df):
+    """
+    64-bit hashes of each document's record key. Documents without an
+    inspection date (reviews, files normalized before dates were kept) are
+    keyed by doc_id instead.
+    """
+    parts = [df[c].astype(str) for c in KEY_COLUMNS]
+    keys = parts[0].str.cat(parts[1:], sep="|")
+    keys = keys.where(parts[1] != "", df["doc_id"].astype(str))
+    return pd.util.hash_pandas_object(keys, index=False).to_numpy()
+
+
+def content_hashes(df):
+    """64-bit hash of the fields that make up a document, to spot changed records."""
+    return pd.util.hash_pandas_object(df[CONTENT_COLUMNS].astype(str), index=False).to_numpy()
+
+
+class RecordKeys:
+    """
+    Record-key hashes of a source sorted for binary search, so incoming
+    records can be matched against the index without loading it all.
+    """
+
+    def __init__(self, sorted_keys, rows, hashes):
+        self.sorted_keys = sorted_keys
+        self.rows = rows
+        self.hashes = hashes
+
+    @classmethod
+    def from_frame(cls, df):
+        keys = record_keys(df)
+        order = np.argsort(keys, kind="stable")
+        return cls(keys[order], order.astype(np.int64), content_hashes(df))
+
+    def lookup(self, keys):
+        """Rows holding each key, or -1 where the key is not present."""
+        keys = np.asarray(keys, dtype=np.uint64)
+        if len(self.sorted_keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.sorted_keys, keys), len(self.sorted_keys) - 1)
+        found = np.asarray(self.sorted_keys[pos]) == keys
+        return np.where(found, self.rows[pos], -1)
+
+    def save(self, path):
+        np.save(os.path.join(path, "record_keys.npy"), self.sorted_keys)
+        np.save(os.path.join(path, "record_rows.npy"), self.rows)
+        np.save(os.path.join(path, "record_hashes.npy"), self.hashes)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        mode = "r" if mmap else None
+        return cls(*[np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mode)
+                     for name in ("record_keys", "record_rows", "record_hashes")])
+
+
+class TextGroups:
+    """
+    Maps documents to their distinct normalized text. NYC violation
+    descriptions come from a few hundred codes, so most documents share a
+    text with many others; the index and embeddings are built per text and
+    results fan back out to documents here.
+    """
+
+    def __init__(self, text_of_row, offsets, rows):
+        self.text_of_row = text_of_row
+        self.offsets = offsets
+        self.rows = rows
+
+    @classmethod
+    def from_texts(cls, texts):
+        text_of_row, uniques = pd.factorize(pd.Series(texts, dtype=object), sort=False)
+        text_of_row = text_of_row.astype(np.int32)
+        counts = np.bincount(text_of_row, minlength=len(uniques))
+        offsets = np.zeros(len(uniques) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        rows = np.argsort(text_of_row, kind="stable").astype(np.int32)
+        return cls(text_of_row, offsets, rows), list(uniques)
+
+    @property
+    def counts(self):
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def first_rows(self):
+        return self.rows[self.offsets[:-1]]
+
+    def gather(self, text_ids):
+        """Document rows of the given texts, concatenated."""
+        starts = self.offsets[text_ids]
+        lens = self.offsets[np.asarray(text_ids) + 1] - starts
+        if lens.sum() == 0:
+            return np.zeros(0, dtype=np.int64)
+        shift = np.repeat(starts - np.concatenate([[0], np.cumsum(lens)[:-1]]), lens)
+        return self.rows[shift + np.arange(lens.sum())].astype(np.int64)
+
+    def expand_top_k(self, text_ids, scores, k, row_filter=None):
+        """
+        Top k documents given per-text scores. Every document of a text gets
+        the text's score; ties break by document row as in select_top_k.
+        row_filter is an optional packed bitmap of allowed document rows.
+        """
+        if len(text_ids) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        counts = self.counts[text_ids]
+        order = np.argsort(-scores, kind="stable")
+        if row_filter is not None:
+            return self._expand_filtered(text_ids, scores, order, k, row_filter)
+        covered = np.cumsum(counts[order])
+        cut = np.searchsorted(covered, k)
+        if cut < len(order):
+            # Keep every text scoring at least the k-th document's score
+            keep = scores >= scores[order[cut]]
+            text_ids, scores, counts = text_ids[keep], scores[keep], counts[keep]
+        rows = self.gather(text_ids)
+        return select_top_k(rows, np.repeat(scores, counts), k)
+
+    def _gather_filtered(self, text_ids, scores, row_filter):
+        rows = self.gather(text_ids)
+        row_scores = np.repeat(scores, self.counts[text_ids])
+        allowed = test_bits(row_filter, rows)
+        return rows[allowed], row_scores[allowed]
+
+    def _expand_filtered(self, text_ids, scores, order, k, row_filter):
+        # Walk texts best-first, doubling the prefix until k allowed documents
+        # are found, then pull in any later texts tied with the k-th score.
+        n = min(len(order), max(k, 1))
+        while True:
+            rows, row_scores = self._gather_filtered(text_ids[order[:n]], scores[order[:n]], row_filter)
+            if len(rows) >= k or n == len(order):
+                break
+            n = min(2 * n, len(order))
+        if len(rows) >= k > 0 and n < len(order):
+            threshold = np.partition(row_scores, len(row_scores) - k)[len(row_scores) - k]
+            tied = order[n:][scores[order[n:]] >= threshold]
+            if len(tied):
+                more_rows, more_scores = self._gather_filtered(text_ids[tied], scores[tied], row_filter)
+                rows = np.concatenate([rows, more_rows])
+                row_scores = np.concatenate([row_scores, more_scores])
+        return select_top_k(rows, row_scores, k)
+
+    def save(self, path):
+        np.save(os.path.join(path, "text_of_row.npy"), self.text_of_row)
+        np.save(os.path.join(path, "group_offsets.npy"), self.offsets)
+        np.save(os.path.join(path, "group_rows.npy"), self.rows)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        mode = "r" if mmap else None
+        return cls(*[np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mode)
+                     for name in ("text_of_row", "group_offsets", "group_rows")])
+
+
+class SourceIndex:
+    """
+    BM25 over a source's distinct texts, returning document rows. Facet
+    filters are applied to the postings before scoring, as are tombstones
+    for rows superseded by a newer index segment.
+    """
+
+    def __init__(self, lexical, groups, facets):
+        self.lexical = lexical
+        self.groups = groups
+        self.facets = facets
+        self.live_rows = self.live_texts = None
+        self.live_counts = groups.counts
+
+    def set_deleted(self, rows):
+        """Tombstones document rows: they no longer match or count towards statistics."""
+        rows = np.asarray(rows, dtype=np.int64)
+        self.live_counts = self.groups.counts
+        self.live_rows = self.live_texts = None
+        if len(rows) == 0:
+            return
+        live = np.ones(len(self.groups.text_of_row), dtype=bool)
+        live[rows] = False
+        self.live_rows = np.packbits(live, bitorder="little")
+        self.live_counts = self.live_counts - np.bincount(self.groups.text_of_row[rows], minlength=len(self.groups))
+        self.live_texts = np.packbits(self.live_counts > 0, bitorder="little")
+
+    def filter_bitmaps(self, filters=None):
+        """(row_filter, text_filter) for the facet filters and tombstones; None where unrestricted."""
+        row_filter, text_filter = self.facets.bitmaps(filters or {})
+        if self.live_rows is not None:
+            row_filter = self.live_rows if row_filter is None else row_filter & self.live_rows
+            text_filter = self.live_texts if text_filter is None else text_filter & self.live_texts
+        return row_filter, text_filter
+
+    def allowed(self, rows, filters=None):
+        """Whether each document row passes the filters."""
+        row_filter, _ = self.filter_bitmaps(filters)
+        if row_filter is None:
+            return np.ones(len(rows), dtype=bool)
+        return test_bits(row_filter, rows)
+
+    def expand_texts(self, text_ids, scores, k, filters=None):
+        """Top k document rows for per-text scores (e.g. from the dense index)."""
+        row_filter, _ = self.filter_bitmaps(filters)
+        return self.groups.expand_top_k(text_ids, scores, k, row_filter)
+
+    def top_k(self, query_tokens, k, filters=None):
+        row_filter, text_filter = self.filter_bitmaps(filters)
+        text_ids, scores = self.lexical.match(query_tokens, text_filter)
+        positive = scores > 0
+        return self.groups.expand_top_k(text_ids[positive], scores[positive], k, row_filter)
+
+    def top_k_batch(self, queries_tokens, k, filters=None):
+        row_filter, text_filter = self.filter_bitmaps(filters)
+        qids, text_ids, scores = self.lexical.match_batch(queries_tokens, text_filter)
+        positive = scores > 0
+        qids, text_ids, scores = qids[positive], text_ids[positive], scores[positive]
+        bounds = np.searchsorted(qids, np.arange(len(queries_tokens) + 1))
+        return [self.groups.expand_top_k(text_ids[bounds[i]:bounds[i + 1]], scores[bounds[i]:bounds[i + 1]],
+                                         k, row_filter)
+                for i in range(len(queries_tokens))]
+
+    @classmethod
+    def build(cls, df):
+        groups, distinct = TextGroups.from_texts(df["text"])
+        lexical = LexicalIndex.from_tokens([tokenize(t) for t in distinct], doc_counts=groups.counts)
+        return cls(lexical, groups, FacetIndex.build(df, groups))
+
+    def save(self, path):
+        self.lexical.save(path)
+        self.groups.save(path)
+        self.facets.save(path)
+
+    @classmethod
+    def load(cls, path):
+        return cls(LexicalIndex.load(path), TextGroups.load(path), FacetIndex.load(path))
+
+
+def empty_frame():
+    df = pd.DataFrame(columns=META_COLUMNS + ["text"], dtype=str)
+    df["tag_mask"] = np.zeros(0, dtype=np.uint32)
+    return df
+
+
+def read_processed(path):
+    df = pd.read_csv(path, dtype=str, keep_default_na=False)
+    for c in META_COLUMNS + ["text"]:
+        if c not in df.columns:
+            df[c] = ""
+    if "tag_mask" in df.columns:
+        df["tag_mask"] = pd.to_numeric(df["tag_mask"], errors="coerce").fillna(0).astype(np.uint32)
+    else:
+        # Processed files written before tag masks existed
+        df["tag_mask"] = df["tags"].map(mask_from_tags).astype(np.uint32)
+    return df
+
+
+def read_sources(data_dir, paths=None):
+    """{source: DataFrame} for the processed CSVs that exist (or `paths`, {source: csv} overrides)."""
+    frames = {}
+    for source, filename in SOURCES.items():
+        path = (paths or {}).get(source) or os.path.join(data_dir, filename)
+        if os.path.exists(path):
+            frames[source] = read_processed(path)
+    return frames
+
+
+def source_fingerprint(path):
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def write_source(path, docs, index, df):
+    """Writes one source's documents, index and record keys to `path`."""
+    os.makedirs(path, exist_ok=True)
+    index.save(path)
+    docs.save(path)
+    RecordKeys.from_frame(df).save(path)
+
+
+def build_snapshot(data_dir):
+    manifest, _ = write_snapshot(data_dir)
+    return publish_snapshot(data_dir, manifest)
+
+
+def write_snapshot(data_dir, paths=None):
+    """
+    Indexes the processed CSVs into a new snapshot directory without
+    publishing it. Returns its manifest and {source: (docs, index)}.
+    `paths` ({source: csv}) indexes other files in place of the processed
+    CSVs, fingerprinted as they are: the snapshot is current once each is
+    renamed over its CSV.
+    """
+    # Every snapshot gets its own directory and the manifest is switched over
+    # to it at the end; files of older snapshots may still be memory-mapped by
+    # a running server, so they are unlinked, never overwritten.
+    index_dir = os.path.join(data_dir, INDEX_DIRNAME)
+    os.makedirs(index_dir, exist_ok=True)
+    name = f"snap-{time.time_ns()}"
+    snapshot_dir = os.path.join(index_dir, name)
+    manifest = {"format_version": FORMAT_VERSION, "created": time.time(), "path": name, "sources": {}}
+
+    paths = paths or {}
+    frames = read_sources(data_dir, paths)
+    print(f"Indexing {', '.join(SOURCES[s] for s in frames)}...")
+    tables = build_tables(frames)
+    for source, (docs, index) in tables.items():
+        write_source(os.path.join(snapshot_dir, source), docs, index, frames[source])
+        manifest["sources"][source] = {
+            "csv": SOURCES[source],
+            "num_docs": len(docs),
+            "num_texts": len(index.groups),
+            **source_fingerprint(paths.get(source) or os.path.join(data_dir, SOURCES[source])),
+        }
+    os.makedirs(snapshot_dir, exist_ok=True)
+    save_businesses(snapshot_dir, business_table(frames.values()))
+    # Imported here: profiles builds on this module
+    from profiles import PROFILES_DIRNAME, build_profiles
+    build_profiles(frames).save(os.path.join(snapshot_dir, PROFILES_DIRNAME))
+    return manifest, tables
+
+
+def publish_snapshot(data_dir, manifest, prune=True):
+    """
+    Switches the manifest over to a snapshot from write_snapshot and, unless
+    `prune` is False, removes the older ones (see prune_snapshots).
+    """
+    index_dir = os.path.join(data_dir, INDEX_DIRNAME)
+    # Write the manifest last so a half-written snapshot is never picked up
+    tmp = os.path.join(index_dir, "manifest.json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, os.path.join(index_dir, "manifest.json"))
+    if prune:
+        prune_snapshots(data_dir, manifest)
+    print(f"Index snapshot written to {snapshot_path(data_dir, manifest)}.")
+    return manifest
+
+
+def prune_snapshots(data_dir, manifest):
+    """Removes every snapshot but the published `manifest`'s."""
+    index_dir = os.path.join(data_dir, INDEX_DIRNAME)
+    for entry in os.listdir(index_dir):
+        # Older snapshots, and the pre-versioned layout
+        if (entry.startswith("snap-") and entry != manifest["path"]) or entry in SOURCES:
+            shutil.rmtree(os.path.join(index_dir, entry), ignore_errors=True)
+
+
+def snapshot_path(data_dir, manifest):
+    return os.path.join(data_dir, INDEX_DIRNAME, manifest["path"])
+
+
+def read_manifest(data_dir):
+    path = os.path.join(data_dir, INDEX_DIRNAME, "manifest.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def is_stale(data_dir, manifest):
+    if manifest is None or manifest.get("format_version") != FORMAT_VERSION:
+        return True
+    for source, filename in SOURCES.items():
+        path = os.path.join(data_dir, filename)
+        entry = manifest["sources"].get(source)
+        if not os.path.exists(path):
+            if entry is not None:
+                return True
+            continue
+        if entry is None:
+            return True
+        fp = source_fingerprint(path)
+        if fp["size"] != entry["size"] or fp["mtime_ns"] != entry["mtime_ns"]:
+            return True
+    return False
+
+
+def save_businesses(path, businesses):
+    with open(os.path.join(path, "businesses.json"), "w") as f:
+        json.dump(businesses.tolist(), f)
+
+
+def load_businesses(path):
+    with open(os.path.join(path, "businesses.json")) as f:
+        return np.array(json.load(f), dtype=str)
+
+
+def load_snapshot(data_dir, manifest=None):
+    """
+    Returns {source: (DocTable, SourceIndex)} memory-mapped from the
+    snapshot, or None if there is no snapshot or it is out of date.
+    """
+    if manifest is None:
+        manifest = read_manifest(data_dir)
+    if is_stale(data_dir, manifest):
+        return None
+    snapshot_dir = snapshot_path(data_dir, manifest)
+    businesses = load_businesses(snapshot_dir)
+    loaded = {}
+    for source in manifest["sources"]:
+        source_dir = os.path.join(snapshot_dir, source)
+        loaded[source] = (DocTable.load(source_dir, businesses), SourceIndex.load(source_dir))
+    return loaded
+
+
+if __name__ == "__main__":
+    import sys
+    build_snapshot(sys.argv[1] if len(sys.argv) > 1 else "saferbites/data")
@@ -0,0 +1,237 @@
+import argparse
+import fcntl
+import os
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from embeddings import embed_snapshot, load_embeddings, text_vectors
+from index_store import (INDEX_DIRNAME, SOURCES, DocTable, RecordKeys, SourceIndex, business_table, content_hashes,
+                         is_stale, load_businesses, load_snapshot, prune_snapshots, publish_snapshot, read_manifest,
+                         read_processed, record_keys, save_businesses, snapshot_path, source_fingerprint,
+                         write_snapshot, write_source)
+from normalize import DATA_DIR, DOC_COLUMNS, INSPECTION_COLUMNS, RECORD_COLUMNS, inspection_documents
+from profiles import update_profiles
+from segments import BASE_SEGMENT, read_segment_state, segment_dir, write_segment_state
+
+
+@contextmanager
+def index_lock(data_dir):
+    """Serializes writers (ingestion, compaction) of a data directory's index."""
+    index_dir = os.path.join(data_dir, INDEX_DIRNAME)
+    os.makedirs(index_dir, exist_ok=True)
+    with open(os.path.join(index_dir, ".lock"), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def finish_compaction(data_dir, manifest):
+    """
+    Completes a compaction that published its snapshot but stopped before
+    renaming the merged CSV into place, or drops the merged CSV of one that
+    stopped before publishing. Call with index_lock held.
+    """
+    csv_path = os.path.join(data_dir, SOURCES["violation"])
+    tmp = csv_path + ".tmp"
+    if not os.path.exists(tmp):
+        return
+    entry = manifest["sources"].get("violation") if manifest else None
+    if entry is not None and source_fingerprint(tmp) == {"size": entry["size"], "mtime_ns": entry["mtime_ns"]}:
+        print("Finishing an interrupted compaction...")
+        os.replace(tmp, csv_path)
+        prune_snapshots(data_dir, manifest)
+    else:
+        os.remove(tmp)
+
+
+def read_feed(path):
+    """Violation documents of a raw inspections extract, one per record key (last wins)."""
+    header = pd.read_csv(path, nrows=0).columns
+    missing = [c for c in ["camis", "violation_description"] + RECORD_COLUMNS if c not in header]
+    if missing:
+        raise ValueError(f"{path} is missing columns: {', '.join(missing)}")
+    raw = pd.read_csv(path, usecols=[c for c in INSPECTION_COLUMNS if c in header], dtype=str)
+    # Same empty-field convention as the processed CSVs the base was built from
+    docs = inspection_documents(raw).fillna("")
+    keys = record_keys(docs)
+    _, last = np.unique(keys[::-1], return_index=True)
+    keep = np.sort(len(keys) - 1 - last)
+    return docs.iloc[keep].reset_index(drop=True), keys[keep]
+
+
+def match_records(snapshot_dir, state, keys, hashes):
+    """
+    Looks incoming records up in the live segments, newest first. Returns
+    (found, changed, superseded): whether each record is already indexed,
+    whether its indexed version differs, and {segment: rows} of the versions
+    a changed record replaces.
+    """
+    deleted = state["deleted"].get("violation", {})
+    found = np.zeros(len(keys), dtype=bool)
+    changed = np.zeros(len(keys), dtype=bool)
+    superseded = {}
+    for name in reversed([BASE_SEGMENT] + state["segments"]):
+        path = os.path.join(segment_dir(snapshot_dir, name), "violation")
+        if not os.path.isdir(path):
+            continue
+        records = RecordKeys.load(path)
+        rows = records.lookup(keys)
+        hit = (rows >= 0) & ~found
+        if deleted.get(name):
+            hit &= ~np.isin(rows, deleted[name])
+        if not hit.any():
+            continue
+        found |= hit
+        differs = hit & (np.asarray(records.hashes[np.maximum(rows, 0)]) != hashes)
+        changed |= differs
+        superseded[name] = rows[differs]
+    return found, changed, superseded
+
+
+def write_delta(path, docs):
+    """A delta segment: the processed documents (kept for compaction) and their index."""
+    os.makedirs(path)
+    docs.to_csv(os.path.join(path, "docs.csv"), index=False)
+    businesses = business_table([docs])
+    write_source(os.path.join(path, "violation"), DocTable.from_frame(docs, businesses), SourceIndex.build(docs), docs)
+    save_businesses(path, businesses)
+
+
+def superseded_docs(snapshot_dir, superseded):
+    """The indexed documents that changed records replace ({segment: rows}), as one frame."""
+    rows = []
+    for name, segment_rows in superseded.items():
+        path = segment_dir(snapshot_dir, name)
+        docs = DocTable.load(os.path.join(path, "violation"), load_businesses(path))
+        rows += [docs.row(i) for i in segment_rows]
+    return pd.DataFrame(rows)
+
+
+def ingest(raw_path, data_dir=DATA_DIR):
+    """
+    Adds the new and changed violation records of an inspections extract
+    (e.g. a daily feed) as a delta segment on top of the current snapshot.
+    Records are keyed by camis + inspection date + violation code: unchanged
+    ones are skipped and changed ones tombstone the version indexed before.
+    Only the extract is normalized and indexed, so the cost follows its size.
+    Returns the new segment's name, or None if there was nothing to add.
+    """
+    start = time.perf_counter()
+    docs, keys = read_feed(raw_path)
+    hashes = content_hashes(docs)
+
+    with index_lock(data_dir):
+        manifest = read_manifest(data_dir)
+        finish_compaction(data_dir, manifest)
+        if is_stale(data_dir, manifest):
+            print("Index snapshot missing or stale. Run index_store.py first.")
+            return None
+        snapshot_dir = snapshot_path(data_dir, manifest)
+        state = read_segment_state(snapshot_dir)
+        found, changed, superseded = match_records(snapshot_dir, state, keys, hashes)
+        take = ~found | changed
+        if not take.any():
+            print(f"No new or changed records in {raw_path}.")
+            return None
+
+        state["generation"] += 1
+        name = f"delta-{state['generation']:06d}"
+        delta = docs[take].reset_index(drop=True)
+        delta["doc_id"] = f"insp_{name}_" + delta.index.astype(str)
+        write_delta(segment_dir(snapshot_dir, name), delta[DOC_COLUMNS])
+        # Business profiles: the delta's documents in, the replaced versions out
+        update_profiles(snapshot_dir, state, name, {"violation": delta},
+                        {"violation": superseded_docs(snapshot_dir, superseded)})
+
+        deleted = state["deleted"].setdefault("violation", {})
+        for segment, rows in superseded.items():
+            deleted[segment] = sorted(set(deleted.get(segment, [])) | set(rows.tolist()))
+        state["segments"].append(name)
+        # Publishing the new segment list makes the delta visible to servers
+        write_segment_state(snapshot_dir, state)
+
+    print(f"Ingested {int((~found).sum())} new and {int(changed.sum())} changed records "
+          f"as {name} in {time.perf_counter() - start:.2f}s.")
+    return name
+
+
+def _live(df, deleted_rows):
+    if not deleted_rows:
+        return df
+    return df.drop(index=df.index[deleted_rows])
+
+
+def compact(data_dir=DATA_DIR, max_segments=None, model=None):
+    """
+    Merges the delta segments into the base: the processed violations CSV is
+    rewritten without tombstoned rows and with every delta's documents
+    appended, and a fresh snapshot is built from it. If the old snapshot had
+    embeddings, the new one gets them before it is published (only texts
+    without a vector yet are encoded, with `model` or the default one), so
+    servers never load it without its dense stage. Servers keep searching
+    the old snapshot until they refresh. With max_segments, it only compacts
+    once more delta segments than that have piled up. The merged CSV replaces
+    the old one only once the snapshot is published; the next ingest or
+    compaction finishes a run that died in between.
+    """
+    with index_lock(data_dir):
+        manifest = read_manifest(data_dir)
+        finish_compaction(data_dir, manifest)
+        if is_stale(data_dir, manifest):
+            print("Index snapshot missing or stale. Run index_store.py first.")
+            return None
+        snapshot_dir = snapshot_path(data_dir, manifest)
+        state = read_segment_state(snapshot_dir)
+        deleted = state["deleted"].get("violation", {})
+        if not state["segments"] and not any(deleted.values()):
+            print("Nothing to compact.")
+            return manifest
+        if max_segments is not None and len(state["segments"]) <= max_segments:
+            print(f"{len(state['segments'])} delta segments; compacting above {max_segments}.")
+            return manifest
+
+        stores = load_embeddings(data_dir, manifest)
+        # Vectors of the texts embedded so far, read before the CSV changes
+        reuse = text_vectors(load_snapshot(data_dir, manifest), stores) if stores else None
+
+        print(f"Compacting {len(state['segments'])} delta segments...")
+        csv_path = os.path.join(data_dir, SOURCES["violation"])
+        frames = [_live(read_processed(csv_path), deleted.get(BASE_SEGMENT))]
+        for name in state["segments"]:
+            docs = read_processed(os.path.join(segment_dir(snapshot_dir, name), "docs.csv"))
+            frames.append(_live(docs, deleted.get(name)))
+        merged = pd.concat(frames, ignore_index=True)
+        # The snapshot is built from the merged CSV before it replaces the
+        # old one; the rename is the last step, right after publishing, so
+        # the CSV never runs ahead of the published snapshot and its segments
+        tmp = csv_path + ".tmp"
+        merged.to_csv(tmp, index=False)
+        new_manifest, tables = write_snapshot(data_dir, {"violation": tmp})
+        if stores:
+            embed_snapshot(snapshot_path(data_dir, new_manifest), new_manifest,
+                           {source: tables[source] for source in stores if source in tables}, model, reuse)
+        publish_snapshot(data_dir, new_manifest, prune=False)
+        os.replace(tmp, csv_path)
+        # The old snapshot and its segments
+        prune_snapshots(data_dir, new_manifest)
+        return new_manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Incrementally index new inspection records.")
+    parser.add_argument("feed", nargs="?", help="Raw inspections CSV (e.g. today's extract)")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--compact", action="store_true", help="Merge delta segments into a new base snapshot")
+    parser.add_argument("--max-segments", type=int,
+                        help="With --compact, only compact once more delta segments than this have piled up")
+    args = parser.parse_args()
+
+    if args.feed:
+        ingest(args.feed, args.data_dir)
+    if args.compact:
+        compact(args.data_dir, args.max_segments)
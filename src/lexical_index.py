@@ -0,0 +1,249 @@
+import json
+import math
+import os
+import re
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+# Same defaults as rank_bm25.BM25Okapi
+K1 = 1.5
+B = 0.75
+EPSILON = 0.25
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(str(text).lower())
+
+
+class LexicalIndex:
+    """
+    Term -> postings index with BM25Okapi scoring.
+
+    Postings are stored CSR-style: the documents containing term `t` are
+    doc_ids[offsets[t]:offsets[t + 1]] with matching term frequencies in tfs.
+    `weights` holds the BM25 term-frequency component for every posting, so a
+    query only touches the postings of its own terms.
+
+    An indexed document may stand for several identical corpus documents:
+    `doc_counts` gives its multiplicity, and corpus statistics (N, document
+    frequencies, average length) are computed over the full corpus, so scores
+    are the same as if every copy had been indexed.
+    """
+
+    def __init__(self, vocab, offsets, doc_ids, tfs, doc_len, idf, weights=None, k1=K1, b=B, doc_counts=None):
+        self.vocab = vocab
+        self.term_index = {t: i for i, t in enumerate(vocab)}
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_len = doc_len
+        self.idf = idf
+        self.num_docs = len(doc_len)
+        self.doc_counts = doc_counts if doc_counts is not None else np.ones(self.num_docs, dtype=np.int64)
+        self.corpus_size = int(self.doc_counts.sum())
+        total_len = int(np.dot(doc_len.astype(np.int64), self.doc_counts))
+        self.avgdl = float(total_len) / self.corpus_size if self.corpus_size else 0.0
+        self.k1 = k1
+        self.b = b
+        self.weights = weights if weights is not None else self._term_weights()
+
+    @classmethod
+    def from_tokens(cls, corpus, doc_counts=None):
+        # Term ids are assigned in first-seen order so the IDF averaging below
+        # sums in the same order as BM25Okapi does.
+        term_index = {}
+        term_ids = []
+        doc_len = np.zeros(len(corpus), dtype=np.int32)
+        for d, tokens in enumerate(corpus):
+            doc_len[d] = len(tokens)
+            for t in tokens:
+                tid = term_index.get(t)
+                if tid is None:
+                    tid = term_index[t] = len(term_index)
+                term_ids.append(tid)
+
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        docs = np.repeat(np.arange(len(corpus), dtype=np.int64), doc_len)
+        n_docs = max(len(corpus), 1)
+        pairs, tfs = np.unique(term_ids * n_docs + docs, return_counts=True)
+        post_terms = pairs // n_docs
+        doc_ids = (pairs % n_docs).astype(np.int32)
+
+        if doc_counts is None:
+            doc_counts = np.ones(len(corpus), dtype=np.int64)
+        doc_counts = np.asarray(doc_counts, dtype=np.int64)
+        df = np.bincount(post_terms, minlength=len(term_index))
+        corpus_df = np.bincount(post_terms, weights=doc_counts[doc_ids], minlength=len(term_index)).astype(np.int64)
+        offsets = np.zeros(len(term_index) + 1, dtype=np.int64)
+        np.cumsum(df, out=offsets[1:])
+
+        vocab = list(term_index)
+        idf = cls._calc_idf(corpus_df, int(doc_counts.sum()))
+        return cls(vocab, offsets, doc_ids, tfs.astype(np.int32), doc_len, idf, doc_counts=doc_counts)
+
+    @staticmethod
+    def _calc_idf(df, corpus_size):
+        # Mirrors BM25Okapi._calc_idf, including the epsilon floor for
+        # terms that appear in more than half of the documents.
+        idf = np.array([math.log(corpus_size - f + 0.5) - math.log(f + 0.5) for f in df.tolist()])
+        if len(idf):
+            average_idf = np.cumsum(idf)[-1] / len(idf)
+            idf[idf < 0] = EPSILON * average_idf
+        return idf
+
+    def corpus_df(self, doc_counts=None):
+        """Corpus document frequency of every term, counting each document doc_counts times."""
+        counts = self.doc_counts if doc_counts is None else doc_counts
+        post_terms = np.repeat(np.arange(len(self.vocab)), np.diff(self.offsets))
+        return np.bincount(post_terms, weights=np.asarray(counts)[self.doc_ids], minlength=len(self.vocab))
+
+    def set_corpus_stats(self, idf, avgdl):
+        """
+        Scores against statistics of a larger corpus this index is part of
+        (e.g. a base snapshot plus delta segments): idf per term of this
+        index's vocabulary and the corpus-wide average document length.
+        """
+        self.idf = np.asarray(idf, dtype=np.float64)
+        self.avgdl = avgdl
+        self.weights = self._term_weights()
+
+    def set_params(self, k1, b):
+        """Switches to other BM25 k1/b, recomputing the term weights."""
+        self.k1, self.b = k1, b
+        self.weights = self._term_weights()
+
+    def _term_weights(self):
+        tf = self.tfs.astype(np.float64)
+        dl = self.doc_len[self.doc_ids]
+        return tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * dl / self.avgdl))
+
+    def _postings(self, query_tokens, doc_filter=None):
+        # Yields (doc_ids, contributions) per query term, in query order.
+        # doc_filter is a packed bitmap of documents allowed to score.
+        for q in query_tokens:
+            tid = self.term_index.get(q)
+            if tid is None:
+                continue
+            start, end = self.offsets[tid], self.offsets[tid + 1]
+            docs, weights = self.doc_ids[start:end], self.weights[start:end]
+            if doc_filter is not None:
+                allowed = ((doc_filter[docs >> 3] >> (docs & 7)) & 1).astype(bool)
+                docs, weights = docs[allowed], weights[allowed]
+            yield docs, self.idf[tid] * weights
+
+    def get_scores(self, query_tokens):
+        scores = np.zeros(self.num_docs)
+        for docs, contrib in self._postings(query_tokens):
+            scores[docs] += contrib
+        return scores
+
+    def match(self, query_tokens, doc_filter=None):
+        """
+        Sparse scoring: returns (doc_ids, scores) for documents containing at
+        least one query term. Cost is proportional to the posting list lengths.
+        """
+        parts = list(self._postings(query_tokens, doc_filter))
+        if not parts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        if len(parts) == 1:
+            docs, scores = parts[0]
+            return np.asarray(docs, dtype=np.int64), np.asarray(scores)
+        docs = np.concatenate([d for d, _ in parts])
+        contrib = np.concatenate([c for _, c in parts])
+        # bincount adds in input order, so per-document sums are accumulated
+        # term by term exactly like the dense path.
+        uniq, inverse = np.unique(docs, return_inverse=True)
+        return uniq.astype(np.int64), np.bincount(inverse, weights=contrib, minlength=len(uniq))
+
+    def top_k(self, query_tokens, k):
+        """
+        Best k documents with a positive score, ordered by score descending.
+        Ties go to the lower row id, matching BM25Okapi's get_scores ranked
+        with np.argsort(-scores, kind="stable").
+        """
+        docs, scores = self.match(query_tokens)
+        positive = scores > 0
+        docs, scores = docs[positive], scores[positive]
+        return select_top_k(docs, scores, k)
+
+    def match_batch(self, queries_tokens, doc_filter=None):
+        """
+        Scores several queries at once. Returns (query_ids, doc_ids, scores)
+        sorted by query then document, one entry per matching pair.
+        """
+        qids, docs, contrib = [], [], []
+        for qi, tokens in enumerate(queries_tokens):
+            for d, c in self._postings(tokens, doc_filter):
+                qids.append(np.full(len(d), qi, dtype=np.int64))
+                docs.append(d)
+                contrib.append(c)
+        if not docs:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, np.zeros(0)
+        n_docs = max(self.num_docs, 1)
+        keys = np.concatenate(qids) * n_docs + np.concatenate(docs)
+        uniq, inverse = np.unique(keys, return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(contrib), minlength=len(uniq))
+        return uniq // n_docs, uniq % n_docs, scores
+
+    def top_k_batch(self, queries_tokens, k):
+        """Same as top_k for each query, scored in one vectorized pass."""
+        qids, docs, scores = self.match_batch(queries_tokens)
+        positive = scores > 0
+        qids, docs, scores = qids[positive], docs[positive], scores[positive]
+        bounds = np.searchsorted(qids, np.arange(len(queries_tokens) + 1))
+        return [select_top_k(docs[bounds[i]:bounds[i + 1]], scores[bounds[i]:bounds[i + 1]], k)
+                for i in range(len(queries_tokens))]
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "vocab.json"), "w") as f:
+            json.dump(self.vocab, f)
+        with open(os.path.join(path, "params.json"), "w") as f:
+            json.dump({"k1": self.k1, "b": self.b, "avgdl": self.avgdl}, f)
+        for name in ("offsets", "doc_ids", "tfs", "doc_len", "idf", "weights", "doc_counts"):
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, path, mmap=True, k1=K1, b=B):
+        mode = "r" if mmap else None
+        with open(os.path.join(path, "vocab.json")) as f:
+            vocab = json.load(f)
+        with open(os.path.join(path, "params.json")) as f:
+            params = json.load(f)
+        arrays = [np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mode)
+                  for name in ("offsets", "doc_ids", "tfs", "doc_len", "idf")]
+        weights = None
+        if params["k1"] == k1 and params["b"] == b:
+            weights = np.load(os.path.join(path, "weights.npy"), mmap_mode=mode)
+        doc_counts = np.load(os.path.join(path, "doc_counts.npy"), mmap_mode=mode)
+        index = cls(vocab, *arrays, weights=weights, k1=k1, b=b, doc_counts=doc_counts)
+        # Saved after set_corpus_stats (e.g. a shard of a larger corpus), the
+        # idf is the corpus' and so must the average length be
+        avgdl = params.get("avgdl", index.avgdl)
+        if avgdl != index.avgdl:
+            index.avgdl = avgdl
+            if weights is None:
+                index.weights = index._term_weights()
+        return index
+
+
+def select_top_k(docs, scores, k):
+    """
+    Partial selection of the k best (score desc, doc asc) entries, returned
+    in rank order.
+    """
+    if len(scores) > k:
+        if k <= 0:
+            return docs[:0], scores[:0]
+        part = np.argpartition(-scores, k - 1)[:k]
+        threshold = scores[part].min()
+        above = np.flatnonzero(scores > threshold)
+        tied = np.flatnonzero(scores == threshold)
+        tied = tied[np.argsort(docs[tied])[:k - len(above)]]
+        keep = np.concatenate([above, tied])
+        docs, scores = docs[keep], scores[keep]
+    order = np.lexsort((docs, -scores))
+    return docs[order], scores[order]
@@ -0,0 +1,212 @@
+import json
+import os
+import threading
+import time
+import weakref
+from collections import deque
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+STAGES = ("search_bm25", "search_hybrid", "rerank", "aggregate_results")
+
+# Forked server workers start over, with a lock nobody holds
+_metrics = weakref.WeakSet()
+
+
+def _reset_metrics():
+    for metrics in list(_metrics):
+        metrics._reset()
+
+
+os.register_at_fork(after_in_child=_reset_metrics)
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus sense."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, n in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += n
+            yield f"{name}_bucket{_labels(labels, le=_number(bound))} {cumulative}"
+        yield f"{name}_sum{_labels(labels)} {_number(self.sum)}"
+        yield f"{name}_count{_labels(labels)} {self.count}"
+
+
+def _number(value):
+    if isinstance(value, str):
+        return value
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{str(v)}"' for k, v in items) + "}"
+
+
+def process_memory():
+    """Resident and virtual memory of this process, in bytes."""
+    with open("/proc/self/statm") as f:
+        size, resident = f.read().split()[:2]
+    page = os.sysconf("SC_PAGE_SIZE")
+    return int(resident) * page, int(size) * page
+
+
+class SearchTrace:
+    """Stage timings and candidate counts of one search."""
+
+    def __init__(self, metrics, query, filters=None):
+        self.metrics = metrics
+        self.query = query
+        self.filters = filters
+        self.start = self.last = time.perf_counter()
+        self.stages = {}
+        self.candidates = {}
+
+    def mark(self, stage):
+        # A paged search may run a stage more than once; times add up
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    def count(self, hits):
+        for r in hits:
+            self.candidates[r["source"]] = self.candidates.get(r["source"], 0) + 1
+
+    def finish(self, cached=False):
+        self.metrics.record(self, time.perf_counter() - self.start, cached)
+
+
+class _NullTrace:
+    # Stands in for SearchTrace when instrumentation is off
+    def mark(self, stage):
+        pass
+
+    def count(self, hits):
+        pass
+
+    def finish(self, cached=False):
+        pass
+
+
+NULL_TRACE = _NullTrace()
+
+
+class SearchMetrics:
+    """
+    Instrumentation of the search path: per-stage latency histograms,
+    candidates per source, encoder call sizes, search counters, and a
+    slow-query log of every search slower than slow_query_ms (JSON lines to
+    slow_query_log, or stdout; the latest `keep` are also held in memory).
+
+    Every series carries a worker label (the process id): each pre-forked
+    server worker records and reports its own, starting from zero at the
+    fork, so summing over workers counts every search once.
+    """
+
+    def __init__(self, slow_query_ms=None, slow_query_log=None, keep=100):
+        self.slow_query_ms = slow_query_ms
+        self.slow_query_log = slow_query_log
+        self.slow_queries = deque(maxlen=keep)
+        self._reset()
+        _metrics.add(self)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self.latency = {stage: Histogram(LATENCY_BUCKETS) for stage in STAGES + ("total",)}
+        self.candidates = {}
+        self.encode_sizes = Histogram(BATCH_BUCKETS)
+        self.searches = {False: 0, True: 0}
+        self.slow = 0
+        self.slow_queries.clear()
+
+    def trace(self, query, filters=None):
+        return SearchTrace(self, query, filters)
+
+    def record(self, trace, total, cached):
+        with self._lock:
+            self.searches[cached] += 1
+            self.latency["total"].observe(total)
+            for stage, seconds in trace.stages.items():
+                self.latency[stage].observe(seconds)
+            if not cached:
+                for source, n in trace.candidates.items():
+                    self.candidates.setdefault(source, Histogram(COUNT_BUCKETS)).observe(n)
+        if self.slow_query_ms is not None and total * 1000 >= self.slow_query_ms:
+            self._log_slow(trace, total, cached)
+
+    def observe_encode(self, n_texts):
+        with self._lock:
+            self.encode_sizes.observe(n_texts)
+
+    def _log_slow(self, trace, total, cached):
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "query": trace.query,
+            "filters": trace.filters or {},
+            "total_ms": round(total * 1000, 3),
+            "stages_ms": {stage: round(s * 1000, 3) for stage, s in trace.stages.items()},
+            "candidates": trace.candidates,
+            "cached": cached,
+        }
+        line = json.dumps(entry)
+        with self._lock:
+            self.slow += 1
+            self.slow_queries.append(entry)
+            if self.slow_query_log:
+                with open(self.slow_query_log, "a") as f:
+                    f.write(line + "\n")
+            else:
+                print(f"Slow query: {line}")
+
+    def render(self, gauges=(), counters=()):
+        """
+        Prometheus text exposition of the recorded metrics, plus extra
+        (name, help, [(labels, value)]) gauges and counters from the caller.
+        """
+        out = []
+        worker = [("worker", os.getpid())]
+        with self._lock:
+            out.append("# HELP saferbites_search_stage_seconds Latency of each search stage.")
+            out.append("# TYPE saferbites_search_stage_seconds histogram")
+            for stage, hist in self.latency.items():
+                out.extend(hist.lines("saferbites_search_stage_seconds", worker + [("stage", stage)]))
+            out.append("# HELP saferbites_search_candidates Candidates retrieved per search, by source.")
+            out.append("# TYPE saferbites_search_candidates histogram")
+            for source, hist in sorted(self.candidates.items()):
+                out.extend(hist.lines("saferbites_search_candidates", worker + [("source", source)]))
+            out.append("# HELP saferbites_encode_texts Texts per reranker encode call.")
+            out.append("# TYPE saferbites_encode_texts histogram")
+            out.extend(self.encode_sizes.lines("saferbites_encode_texts", worker))
+            out.append("# HELP saferbites_searches_total Searches served, by whether the result cache answered.")
+            out.append("# TYPE saferbites_searches_total counter")
+            for cached, n in self.searches.items():
+                out.append(f"saferbites_searches_total{_labels(worker + [('cached', str(cached).lower())])} {n}")
+            out.append("# HELP saferbites_slow_queries_total Searches over the slow-query threshold.")
+            out.append("# TYPE saferbites_slow_queries_total counter")
+            out.append(f"saferbites_slow_queries_total{_labels(worker)} {self.slow}")
+        for kind, metrics in (("gauge", gauges), ("counter", counters)):
+            for name, help_text, samples in metrics:
+                out.append(f"# HELP {name} {help_text}")
+                out.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    out.append(f"{name}{_labels(worker + list(labels))} {_number(value)}")
+        return "\n".join(out) + "\n"
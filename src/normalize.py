@@ -1,131 +1,240 @@
 import pandas as pd
 import numpy as np
-import re
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from index_store import build_snapshot
+from tagger import tag_masks, tag_strings
 
 DATA_DIR = "saferbites/data"
 
-KEYWORDS = {
-    "pests": ["rodent", "mouse", "mice", "roach", "insect", "rat", "fly", "flies", "vermin", "pest"],
-    "temperature": ["cold", "hot", "temp", "thermometer", "degree", "cooling", "holding", "refrigerat"],
-    "contamination": ["raw", "contam", "sanitize", "cross", "glove", "hand", "clean", "wash"]
-}
-
-def normalize_text(text):
-    if pd.isna(text):
-        return ""
-    text = str(text).lower()
-    text = re.sub(r'[^\w\s]', '', text)
-    return text
-
-def get_tags(text):
-    tags = []
-    for category, words in KEYWORDS.items():
-        if any(w in text for w in words):
-            tags.append(category)
-    return ",".join(tags)
-
-def process_inspections():
-    print("Processing Inspections...")
-    df = pd.read_csv(f"{DATA_DIR}/inspections_raw.csv")
-    
-    # Keep relevant columns
-    cols = ["camis", "dba", "violation_description", "street", "boro", "zipcode"]
-    # Check which columns exist (case sensitive sometimes)
-    existing_cols = [c for c in cols if c in df.columns]
-    df = df[existing_cols].copy()
-    
-    if "violation_description" not in df.columns:
-        print("Error: violation_description column not found.")
-        return None
+DOC_COLUMNS = ["doc_id", "business_id", "business_name", "text", "original_text", "source", "tags", "tag_mask",
+               "boro", "zipcode", "street", "inspection_date", "violation_code"]
+LOCATION_COLUMNS = ["boro", "zipcode", "street"]
+# Together with camis these identify a violation record across daily feeds
+RECORD_COLUMNS = ["inspection_date", "violation_code"]
+INSPECTION_COLUMNS = ["camis", "dba", "violation_description", "street", "boro", "zipcode"] + RECORD_COLUMNS
 
+def normalize_column(series):
+    # Lowercase, punctuation stripped; missing values become ""
+    return series.fillna("").astype(str).str.lower().str.replace(r'[^\w\s]', '', regex=True)
+
+def inspection_documents(df):
+    """Violation documents for a frame of raw inspection rows."""
     df = df.dropna(subset=["violation_description"])
-    
+
     # Normalize
-    df["clean_text"] = df["violation_description"].apply(normalize_text)
-    df["tags"] = df["clean_text"].apply(get_tags)
-    
+    clean_text = normalize_column(df["violation_description"])
+    masks = tag_masks(clean_text)
+
     # Create documents (one per violation)
     # We will rename columns to match a standard "document" schema
     # doc_id, business_id, text, source, tags, original_text, business_name
-    
-    documents = []
-    for idx, row in df.iterrows():
-        doc = {
-            "doc_id": f"insp_{idx}",
-            "business_id": row["camis"],
-            "business_name": row.get("dba", "Unknown"),
-            "text": row["clean_text"],
-            "original_text": row["violation_description"],
-            "source": "violation",
-            "tags": row["tags"]
-        }
-        documents.append(doc)
-        
-    doc_df = pd.DataFrame(documents)
-    doc_df.to_csv(f"{DATA_DIR}/violations_processed.csv", index=False)
-    print(f"Saved {len(doc_df)} violation documents.")
-    return df["camis"].unique()
-
-def process_reviews(valid_business_ids):
+    # plus the location facets (boro, zipcode, street) and the record key
+    return pd.DataFrame({
+        "doc_id": "insp_" + df.index.astype(str),
+        "business_id": df["camis"],
+        "business_name": df["dba"] if "dba" in df.columns else "Unknown",
+        "text": clean_text,
+        "original_text": df["violation_description"],
+        "source": "violation",
+        "tags": tag_strings(masks),
+        "tag_mask": masks,
+        **{c: df[c] if c in df.columns else "" for c in LOCATION_COLUMNS + RECORD_COLUMNS},
+    }, columns=DOC_COLUMNS)
+
+def review_documents(df, business_ids, locations=None):
+    """
+    Sentence documents for a frame of raw reviews, one business id per
+    review. locations (indexed by business id) supplies the facets.
+    """
+    sentences = df["Review"].astype(str).str.split(r'[.!?]+', regex=True)
+    exploded = pd.DataFrame({
+        "sentence": sentences,
+        "business_id": business_ids,
+    }, index=df.index).explode("sentence")
+    # Position of each sentence within its review
+    s_idx = exploded.groupby(level=0).cumcount()
+
+    # Segment sentences
+    clean_s = normalize_column(exploded["sentence"]).str.strip()
+    masks = tag_masks(clean_s)
+
+    # Skip too short, and keep only if it has tags or food-safety-ish keyword
+    keep = (clean_s.str.len() >= 5).to_numpy() & (masks != 0)
+    exploded, s_idx, clean_s, masks = exploded[keep], s_idx[keep], clean_s[keep], masks[keep]
+
+    return pd.DataFrame({
+        "doc_id": "rev_" + exploded.index.astype(str) + "_" + s_idx.astype(str),
+        "business_id": exploded["business_id"],
+        "business_name": "Unknown", # We don't know the name for random assignments
+        "text": clean_s,
+        "original_text": exploded["sentence"].str.strip(),
+        "source": "review",
+        "tags": tag_strings(masks),
+        "tag_mask": masks,
+        **_locations_for(exploded["business_id"], locations),
+        **{c: "" for c in RECORD_COLUMNS},
+    }, columns=DOC_COLUMNS)
+
+def _locations_for(business_ids, locations):
+    if locations is None or locations.empty:
+        return {c: "" for c in LOCATION_COLUMNS}
+    found = locations.reindex(business_ids.to_numpy())
+    return {c: found[c].fillna("").to_numpy() for c in LOCATION_COLUMNS}
+
+class ChunkWriter:
+    """Appends processed chunks to a CSV and reports throughput."""
+
+    def __init__(self, path, label):
+        self.path = path
+        self.label = label
+        self.rows_in = 0
+        self.docs_out = 0
+        self.start = time.perf_counter()
+        if os.path.exists(path):
+            os.remove(path)
+
+    def write(self, docs, rows_in):
+        docs.to_csv(self.path, mode="a", header=not os.path.exists(self.path), index=False)
+        self.rows_in += rows_in
+        self.docs_out += len(docs)
+        elapsed = time.perf_counter() - self.start
+        print(f"  {self.label}: {self.rows_in} rows -> {self.docs_out} docs "
+              f"({self.rows_in / max(elapsed, 1e-9):,.0f} rows/s)")
+
+    def finish(self):
+        if not os.path.exists(self.path):
+            pd.DataFrame(columns=DOC_COLUMNS).to_csv(self.path, index=False)
+
+def _map_chunks(fn, chunks, workers, initializer=None, initargs=()):
+    # Runs fn over (args) tuples, yielding results in input order. At most
+    # 2 * workers chunks are in flight so memory stays bounded. initializer
+    # sets up state shared by all chunks, once per process.
+    if workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for args in chunks:
+            yield fn(*args)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as pool:
+        pending = []
+        for args in chunks:
+            pending.append(pool.submit(fn, *args))
+            if len(pending) >= 2 * workers:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+def _inspection_task(df):
+    docs = inspection_documents(df)
+    return docs, len(df), docs.drop_duplicates("business_id").set_index("business_id")[LOCATION_COLUMNS]
+
+# Business locations for the review chunks, set once per worker process
+_locations = None
+
+def _set_locations(locations):
+    global _locations
+    _locations = locations
+
+def _review_task(df, business_ids):
+    return review_documents(df, business_ids, _locations), len(df)
+
+def raw_path(filename):
+    # download_data.py --gzip stores the raw file compressed
+    path = f"{DATA_DIR}/{filename}"
+    if not os.path.exists(path) and os.path.exists(path + ".gz"):
+        return path + ".gz"
+    return path
+
+def process_inspections(chunksize=None, workers=1):
+    print("Processing Inspections...")
+    path = raw_path("inspections_raw.csv")
+
+    # Keep relevant columns
+    header = pd.read_csv(path, nrows=0).columns
+    # Check which columns exist (case sensitive sometimes)
+    existing_cols = [c for c in INSPECTION_COLUMNS if c in header]
+
+    if "violation_description" not in existing_cols:
+        print("Error: violation_description column not found.")
+        return None
+
+    dtypes = {c: str for c in LOCATION_COLUMNS + RECORD_COLUMNS}
+    if chunksize:
+        chunks = ((df,) for df in pd.read_csv(path, usecols=existing_cols, dtype=dtypes, chunksize=chunksize))
+    else:
+        chunks = [(pd.read_csv(path, usecols=existing_cols, dtype=dtypes),)]
+
+    writer = ChunkWriter(f"{DATA_DIR}/violations_processed.csv", "inspections")
+    businesses = []
+    for docs, rows_in, locations in _map_chunks(_inspection_task, chunks, workers):
+        writer.write(docs, rows_in)
+        businesses.append(locations)
+    writer.finish()
+    print(f"Saved {writer.docs_out} violation documents.")
+    # One row per business (first seen), indexed by business id
+    businesses = pd.concat(businesses) if businesses else pd.DataFrame(columns=LOCATION_COLUMNS)
+    return businesses[~businesses.index.duplicated()]
+
+def process_reviews(valid_business_ids, chunksize=None, workers=1, locations=None):
     print("Processing Reviews...")
-    try:
-        df = pd.read_csv(f"{DATA_DIR}/reviews_raw.csv")
-    except:
+    path = f"{DATA_DIR}/reviews_raw.csv"
+    if not os.path.exists(path):
         print("No reviews file found.")
         return
 
-    if "Review" not in df.columns:
+    columns = pd.read_csv(path, nrows=0).columns
+    if "Review" in columns:
+        review_col = "Review"
+    elif "text" in columns:
         # Try 'text' or similar if schema differs
-        if "text" in df.columns:
-            df["Review"] = df["text"]
-        else:
-            print("Review column not found.")
-            return
-
-    documents = []
-    count = 0
-    
-    # If we don't have many reviews, we can duplicate them to simulate volume, 
+        review_col = "text"
+    else:
+        print("Review column not found.")
+        return
+
+    # If we don't have many reviews, we can duplicate them to simulate volume,
     # but for now just process what we have.
-    
-    for idx, row in df.iterrows():
-        review_text = row["Review"]
-        # Segment sentences
-        sentences = re.split(r'[.!?]+', str(review_text))
-        
-        # Assign a random business ID
-        if len(valid_business_ids) > 0:
-            bid = np.random.choice(valid_business_ids)
-        else:
-            bid = "00000000"
-
-        for s_idx, sentence in enumerate(sentences):
-            clean_s = normalize_text(sentence).strip()
-            if len(clean_s) < 5: continue # Skip too short
-            
-            tags = get_tags(clean_s)
-            
-            # Filter: Keep only if it has tags or food-safety-ish keyword
-            if not tags: 
-                continue
-                
-            doc = {
-                "doc_id": f"rev_{idx}_{s_idx}",
-                "business_id": bid,
-                "business_name": "Unknown", # We don't know the name for random assignments
-                "text": clean_s,
-                "original_text": sentence.strip(),
-                "source": "review",
-                "tags": tags
-            }
-            documents.append(doc)
-            count += 1
-            
-    doc_df = pd.DataFrame(documents)
-    doc_df.to_csv(f"{DATA_DIR}/reviews_processed.csv", index=False)
-    print(f"Saved {count} review sentence documents.")
+
+    def chunks():
+        reader = pd.read_csv(path, usecols=[review_col], chunksize=chunksize) if chunksize \
+            else [pd.read_csv(path, usecols=[review_col])]
+        for df in reader:
+            df = df.rename(columns={review_col: "Review"})
+            # Assign a random business ID (drawn here, in the parent, so the
+            # sequence does not depend on how chunks are scheduled)
+            if len(valid_business_ids) > 0:
+                # Same draws as one np.random.choice per review
+                bids = np.asarray(valid_business_ids)[np.random.randint(len(valid_business_ids), size=len(df))]
+            else:
+                bids = np.full(len(df), "00000000")
+            yield df, bids
+
+    writer = ChunkWriter(f"{DATA_DIR}/reviews_processed.csv", "reviews")
+    for docs, rows_in in _map_chunks(_review_task, chunks(), workers, _set_locations, (locations,)):
+        writer.write(docs, rows_in)
+    writer.finish()
+    print(f"Saved {writer.docs_out} review sentence documents.")
 
 if __name__ == "__main__":
-    business_ids = process_inspections()
-    if business_ids is not None:
-        process_reviews(business_ids)
+    parser = argparse.ArgumentParser(description="Normalize raw inspections and reviews into documents.")
+    parser.add_argument("--stream", action="store_true",
+                        help="Read raw files in chunks and write output incrementally. Memory stays bounded "
+                             "while normalizing; the index snapshot built afterwards still loads the "
+                             "processed CSVs in full (see --no-snapshot)")
+    parser.add_argument("--chunksize", type=int, default=100000, help="Rows per chunk in streaming mode")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Worker processes in streaming mode")
+    parser.add_argument("--no-snapshot", action="store_true",
+                        help="Only write the processed CSVs; build the index snapshot later with index_store.py")
+    args = parser.parse_args()
+
+    chunksize = args.chunksize if args.stream else None
+    workers = args.workers if args.stream else 1
+    businesses = process_inspections(chunksize, workers)
+    if businesses is not None:
+        process_reviews(businesses.index.to_numpy(), chunksize, workers, locations=businesses)
+        if not args.no_snapshot:
+            build_snapshot(DATA_DIR)
@@ -0,0 +1,140 @@
+import base64
+import binascii
+import json
+
+from metrics import NULL_TRACE
+
+# Bounds of the paging state a cursor may carry
+MAX_PAGE_SIZE = 1000
+MAX_TOP_K = 1000
+MAX_EVIDENCE = 1000
+MAX_OFFSET = 100000
+
+
+class ResultStream:
+    """
+    A query's businesses in rank order, produced incrementally. Candidates
+    are fetched at a BM25 depth that doubles whenever the businesses found
+    so far run out; rerank scores of candidates already seen are kept, so
+    each deepening only encodes the new ones. Only the ranked businesses
+    not yet handed out are held between calls.
+
+    The order is that of engine.search(query, top_k) for the businesses it
+    finds, followed by those first found at twice the depth (ranked among
+    themselves as search() would rank them), and so on. It does not depend
+    on how many businesses are asked for at a time.
+
+    The stream keeps searching the index version it started on (state,
+    default: the engine's current one), so its pages stay consistent
+    across reloads. Candidates come from engine.retrieve with first_stage;
+    dense candidates only run out with the documents passing the filters,
+    so a hybrid stream goes on through every such business.
+    """
+
+    def __init__(self, engine, query, filters=None, top_k=30, max_evidence=None, state=None, first_stage=None):
+        self.engine = engine
+        self.state = state or engine.state
+        # The stage that runs, resolved once like the rest of the stream's state
+        self.first_stage = engine._first_stage(first_stage, self.state)
+        self.query = query
+        self.filters = filters
+        self.depth = 0
+        self.initial_depth = top_k
+        self.max_evidence = max_evidence
+        self.position = 0
+        self.exhausted = False
+        self._ranked = []
+        self._emitted = set()
+        self._rerank_scores = {}
+
+    def _deepen(self, trace):
+        self.depth = self.depth * 2 if self.depth else self.initial_depth
+        hits = self.engine.retrieve(self.query, self.depth, self.filters, self.first_stage, self.state)
+        trace.mark(f"search_{self.first_stage}")
+        trace.count(hits)
+        per_source = {}
+        for r in hits:
+            per_source[r["source"]] = per_source.get(r["source"], 0) + 1
+        # Every source returned fewer than asked: nothing more to fetch
+        self.exhausted = all(n < self.depth for n in per_source.values())
+
+        hits = [r for r in hits if r["business_id"] not in self._emitted]
+        if self.engine.reranking:
+            new = [r for r in hits if (r["source"], r["row"]) not in self._rerank_scores]
+            for r in self.engine.rerank(self.query, new, state=self.state):
+                self._rerank_scores[(r["source"], r["row"])] = r["rerank_score"]
+            for r in hits:
+                r["rerank_score"] = self._rerank_scores[(r["source"], r["row"])]
+            hits = sorted(hits, key=lambda x: x["rerank_score"], reverse=True)
+        trace.mark("rerank")
+        self._ranked = self.engine.aggregate_results(hits, self.query, max_evidence=self.max_evidence)
+        trace.mark("aggregate_results")
+
+    def next(self, n, trace=NULL_TRACE):
+        """
+        The next n businesses (fewer at the end), as aggregate_results
+        returns them. Stages run to deepen are marked on trace.
+        """
+        batch = []
+        while len(batch) < n:
+            if not self._ranked:
+                if self.exhausted:
+                    break
+                # Every business found at this depth has been handed out
+                self._deepen(trace)
+                continue
+            taken = self._ranked[:n - len(batch)]
+            self._ranked = self._ranked[len(taken):]
+            self._emitted.update(b["business_id"] for b in taken)
+            batch += taken
+        self.position += len(batch)
+        return batch
+
+    def done(self):
+        return self.exhausted and not self._ranked
+
+
+def encode_cursor(state):
+    """Opaque, URL-safe cursor for a paging state dict."""
+    raw = json.dumps(state, separators=(",", ":"), sort_keys=True).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        state = json.loads(raw)
+    except (binascii.Error, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {e}") from None
+    return check_state(state)
+
+
+def _bounded_int(value, low, high):
+    return isinstance(value, int) and not isinstance(value, bool) and low <= value <= high
+
+
+def check_state(state):
+    """
+    Returns a paging state dict if it is well-formed, else raises
+    ValueError: cursors come from clients, and their sizes bound the work
+    a request can ask for.
+    """
+    if not isinstance(state, dict) or not {"q", "o", "n"} <= state.keys():
+        raise ValueError("Invalid cursor")
+    if not isinstance(state["q"], str):
+        raise ValueError("Invalid cursor: q must be a string")
+    for field, low, high, optional in (("o", 0, MAX_OFFSET, False), ("n", 1, MAX_PAGE_SIZE, False),
+                                       ("k", 1, MAX_TOP_K, True), ("e", 1, MAX_EVIDENCE, True)):
+        value = state.get(field)
+        if value is None and optional:
+            continue
+        if not _bounded_int(value, low, high):
+            raise ValueError(f"Invalid cursor: {field} must be an integer from {low} to {high}")
+    filters = state.get("f") or {}
+    if not isinstance(filters, dict) or not all(
+            isinstance(k, str) and (isinstance(v, str) or isinstance(v, list) and all(isinstance(x, str) for x in v))
+            for k, v in filters.items()):
+        raise ValueError("Invalid cursor: f must map filter names to strings")
+    if state.get("s") is not None and not isinstance(state["s"], str):
+        raise ValueError("Invalid cursor: s must be a string")
+    return state
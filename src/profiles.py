@@ -0,0 +1,400 @@
+import datetime
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from facets import FACET_FIELDS, normalize_value
+from index_store import (InternedColumn, is_stale, load_businesses, read_manifest, record_keys, save_businesses,
+                         snapshot_path)
+from segments import read_segment_state, segment_dir
+from tagger import TAG_BITS, TAG_CATEGORIES
+
+PROFILES_DIRNAME = "profiles"
+PROFILE_SOURCES = ["violation", "review"]
+VIOLATION, REVIEW = 0, 1
+COLUMNS = ["business_name"] + FACET_FIELDS
+# Most recent violations kept per business
+RECENT = 3
+
+# Risk score: each violation weighs 1 plus the weights of its tags, halved
+# for every HALF_LIFE_DAYS it is older than the newest inspection in the
+# data; each tag of a review adds REVIEW_WEIGHT times the tag's weight.
+TAG_WEIGHTS = {"pests": 3.0, "temperature": 2.0, "contamination": 2.0}
+REVIEW_WEIGHT = 0.5
+HALF_LIFE_DAYS = 365.0
+# Violation weights are summed relative to a fixed epoch ("forward decay")
+# and scaled to the reference date when read, so adding or removing a
+# document never touches the other documents' weights. Undated violations
+# count as of the epoch.
+EPOCH = datetime.date(2000, 1, 1)
+NO_DATE = np.iinfo(np.int32).min
+
+
+def to_days(dates):
+    """Days since EPOCH of ISO dates (time of day ignored); NO_DATE where missing."""
+    codes, uniques = pd.factorize(pd.Series(dates, dtype=object).astype(str))
+    parsed = pd.to_datetime(pd.Series(uniques, dtype=object).str[:10], format="%Y-%m-%d", errors="coerce")
+    days = ((parsed - pd.Timestamp(EPOCH)).dt.days).fillna(NO_DATE).to_numpy(np.int64)
+    return days[codes].astype(np.int32)
+
+
+def format_day(day):
+    if day == NO_DATE:
+        return None
+    return (EPOCH + datetime.timedelta(days=day)).isoformat()
+
+
+def _tag_weights(masks):
+    masks = np.asarray(masks, dtype=np.int64)
+    weights = np.zeros(len(masks))
+    for category, weight in TAG_WEIGHTS.items():
+        weights += weight * ((masks & TAG_BITS[category]) > 0)
+    return weights
+
+
+def violation_weights(masks, days):
+    """Forward-decayed weight of each violation (see EPOCH)."""
+    days = np.where(days == NO_DATE, 0, days).astype(np.float64)
+    return (1.0 + _tag_weights(masks)) * np.exp2(days / HALF_LIFE_DAYS)
+
+
+def _grouped_order(group, *keys):
+    # Rows ordered by group, then by the keys (most significant first), then by row
+    return np.lexsort((np.arange(len(group)),) + tuple(reversed(keys)) + (group,))
+
+
+class ProfileTable:
+    """
+    Materialized safety profiles, one per business (codes into a sorted
+    business id table): documents and tag counts per source, a risk score,
+    the most recent violations, name and location, plus leaderboards
+    precomputed as sorted views over the business codes: all businesses by
+    risk, those with violations of each tag by count then risk (CSR per
+    tag), and each borough's and zipcode's businesses by risk (CSR per value).
+
+    update() folds documents in or out: counts and the risk score are sums
+    over documents, and recent violations are re-merged only for the
+    businesses concerned, so an ingest costs about the size of its delta
+    plus one re-sort of the views.
+    """
+
+    def __init__(self, businesses, columns, doc_counts, tag_counts, decayed, recent, items, reference_day,
+                 views=None):
+        self.businesses = businesses
+        self.columns = columns
+        self.doc_counts = doc_counts
+        self.tag_counts = tag_counts
+        self.decayed = decayed
+        # {"day", "item", "key"}: (businesses, RECENT) arrays, most recent
+        # first; item indexes `items` ([violation_code, text]), -1 is empty
+        self.recent = recent
+        self.items = items
+        self.reference_day = int(reference_day)
+        self.views = views if views is not None else self._build_views()
+        self._codes = None
+        self._values = {field: {v: i for i, v in enumerate(self.columns[field].values)} for field in FACET_FIELDS}
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros(0, dtype=str), {c: InternedColumn.from_strings([]) for c in COLUMNS},
+                   np.zeros((0, len(PROFILE_SOURCES)), dtype=np.int32),
+                   np.zeros((0, len(PROFILE_SOURCES), len(TAG_CATEGORIES)), dtype=np.int32),
+                   np.zeros(0), cls._empty_recent(0), [], 0)
+
+    @staticmethod
+    def _empty_recent(n):
+        return {"day": np.full((n, RECENT), NO_DATE, dtype=np.int32),
+                "item": np.full((n, RECENT), -1, dtype=np.int32),
+                "key": np.zeros((n, RECENT), dtype=np.uint64)}
+
+    def __len__(self):
+        return len(self.businesses)
+
+    @property
+    def risk(self):
+        return self.views["risk"]
+
+    def _compute_risk(self):
+        scale = np.exp2(-self.reference_day / HALF_LIFE_DAYS)
+        review_tags = self.tag_counts[:, REVIEW, :] @ np.array([TAG_WEIGHTS[c] for c in TAG_CATEGORIES])
+        return self.decayed * scale + REVIEW_WEIGHT * review_tags
+
+    def _build_views(self):
+        risk = self._compute_risk()
+        n = len(risk)
+        views = {"risk": risk, "by_risk": np.lexsort((np.arange(n), -risk)).astype(np.int32)}
+        parts, offsets = [], [0]
+        for t in range(len(TAG_CATEGORIES)):
+            counts = self.tag_counts[:, VIOLATION, t].astype(np.int64)
+            order = np.lexsort((np.arange(n), -risk, -counts))
+            parts.append(order[counts[order] > 0])
+            offsets.append(offsets[-1] + len(parts[-1]))
+        views["tag_view"] = np.concatenate(parts).astype(np.int32)
+        views["tag_offsets"] = np.array(offsets, dtype=np.int64)
+        for field in FACET_FIELDS:
+            codes = np.asarray(self.columns[field].codes, dtype=np.int64)
+            order = _grouped_order(codes, -risk)
+            views[f"{field}_view"] = order.astype(np.int32)
+            views[f"{field}_offsets"] = np.searchsorted(codes[order], np.arange(len(self.columns[field].values) + 1))
+        return views
+
+    def _decoded(self, column):
+        col = self.columns[column]
+        return np.asarray(col.values, dtype=object)[np.asarray(col.codes, dtype=np.int64)]
+
+    def update(self, added=None, removed=None):
+        """
+        A new table with documents added and removed, each given as
+        {source: DataFrame} of processed documents (removed ones being
+        documents counted before). Name and location come from a business'
+        latest added violation, or from a review if it has none.
+        """
+        added = {s: df for s, df in (added or {}).items() if len(df)}
+        removed = {s: df for s, df in (removed or {}).items() if len(df)}
+        ids = pd.unique(np.concatenate([df["business_id"].astype(str).to_numpy(dtype=object)
+                                        for df in added.values()] or [np.zeros(0, dtype=object)]))
+        missing = np.sort(ids[pd.Index(self.businesses).get_indexer(ids) < 0].astype(str))
+        # Existing businesses keep their order; new ones are slotted in
+        at = np.searchsorted(self.businesses, missing) + np.arange(len(missing))
+        n = len(self.businesses) + len(missing)
+        old = np.flatnonzero(~np.isin(np.arange(n), at))
+        businesses = np.empty(n, dtype=np.result_type(self.businesses.dtype, missing.dtype))
+        businesses[old], businesses[at] = self.businesses, missing
+        lookup = pd.Index(businesses)
+
+        def grow(a, fill=0):
+            out = np.full((n,) + a.shape[1:], fill, dtype=a.dtype)
+            out[old] = a
+            return out
+
+        doc_counts, tag_counts, decayed = grow(self.doc_counts), grow(self.tag_counts), grow(self.decayed)
+        recent = {"day": grow(self.recent["day"], NO_DATE), "item": grow(self.recent["item"], -1),
+                  "key": grow(self.recent["key"])}
+        columns = {c: grow(self._decoded(c), "") for c in COLUMNS}
+        reference_day = self.reference_day
+        touched, candidates = [], None
+
+        for sign, frames in ((1, added), (-1, removed)):
+            for source, df in frames.items():
+                s = PROFILE_SOURCES.index(source)
+                codes = lookup.get_indexer(df["business_id"].astype(str))
+                masks = df["tag_mask"].to_numpy(np.int64)
+                doc_counts[:, s] += sign * np.bincount(codes, minlength=n).astype(np.int32)
+                for t, category in enumerate(TAG_CATEGORIES):
+                    has_tag = (masks & TAG_BITS[category]) > 0
+                    tag_counts[:, s, t] += sign * np.bincount(codes[has_tag], minlength=n).astype(np.int32)
+                if sign > 0:
+                    self._set_columns(columns, codes, df, source)
+                if source != "violation":
+                    continue
+                days = to_days(df["inspection_date"])
+                decayed += sign * np.bincount(codes, weights=violation_weights(masks, days), minlength=n)
+                touched.append(codes)
+                if sign > 0:
+                    if (days != NO_DATE).any():
+                        reference_day = max(reference_day, int(days[days != NO_DATE].max()))
+                    candidates = (codes, days, df)
+
+        items = list(self.items)
+        if touched:
+            removed_keys = record_keys(removed["violation"]) if "violation" in removed else None
+            self._merge_recent(recent, items, np.unique(np.concatenate(touched)), candidates, removed_keys)
+        return ProfileTable(businesses, {c: InternedColumn.from_strings(v) for c, v in columns.items()},
+                            doc_counts, tag_counts, decayed, recent, items, reference_day)
+
+    @staticmethod
+    def _set_columns(columns, codes, df, source):
+        # Each business' last document in the frame
+        last = np.full(len(columns[COLUMNS[0]]), -1)
+        np.maximum.at(last, codes, np.arange(len(codes)))
+        hit = np.flatnonzero(last >= 0)
+        for c in COLUMNS:
+            values = df[c].iloc[last[hit]].astype(str)
+            if c in FACET_FIELDS:
+                # As normalize_value
+                values = values.str.strip().str.lower()
+            values = values.to_numpy(dtype=object)
+            # Reviews only fill in what no violation has given
+            keep = values != ""
+            if source != "violation":
+                keep &= columns[c][hit] == ""
+            columns[c][hit[keep]] = values[keep]
+
+    @staticmethod
+    def _merge_recent(recent, items, touched, candidates, removed_keys):
+        # Candidates per touched business: its current recent violations (in
+        # stored order, less removed ones), then the added ones (later rows
+        # first); the RECENT latest of them win.
+        day = recent["day"][touched]
+        live = recent["item"][touched] >= 0
+        if removed_keys is not None:
+            live &= ~np.isin(recent["key"][touched], removed_keys)
+        entry, slot = np.nonzero(live)
+        # Added documents are numbered from 0 and current entries below it
+        group, days, seqs = [entry], [day[entry, slot]], [-1 - slot]
+        if candidates is not None:
+            codes, doc_days, df = candidates
+            group.append(np.searchsorted(touched, codes))
+            days.append(doc_days)
+            seqs.append(np.arange(len(codes)))
+
+        group, days, seqs = np.concatenate(group), np.concatenate(days).astype(np.int64), np.concatenate(seqs)
+        order = _grouped_order(group, -days, -seqs)
+        group = group[order]
+        rank = np.arange(len(order)) - np.searchsorted(group, group)
+        keep = order[rank < RECENT]
+        rows, slots = touched[group[rank < RECENT]], rank[rank < RECENT]
+
+        item, key = np.full(len(seqs), -1, dtype=np.int32), np.zeros(len(seqs), dtype=np.uint64)
+        current = seqs < 0
+        item[current] = recent["item"][touched][entry, slot]
+        key[current] = recent["key"][touched][entry, slot]
+        # Item ids and record keys only for the added documents that made it
+        won = keep[~current[keep]]
+        if len(won):
+            docs = df.iloc[seqs[won]]
+            pairs = docs["violation_code"].astype(str) + "\x1f" + docs["original_text"].astype(str)
+            pair_codes, uniques = pd.factorize(pairs)
+            index = {(code, text): i for i, (code, text) in enumerate(map(tuple, items))}
+            ids = np.array([index.setdefault(tuple(u.split("\x1f", 1)), len(index)) for u in uniques], dtype=np.int32)
+            items[:] = [list(pair) for pair in index]
+            item[won] = ids[pair_codes]
+            key[won] = record_keys(docs)
+        for k, values in (("day", days), ("item", item), ("key", key)):
+            recent[k][touched] = ProfileTable._empty_recent(1)[k]
+            recent[k][rows, slots] = values[keep]
+
+    def code(self, business_id):
+        if self._codes is None:
+            self._codes = {b: i for i, b in enumerate(self.businesses.tolist())}
+        return self._codes.get(str(business_id))
+
+    def summary(self, code):
+        counts = {}
+        for source, documents, tags in zip(PROFILE_SOURCES, self.doc_counts[code].tolist(),
+                                           self.tag_counts[code].tolist()):
+            counts[source] = {"documents": documents, **dict(zip(TAG_CATEGORIES, tags))}
+        profile = {"business_id": str(self.businesses[code])}
+        profile.update((c, self.columns[c][code]) for c in COLUMNS)
+        profile["risk_score"] = round(float(self.risk[code]), 4)
+        profile["last_inspection"] = format_day(int(self.recent["day"][code, 0]))
+        profile["counts"] = counts
+        return profile
+
+    def profile(self, business_id):
+        """A business' profile (summary plus its recent violations), or None if unknown."""
+        code = self.code(business_id)
+        if code is None:
+            return None
+        profile = self.summary(code)
+        profile["recent_violations"] = [
+            {"inspection_date": format_day(day), "violation_code": self.items[i][0], "text": self.items[i][1]}
+            for day, i in zip(self.recent["day"][code].tolist(), self.recent["item"][code].tolist()) if i >= 0
+        ]
+        return profile
+
+    def _group(self, field, value):
+        i = self._values[field].get(normalize_value(value))
+        if i is None:
+            return np.zeros(0, dtype=np.int32)
+        offsets = self.views[f"{field}_offsets"]
+        return self.views[f"{field}_view"][offsets[i]:offsets[i + 1]]
+
+    def leaderboard(self, tag=None, zipcode=None, boro=None, limit=10):
+        """
+        Summaries of the riskiest businesses, optionally only those with
+        violations of `tag` (ranked by how many, then risk) and only in a
+        zipcode and/or borough.
+        """
+        if tag is not None and tag not in TAG_CATEGORIES:
+            raise ValueError(f"Unknown tag {tag!r}; expected one of {', '.join(TAG_CATEGORIES)}")
+        if zipcode or boro:
+            # The narrower location group, already in risk order
+            codes = self._group("zipcode", zipcode) if zipcode else self._group("boro", boro)
+            if zipcode and boro:
+                wanted = self._values["boro"].get(normalize_value(boro), -1)
+                codes = codes[np.asarray(self.columns["boro"].codes)[codes] == wanted]
+            if tag is not None:
+                counts = self.tag_counts[codes, VIOLATION, TAG_CATEGORIES.index(tag)]
+                order = np.argsort(-counts.astype(np.int64), kind="stable")
+                codes = codes[order][counts[order] > 0]
+        elif tag is not None:
+            t = TAG_CATEGORIES.index(tag)
+            offsets = self.views["tag_offsets"]
+            codes = self.views["tag_view"][offsets[t]:offsets[t + 1]]
+        else:
+            codes = self.views["by_risk"]
+        return [self.summary(int(code)) for code in codes[:max(int(limit), 0)]]
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        save_businesses(path, self.businesses)
+        for c in COLUMNS:
+            self.columns[c].save(os.path.join(path, c))
+        arrays = {"doc_counts": self.doc_counts, "tag_counts": self.tag_counts, "decayed": self.decayed,
+                  **{f"recent_{k}": v for k, v in self.recent.items()}, **self.views}
+        for name, array in arrays.items():
+            np.save(os.path.join(path, f"{name}.npy"), array)
+        with open(os.path.join(path, "profiles.json"), "w") as f:
+            json.dump({"reference_day": self.reference_day, "views": list(self.views), "items": self.items}, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        mode = "r" if mmap else None
+
+        def load_array(name):
+            # Still memory-mapped, minus np.memmap's per-lookup overhead
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mode).view(np.ndarray)
+
+        with open(os.path.join(path, "profiles.json")) as f:
+            meta = json.load(f)
+        arrays = {name: load_array(name)
+                  for name in ["doc_counts", "tag_counts", "decayed"] + [f"recent_{k}" for k in ("day", "item", "key")]}
+        views = {name: load_array(name) for name in meta["views"]}
+        columns = {}
+        for c in COLUMNS:
+            columns[c] = InternedColumn.load(os.path.join(path, c), mmap)
+            columns[c].codes = columns[c].codes.view(np.ndarray)
+        table = cls(load_businesses(path), columns, arrays["doc_counts"], arrays["tag_counts"], arrays["decayed"],
+                    {k: arrays[f"recent_{k}"] for k in ("day", "item", "key")}, meta["items"],
+                    meta["reference_day"], views)
+        # Builds the business id lookup now rather than on the first request
+        table.code("")
+        return table
+
+
+def build_profiles(frames):
+    """ProfileTable of {source: processed DataFrame}."""
+    return ProfileTable.empty().update(added={s: df for s, df in frames.items() if s in PROFILE_SOURCES})
+
+
+def profiles_dir(snapshot_dir, state):
+    """Latest profile table of a snapshot: the newest delta segment's, else the base's."""
+    for name in reversed(state["segments"]):
+        path = os.path.join(segment_dir(snapshot_dir, name), PROFILES_DIRNAME)
+        if os.path.isdir(path):
+            return path
+    return os.path.join(snapshot_dir, PROFILES_DIRNAME)
+
+
+def update_profiles(snapshot_dir, state, segment, added, removed=None):
+    """
+    Writes the profile table of a new delta segment: the latest one of
+    `state` (before the segment is published) with the segment's documents
+    added and those it tombstones removed.
+    """
+    table = ProfileTable.load(profiles_dir(snapshot_dir, state), mmap=False)
+    table.update(added, removed).save(os.path.join(segment_dir(snapshot_dir, segment), PROFILES_DIRNAME))
+
+
+def load_profiles(data_dir, manifest=None):
+    """The current ProfileTable of the index snapshot, or None if the snapshot is missing or stale."""
+    if manifest is None:
+        manifest = read_manifest(data_dir)
+    if is_stale(data_dir, manifest):
+        return None
+    snapshot_dir = snapshot_path(data_dir, manifest)
+    path = profiles_dir(snapshot_dir, read_segment_state(snapshot_dir))
+    return ProfileTable.load(path) if os.path.isdir(path) else None
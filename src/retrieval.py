@@ -1,143 +1,751 @@
 import pandas as pd
 import numpy as np
-import re
-from rank_bm25 import BM25Okapi
-from sentence_transformers import SentenceTransformer, util
-import torch
+import os
+import threading
+import time
+from contextlib import contextmanager
+from index_store import DocTable, build_tables, empty_frame, read_manifest, read_sources, snapshot_path
+from batching import EncodeScheduler
+from cache import LRUCache
+from metrics import NULL_TRACE, SearchMetrics, process_memory
+from paging import ResultStream, check_state, decode_cursor, encode_cursor
+from profiles import build_profiles, load_profiles
+from segments import BASE_SEGMENT, SegmentedDocs, combine_segments, index_version, load_segments
+from lexical_index import tokenize
+from aggregate import aggregate_arrays
+from dense_index import DEFAULT_NPROBE, DenseIndex, reciprocal_rank_fusion
+from embeddings import MODEL_NAME, load_embeddings
+from encoders import load_encoder
+
+# Candidate retrieval ahead of the reranker: BM25 alone, or BM25 fused with
+# the dense index (search_hybrid)
+FIRST_STAGES = ("bm25", "hybrid")
+
+
+class IndexState:
+    """
+    Everything searches read from one version of the index. A reload builds
+    a new state and publishes it with a single assignment to engine.state,
+    so a search that takes the state once sees documents, BM25 indexes,
+    embeddings, dense indexes and profiles of the same version throughout,
+    however a reload interleaves with it. Never modified once published;
+    replace() makes a changed copy.
+    """
+
+    FIELDS = ("version", "violations", "bm25_viol", "reviews", "bm25_rev", "doc_embeddings", "dense_indexes",
+              "profiles", "pool")
+
+    def __init__(self, version, violations=None, bm25_viol=None, reviews=None, bm25_rev=None, doc_embeddings=None,
+                 dense_indexes=None, profiles=None, pool=None):
+        self.version = version
+        self.violations, self.bm25_viol = violations, bm25_viol
+        self.reviews, self.bm25_rev = reviews, bm25_rev
+        self.doc_embeddings = doc_embeddings if doc_embeddings is not None else {}
+        self.dense_indexes = dense_indexes if dense_indexes is not None else {}
+        self.profiles = profiles
+        # Shard workers serving this version (ShardedEngine)
+        self.pool = pool
+        # Facet values, memoized for this version
+        self.facets = {}
+
+    def replace(self, **changes):
+        fields = {name: getattr(self, name) for name in self.FIELDS}
+        fields.update(changes)
+        return IndexState(**fields)
+
 
 class SaferBitesEngine:
-    def __init__(self, data_dir="data", use_reranker=True):
+    # Startup phases, in order: the manifest and segment state, the BM25
+    # indexes and document tables, the business profiles, the precomputed
+    # embeddings and dense indexes, and the reranker model
+    PHASES = ("metadata", "lexical", "profiles", "dense", "model")
+
+    def __init__(self, data_dir="data", use_reranker=True, result_cache_size=1024, embedding_cache_size=4096,
+                 cache_ttl=None, encode_batch_size=64, encode_wait_ms=2.0, encoder_backend="torch",
+                 encoder_threads=None, background=False, metrics=False, slow_query_ms=None,
+                 slow_query_log=None, page_cache_size=256, first_stage="bm25"):
+        """
+        background=True returns at once and loads the engine on a thread:
+        searches are BM25-only until the reranker model is loaded, and
+        index_ready/model_ready tell when each stage can be used.
+        metrics=True instruments searches (see metrics_text); with
+        slow_query_ms, searches slower than that are logged to
+        slow_query_log (JSON lines) or stdout.
+        first_stage="hybrid" makes search(), search_page() and
+        iter_results() fetch candidates with search_hybrid whenever dense
+        indexes are loaded and the reranker is ready (see retrieve).
+        """
+        if first_stage not in FIRST_STAGES:
+            raise ValueError(f"Unknown first stage {first_stage!r}; expected one of {', '.join(FIRST_STAGES)}")
+        self.first_stage = first_stage
         self.data_dir = data_dir
         self.use_reranker = use_reranker
-        
-        # Load Data
-        print("Loading data...")
-        self.violations = pd.read_csv(f"{data_dir}/violations_processed.csv").fillna("")
-        self.reviews = pd.read_csv(f"{data_dir}/reviews_processed.csv").fillna("")
-        
-        # Create BM25 indices
-        print("Building BM25 indices...")
-        self.viol_corpus = [self._tokenize(t) for t in self.violations["text"]]
-        self.bm25_viol = BM25Okapi(self.viol_corpus)
-        
-        if not self.reviews.empty:
-            self.rev_corpus = [self._tokenize(t) for t in self.reviews["text"]]
-            self.bm25_rev = BM25Okapi(self.rev_corpus)
+        self.encode_batch_size, self.encode_wait_ms = encode_batch_size, encode_wait_ms
+        self.encoder_backend, self.encoder_threads = encoder_backend, encoder_threads
+
+        # Aggregated results are only valid for the index version they came
+        # from; query embeddings only depend on the model and its backend.
+        self.result_cache = LRUCache(result_cache_size, cache_ttl)
+        self.embedding_cache = LRUCache(embedding_cache_size, cache_ttl, version=(MODEL_NAME, encoder_backend))
+        # Result streams of paged searches, waiting for their next page
+        self.page_cache = LRUCache(page_cache_size, cache_ttl)
+
+        # None when off, so the search path only pays for an attribute check
+        self.metrics = None
+        if metrics or slow_query_ms is not None:
+            self.metrics = SearchMetrics(slow_query_ms, slow_query_log)
+
+        self.model = self.encoder = None
+        # The loaded index (an IndexState), None until it is
+        self.state = None
+        self.timings = {}
+        self.status = "starting"
+        self.error = None
+        self.index_ready = threading.Event()
+        self.model_ready = threading.Event()
+        self.started = threading.Event()
+        # Background threads, for quiesce()
+        self._loader = self._watcher = None
+        # Interval of the index watcher, None until one is started
+        self.watch_interval = None
+        if background:
+            self._loader = threading.Thread(target=self._start, args=(True,), name="engine-startup", daemon=True)
+            self._loader.start()
         else:
-            self.bm25_rev = None
-            
-        # Load Reranker
-        if self.use_reranker:
-            print("Loading Reranker model...")
-            self.model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
-        
+            self._start()
+
+    def _start(self, background=False):
+        started = time.perf_counter()
+        try:
+            self._load_index()
+            self.index_ready.set()
+            self.status = "warming"
+            if self.use_reranker:
+                self._load_model()
+            self.model_ready.set()
+            self.status = "ready"
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            # Without the model the engine keeps serving BM25 results
+            self.status = "degraded" if self.index_ready.is_set() else "failed"
+            if not background:
+                raise
+            print(f"Engine startup failed: {self.error}")
+        finally:
+            self.timings["total"] = time.perf_counter() - started
+            self.started.set()
+        print(self.startup_report())
+
+    @contextmanager
+    def _phase(self, name):
+        started = time.perf_counter()
+        yield
+        self.timings[name] = time.perf_counter() - started
+
+    def startup_report(self):
+        """Seconds spent in each startup phase (the latest load of the index)."""
+        lines = ["Engine startup:"]
+        for phase in self.PHASES + ("total",):
+            if phase in self.timings:
+                lines.append(f"  {phase:<9} {self.timings[phase]:7.3f}s")
+        return "\n".join(lines)
+
+    def readiness(self):
+        """
+        Startup status for health checks: "starting", "warming" (BM25 only
+        while the model loads), "ready", "degraded" (BM25 only, the model
+        failed to load) or "failed".
+        """
+        return {
+            "status": self.status,
+            "index_ready": self.index_ready.is_set(),
+            "reranker_ready": self.model_ready.is_set() and self.use_reranker,
+            "index_version": self.index_version,
+            "timings": dict(self.timings),
+            "error": self.error,
+        }
+
+    def wait_ready(self, timeout=None):
+        """Blocks until startup has finished (ready or not); returns True if fully ready."""
+        self.started.wait(timeout)
+        return self.model_ready.is_set()
+
+    # Read-only views of the current state, for callers that need no
+    # consistency across several reads
+    @property
+    def index_version(self):
+        return self.state.version if self.state is not None else None
+
+    @property
+    def violations(self):
+        return self.state.violations
+
+    @property
+    def bm25_viol(self):
+        return self.state.bm25_viol
+
+    @property
+    def reviews(self):
+        return self.state.reviews
+
+    @property
+    def bm25_rev(self):
+        return self.state.bm25_rev
+
+    @property
+    def doc_embeddings(self):
+        return self.state.doc_embeddings
+
+    @property
+    def dense_indexes(self):
+        return self.state.dense_indexes
+
+    @property
+    def profiles(self):
+        return self.state.profiles
+
+    @property
+    def reranking(self):
+        # Falls back to BM25 order until the model is loaded
+        return self.use_reranker and self.model_ready.is_set()
+
+    def _load_model(self):
+        with self._phase("model"):
+            # float32 torch, int8 or onnx; see encoders.py for the quality check
+            print(f"Loading Reranker model ({self.encoder_backend})...")
+            model = load_encoder(self.encoder_backend, MODEL_NAME, self.encoder_threads)
+            # Concurrent requests' encode calls are merged into shared batches;
+            # encode_wait_ms=None encodes each call on its own
+            if self.encode_wait_ms is not None:
+                self.encoder = EncodeScheduler(model, self.encode_batch_size, self.encode_wait_ms)
+            self.model = model
         print("Engine initialized.")
 
+    def _load_index(self):
+        with self._phase("metadata"):
+            version = index_version(self.data_dir)
+            manifest = read_manifest(self.data_dir)
+
+        with self._phase("lexical"):
+            tables = load_segments(self.data_dir, manifest)
+            snapshot = tables is not None
+            if snapshot:
+                print("Loaded index snapshot.")
+            else:
+                print("Index snapshot missing or stale; building BM25 indices from CSVs...")
+                frames = read_sources(self.data_dir)
+                tables = combine_segments({source: [(BASE_SEGMENT, docs, index)]
+                                           for source, (docs, index) in build_tables(frames).items()})
+
+            violations, bm25_viol = tables["violation"]
+            businesses = violations.businesses
+            empty = SegmentedDocs([DocTable.from_frame(empty_frame(), businesses)], businesses)
+            reviews, bm25_rev = tables.get("review", (empty, None))
+            if reviews.empty:
+                bm25_rev = None
+
+        with self._phase("profiles"):
+            profiles = load_profiles(self.data_dir, manifest) if snapshot else build_profiles(frames)
+
+        with self._phase("dense"):
+            doc_embeddings = load_embeddings(self.data_dir, manifest) if snapshot else {}
+            # Dense first stage over the precomputed embeddings (base snapshot only;
+            # delta segments are covered once compacted and re-embedded)
+            dense_indexes = {
+                source: DenseIndex.load(os.path.join(snapshot_path(self.data_dir, manifest), source), store.vectors)
+                for source, store in doc_embeddings.items()
+            }
+
+        self._publish(IndexState(version, violations, bm25_viol, reviews, bm25_rev, doc_embeddings, dense_indexes,
+                                 profiles))
+
+    def _publish(self, state):
+        # The one place the index changes under running searches
+        self.state = state
+        self.result_cache.sync(state.version)
+        self.page_cache.sync(state.version)
+
+    def refresh(self):
+        """
+        Reloads the index if a new snapshot or delta segment was published
+        since it was loaded. Returns True if it reloaded.
+        """
+        if index_version(self.data_dir) == self.index_version:
+            return False
+        self._load_index()
+        return True
+
+    def start_index_watcher(self, interval=30):
+        """
+        Background thread that picks up new segments every `interval` seconds
+        without a restart. The server never writes the index: compaction runs
+        offline (`ingest.py --compact`) and is picked up like any snapshot.
+        Threads do not survive fork(): a forked server worker calls this again
+        with `watch_interval` to get its own.
+        """
+        def watch(stop):
+            while not stop.wait(interval):
+                if not self.index_ready.is_set():
+                    continue
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"Index refresh failed: {e}")
+
+        self.watch_interval = interval
+        self._watcher_stop = threading.Event()
+        self._watcher = threading.Thread(target=watch, args=(self._watcher_stop,), name="index-watcher", daemon=True)
+        self._watcher.start()
+        return self._watcher
+
+    def quiesce(self):
+        """
+        Stops the engine's background threads (startup loader, index
+        watcher, encode scheduler), waiting for a reload or encode batch in
+        progress, so the process can fork with no thread holding a lock or
+        halfway through publishing an index. Forked server workers restart
+        the watcher themselves (start_index_watcher) and the scheduler starts
+        again on its first encode; this process must not search afterwards.
+        """
+        if self._loader is not None:
+            self._loader.join()
+        if self._watcher is not None:
+            self._watcher_stop.set()
+            self._watcher.join()
+            self._watcher = None
+        if self.encoder is not None:
+            self.encoder.stop()
+
+    def facet_values(self, field):
+        return self.bm25_viol.facet_values(field)
+
+    def business_profile(self, business_id):
+        """
+        A business' safety profile: documents and tag counts per source, risk
+        score, latest inspection and most recent violations (see profiles.py).
+        None for an unknown business.
+        """
+        return self.profiles.profile(business_id)
+
+    def top_risk(self, tag=None, zipcode=None, boro=None, limit=10):
+        """
+        The `limit` riskiest businesses as profile summaries; with a tag,
+        those with most violations of it. zipcode and boro narrow it down.
+        """
+        return self.profiles.leaderboard(tag, zipcode, boro, limit)
+
+    def set_bm25_params(self, k1, b):
+        """
+        Scores with other BM25 k1/b (e.g. for parameter sweeps) until the
+        index is reloaded; cached results are dropped.
+        """
+        state = self.state
+        for index in (state.bm25_viol, state.bm25_rev):
+            if index is not None:
+                index.set_bm25_params(k1, b)
+        self.result_cache.clear()
+
     def _tokenize(self, text):
-        return re.findall(r'\w+', str(text).lower())
+        return tokenize(text)
+
+    def search(self, query, top_k=30, filters=None, top_n=None, max_evidence=None, first_stage=None):
+        """
+        retrieve -> rerank -> aggregate_results. Results are cached by
+        normalized query tokens, filters and parameters until the index
+        version changes; callers must not modify them.
+        """
+        return self._search(query, top_k, filters, top_n, max_evidence, first_stage)[0]
+
+    def _search(self, query, top_k, filters, top_n, max_evidence, first_stage):
+        # search(), plus whether more businesses than those returned match
+        # (past top_n, or deeper than top_k), for search_page's first page.
+        # Every stage reads the index version the key names
+        state = self.state
+        stage = self._first_stage(first_stage, state)
+        key = (state.version, tuple(self._tokenize(query)), filter_key(filters), top_k, top_n, max_evidence,
+               self.reranking, stage)
+        trace = self.metrics.trace(query, filters) if self.metrics is not None else NULL_TRACE
+        entry = self.result_cache.get(key)
+        cached = entry is not None
+        if not cached:
+            hits = self.retrieve(query, top_k, filters, stage, state)
+            trace.mark(f"search_{stage}")
+            trace.count(hits)
+            per_source = {}
+            for r in hits:
+                per_source[r["source"]] = per_source.get(r["source"], 0) + 1
+            hits = self.rerank(query, hits, state=state)
+            trace.mark("rerank")
+            results = self.aggregate_results(hits, query, top_n=top_n, max_evidence=max_evidence)
+            trace.mark("aggregate_results")
+            more = (len({r["business_id"] for r in hits}) > len(results)
+                    or any(n >= top_k for n in per_source.values()))
+            entry = (results, more)
+            self.result_cache.put(key, entry)
+        trace.finish(cached)
+        return entry
+
+    def search_page(self, query=None, filters=None, page_size=10, cursor=None, top_k=30, max_evidence=None,
+                    first_stage=None):
+        """
+        One page of search() results: {"results": [...], "next_cursor": ...}.
+        Pass next_cursor back (query, filters and first stage come from it)
+        for the next page; it is None after the last one. Candidates are
+        only fetched and reranked as deep as the pages so far need, and the
+        query's state is kept for the next page. Cursors hold no server
+        state: if it was evicted, the earlier pages are recomputed. A first
+        page that fills up is search(top_n=page_size), from its cache.
+        """
+        if cursor is not None:
+            state = decode_cursor(cursor)
+        else:
+            state = check_state({"q": query, "f": filters or {}, "o": 0, "n": page_size, "k": top_k,
+                                 "e": max_evidence, "s": first_stage})
+        query, filters, page_size, top_k = state["q"], state.get("f") or None, state["n"], state.get("k") or top_k
+        if state["o"] == 0:
+            results, more = self._search(query, top_k, filters, page_size, state.get("e"), state.get("s"))
+            if len(results) == page_size or not more:
+                next_cursor = encode_cursor(dict(state, o=len(results))) if more else None
+                return {"results": results, "next_cursor": next_cursor}
+            # Fewer businesses than a page at this depth: the stream deepens
+
+        index = self.state
+        stage = self._first_stage(state.get("s"), index)
+        key = (index.version, tuple(self._tokenize(query)), filter_key(filters), top_k, state.get("e"),
+               self.reranking, stage)
+        trace = self.metrics.trace(query, filters) if self.metrics is not None else NULL_TRACE
+        stream = self.page_cache.pop(key + (state["o"],))
+        if stream is None:
+            stream = ResultStream(self, query, filters, top_k, state.get("e"), index, stage)
+            # Earlier pages again, so that this one starts where they ended
+            stream.next(state["o"], trace)
+        results = stream.next(page_size, trace)
+        # A page handed out from the stream's kept businesses ran no stage
+        trace.finish(cached=not trace.stages)
+        next_cursor = None
+        if not stream.done():
+            state = dict(state, o=stream.position)
+            next_cursor = encode_cursor(state)
+            self.page_cache.put(key + (stream.position,), stream)
+        return {"results": results, "next_cursor": next_cursor}
+
+    def iter_results(self, query, filters=None, top_k=30, batch_size=100, max_evidence=None, first_stage=None):
+        """
+        Every business matching the query, in rank order, computed batch_size
+        at a time (e.g. for exports). Businesses are not kept once yielded.
+        Each batch is traced like a page of search_page.
+        """
+        state = self.state
+        stream = ResultStream(self, query, filters, top_k, max_evidence, state, first_stage)
+        while not stream.done():
+            trace = self.metrics.trace(query, filters) if self.metrics is not None else NULL_TRACE
+            batch = stream.next(batch_size, trace)
+            trace.finish(cached=not trace.stages)
+            if not batch:
+                return
+            yield from batch
+
+    def cache_stats(self):
+        return {"results": self.result_cache.stats(), "query_embeddings": self.embedding_cache.stats(),
+                "pages": self.page_cache.stats()}
+
+    def metrics_text(self):
+        """Prometheus text format: search instrumentation plus cache, encoder, memory and index gauges."""
+        if self.metrics is None:
+            return None
+        resident, virtual = process_memory()
+        caches = self.cache_stats()
+        gauges = [
+            ("process_resident_memory_bytes", "Resident memory size in bytes.", [([], resident)]),
+            ("process_virtual_memory_bytes", "Virtual memory size in bytes.", [([], virtual)]),
+            ("saferbites_cache_entries", "Entries held by each cache.",
+             [([("cache", name)], stats["size"]) for name, stats in caches.items()]),
+            ("saferbites_cache_hit_ratio", "Hit rate of each cache since start.",
+             [([("cache", name)], stats["hit_rate"]) for name, stats in caches.items()]),
+            ("saferbites_ready", "1 once the startup phase is done.",
+             [([("phase", "index")], int(self.index_ready.is_set())),
+              ([("phase", "reranker")], int(self.model_ready.is_set()))]),
+        ]
+        if self.index_ready.is_set():
+            gauges += self._index_gauges()
+        counters = [
+            (f"saferbites_cache_{field}_total", f"Cache {field}.",
+             [([("cache", name)], stats[field]) for name, stats in caches.items()])
+            for field in ("hits", "misses", "evictions")
+        ]
+        if self.encoder is not None:
+            encoder = self.encoder_stats()
+            counters.append(("saferbites_encoder_batches_total", "Forward passes run by the encode scheduler.",
+                             [([], encoder["batches"])]))
+            counters.append(("saferbites_encoder_texts_total", "Texts encoded by the encode scheduler.",
+                             [([], encoder["texts"])]))
+            gauges.append(("saferbites_encoder_queued", "Encode jobs waiting for a batch.",
+                           [([], encoder["queued"])]))
+        return self.metrics.render(gauges, counters)
 
-    def search_bm25(self, query, top_k=30):
+    def _index_gauges(self):
+        return [("saferbites_index_segments", "Delta segments on top of the base snapshot.",
+                 [([], len(self.bm25_viol.indexes) - 1)])]
+
+    def _first_stage(self, first_stage, state):
+        # The first stage a search runs: hybrid needs the query embedding,
+        # so the reranker, and a dense index
+        first_stage = first_stage or self.first_stage
+        if first_stage not in FIRST_STAGES:
+            raise ValueError(f"Unknown first stage {first_stage!r}; expected one of {', '.join(FIRST_STAGES)}")
+        if first_stage == "hybrid" and not (self.reranking and state.dense_indexes):
+            return "bm25"
+        return first_stage
+
+    def retrieve(self, query, top_k=30, filters=None, first_stage=None, state=None):
+        """
+        First-stage candidates: search_bm25, or with first_stage="hybrid"
+        (default: the engine's) search_hybrid at the same depth for BM25 and
+        the dense index. Hybrid falls back to BM25 until it can run.
+        """
+        state = state or self.state
+        if self._first_stage(first_stage, state) == "hybrid":
+            return self.search_hybrid(query, top_k, dense_k=top_k, filters=filters, state=state)
+        return self.search_bm25(query, top_k, filters, state)
+
+    def search_bm25(self, query, top_k=30, filters=None, state=None):
+        """
+        filters: optional {"boro", "zipcode", "tag", "source": value or list};
+        applied to the postings before scoring. state: the IndexState to
+        search (default: the current one).
+        """
         tokenized_query = self._tokenize(query)
         
         results = []
         
-        # Search Violations
-        if not self.violations.empty:
-            scores = self.bm25_viol.get_scores(tokenized_query)
-            top_n = np.argsort(scores)[::-1][:top_k]
-            for idx in top_n:
-                if scores[idx] > 0:
-                    row = self.violations.iloc[idx]
-                    results.append({
-                        "doc_id": row["doc_id"],
-                        "business_id": row["business_id"],
-                        "business_name": row["business_name"],
-                        "text": row["original_text"],
-                        "score": scores[idx],
-                        "source": "violation",
-                        "tags": row["tags"]
-                    })
-
-        # Search Reviews
-        if self.bm25_rev and not self.reviews.empty:
-            scores = self.bm25_rev.get_scores(tokenized_query)
-            top_n = np.argsort(scores)[::-1][:top_k]
-            for idx in top_n:
-                if scores[idx] > 0:
-                    row = self.reviews.iloc[idx]
-                    results.append({
-                        "doc_id": row["doc_id"],
-                        "business_id": row["business_id"],
-                        "business_name": row["business_name"],
-                        "text": row["original_text"],
-                        "score": scores[idx],
-                        "source": "review",
-                        "tags": row["tags"]
-                    })
+        for source, docs, index in self._sources(filters, state):
+            results += self._search_source(docs, index, tokenized_query, top_k, source, filters)
                     
         return results
 
-    def rerank(self, query, results):
-        if not results or not self.use_reranker:
+    def search_hybrid(self, query, top_k=30, dense_k=30, nprobe=DEFAULT_NPROBE, rrf_k=60, query_emb=None,
+                      filters=None, state=None):
+        """
+        BM25 and dense candidates fused per source with reciprocal rank
+        fusion. Falls back to plain BM25 when no dense index is available.
+        "score" holds the fused score; the stage scores are kept alongside.
+        """
+        state = state or self.state
+        if not self.reranking or not state.dense_indexes:
+            return self.search_bm25(query, top_k, filters, state)
+        tokenized_query = self._tokenize(query)
+        if query_emb is None:
+            query_emb = self.encode_query(query)
+
+        results = []
+        for source, docs, index in self._sources(filters, state):
+            lex_rows, lex_scores = index.top_k(tokenized_query, top_k, filters)
+            ranked = [lex_rows.tolist()]
+            dense_scores = {}
+            dense = state.dense_indexes.get(source)
+            if dense is not None:
+                # The dense index covers the base snapshot, whose rows come first
+                _, text_filter = index.base.filter_bitmaps(filters)
+                text_ids, scores = dense.search(query_emb, dense_k, nprobe=nprobe, doc_filter=text_filter)
+                dense_rows, scores = index.base.expand_texts(text_ids, scores, dense_k, filters)
+                ranked.append(dense_rows.tolist())
+                dense_scores = dict(zip(dense_rows.tolist(), scores.tolist()))
+            rows, fused = reciprocal_rank_fusion(ranked, k=rrf_k)
+            rows, fused = rows[:top_k], fused[:top_k]
+            bm25_scores = dict(zip(lex_rows.tolist(), lex_scores.tolist()))
+            for r in self._make_hits(docs, rows, fused, source):
+                r["bm25_score"] = bm25_scores.get(r["row"], 0.0)
+                if r["row"] in dense_scores:
+                    r["dense_score"] = dense_scores[r["row"]]
+                results.append(r)
+        return results
+
+    def search_batch(self, queries, top_k=30, batch_size=64, filters=None):
+        """
+        Runs search_bm25 -> rerank -> aggregate_results for many queries at
+        once. BM25 is scored for the whole batch in one pass per source and
+        the encoder sees all queries (and any candidates without precomputed
+        embeddings) in large batches. Returns one aggregated list per query.
+        """
+        queries = list(queries)
+        state = self.state
+        tokenized = [self._tokenize(q) for q in queries]
+        per_query = [[] for _ in queries]
+        for source, docs, index in self._sources(filters, state):
+            for qi, (rows, scores) in enumerate(index.top_k_batch(tokenized, top_k, filters)):
+                per_query[qi] += self._make_hits(docs, rows, scores, source)
+
+        if self.reranking and queries:
+            query_embs = self.encode_queries(queries, batch_size=batch_size)
+            # Candidates not covered by an embedding store are encoded once
+            # across the whole batch.
+            pending = {}
+            for results in per_query:
+                for r in results:
+                    if not self._embedded(r, state):
+                        pending.setdefault((r["source"], r["row"]), r["text"])
+            candidate_embs = {}
+            if pending:
+                vectors = self._encode(list(pending.values()), batch_size)
+                candidate_embs = dict(zip(pending.keys(), vectors))
+            per_query = [self.rerank(q, results, query_emb=query_embs[i], candidate_embs=candidate_embs, state=state)
+                         for i, (q, results) in enumerate(zip(queries, per_query))]
+
+        return [self.aggregate_results(results, q) for q, results in zip(queries, per_query)]
+
+    def _sources(self, filters=None, state=None):
+        state = state or self.state
+        sources = [("violation", state.violations, state.bm25_viol), ("review", state.reviews, state.bm25_rev)]
+        wanted = (filters or {}).get("source")
+        if isinstance(wanted, str):
+            wanted = [wanted]
+        return [(source, docs, index) for source, docs, index in sources
+                if index is not None and not docs.empty and (not wanted or source in wanted)]
+
+    def encode_query(self, query):
+        key = " ".join(str(query).split())
+        query_emb = self.embedding_cache.get(key)
+        if query_emb is None:
+            query_emb = self._encode([query])[0]
+            self.embedding_cache.put(key, query_emb)
+        return query_emb
+
+    def _encode(self, texts, batch_size=64):
+        if self.metrics is not None:
+            self.metrics.observe_encode(len(texts))
+        if self.encoder is not None:
+            return self.encoder.encode(texts)
+        return self.model.encode(texts, batch_size=batch_size, normalize_embeddings=True, convert_to_numpy=True)
+
+    def encoder_stats(self):
+        """Batch sizes and queue waits of the encode scheduler."""
+        return self.encoder.stats() if self.encoder is not None else {}
+
+    def encode_queries(self, queries, batch_size=64):
+        """encode_query for many queries; only cache misses go to the model, in one batched call."""
+        keys = [" ".join(str(q).split()) for q in queries]
+        query_embs = [self.embedding_cache.get(k) for k in keys]
+        missing = [i for i, emb in enumerate(query_embs) if emb is None]
+        if missing:
+            vectors = self._encode([queries[i] for i in missing], batch_size)
+            for i, emb in zip(missing, vectors):
+                query_embs[i] = emb
+                self.embedding_cache.put(keys[i], emb)
+        return query_embs
+
+    def _search_source(self, docs, index, tokenized_query, top_k, source, filters=None):
+        # Only documents sharing a term with the query (and passing the filters) are scored
+        rows, scores = index.top_k(tokenized_query, top_k, filters)
+        return self._make_hits(docs, rows, scores, source)
+
+    def _make_hits(self, docs, rows, scores, source):
+        # Hits decode doc_id/text lazily from the document store
+        return [docs.hit(idx, score, source) for idx, score in zip(rows.tolist(), scores.tolist())]
+
+    def rerank(self, query, results, query_emb=None, candidate_embs=None, filters=None, state=None):
+        state = state or self.state
+        if filters:
+            results = self.apply_filters(results, filters, state)
+        if not results or not self.reranking:
             return results
             
         # Embed query
-        query_emb = self.model.encode(query, convert_to_tensor=True)
-        
-        # Embed documents
-        texts = [r["text"] for r in results]
-        doc_embs = self.model.encode(texts, convert_to_tensor=True)
+        if query_emb is None:
+            query_emb = self.encode_query(query)
         
         # Compute cosine similarity
-        cosine_scores = util.cos_sim(query_emb, doc_embs)[0]
+        cosine_scores = self._doc_similarities(query_emb, results, candidate_embs, state)
         
         # Update scores
         for i, r in enumerate(results):
-            r["rerank_score"] = cosine_scores[i].item()
+            r["rerank_score"] = float(cosine_scores[i])
             
         # Sort by rerank score
         results = sorted(results, key=lambda x: x["rerank_score"], reverse=True)
         return results
 
-    def aggregate_results(self, results, query):
-        # Fusion Rule: score = (bm25 or rerank)
-        
-        keywords = self._tokenize(query)
+    def apply_filters(self, results, filters, state=None):
+        """Drops hits that do not pass the filters (for candidates from elsewhere)."""
+        keep = [False] * len(results)
+        for source, docs, index in self._sources(filters, state):
+            idx = [i for i, r in enumerate(results) if r["source"] == source]
+            allowed = index.allowed([results[i]["row"] for i in idx], filters).tolist()
+            for i, ok in zip(idx, allowed):
+                keep[i] = ok
+        return [r for r, ok in zip(results, keep) if ok]
+
+    def _doc_similarities(self, query_emb, results, candidate_embs=None, state=None):
+        state = state or self.state
+        scores = np.zeros(len(results), dtype=np.float32)
+        pending = []
+        for source in {r["source"] for r in results}:
+            idx = [i for i, r in enumerate(results) if r["source"] == source]
+            store = state.doc_embeddings.get(source)
+            if store is None:
+                pending += idx
+                continue
+            # Rows of delta segments come after the embedded base rows
+            pending += [i for i in idx if not self._embedded(results[i], state)]
+            idx = [i for i in idx if self._embedded(results[i], state)]
+            # Precomputed vectors: gather the candidate rows
+            scores[idx] = store.similarities(query_emb, [results[i]["row"] for i in idx])
+
+        if pending and candidate_embs is not None:
+            doc_embs = np.array([candidate_embs[(results[i]["source"], results[i]["row"])] for i in pending])
+            scores[pending] = doc_embs @ query_emb
+        elif pending:
+            # No embedding store for this source; encode the candidates
+            doc_embs = self._encode([results[i]["text"] for i in pending])
+            scores[pending] = doc_embs @ query_emb
+        return scores
+
+    def _embedded(self, hit, state=None):
+        store = (state or self.state).doc_embeddings.get(hit["source"])
+        return store is not None and hit["row"] < len(store.row_map)
+
+    def aggregate_results(self, results, query, top_n=None, max_evidence=None, fusion="sum"):
+        """
+        Groups hits by business. top_n limits the businesses returned and
+        max_evidence the evidence kept per business (best first); fusion
+        picks how document scores combine ("sum", "max" or "mean").
+        """
+        if not results:
+            return []
+
+        # Document score: the rerank score, else BM25
+        scores = np.array([r.get("rerank_score", r["score"]) for r in results], dtype=np.float64)
+        doc_masks = np.array([r.get("tag_mask", 0) for r in results], dtype=np.int64)
+
+        keys = [r.get("business_code") for r in results]
+        if any(k is None for k in keys):
+            keys = pd.factorize(pd.Series([str(r["business_id"]) for r in results]))[0]
         
-        business_map = {}
+        _, totals, first_seen, evidence, tag_masks = aggregate_arrays(
+            keys, scores, doc_masks, fusion=fusion, top_n=top_n, max_evidence=max_evidence)
         
-        for r in results:
-            bid = r["business_id"]
-            if bid not in business_map:
-                business_map[bid] = {
-                    "business_id": bid,
-                    "business_name": r["business_name"],
-                    "total_score": 0,
-                    "evidence": []
-                }
-            
-            # Determine base score
-            score = r.get("rerank_score", r["score"])
-            
-            # Apply category boost
-            # Check if any tag in document matches query keywords
-            boost = 1.0
-            doc_tags = str(r["tags"]).split(",")
-            
-            # Logic to check if query keywords match document tags could be added here.
-            # For now, we use a simple score summation.
-            if r["tags"]:
-                pass 
-                
-            fused_score = score
-            
-            business_map[bid]["total_score"] += fused_score
-            business_map[bid]["evidence"].append(r)
-            
-        # Sort businesses by score
-        ranked_businesses = sorted(business_map.values(), key=lambda x: x["total_score"], reverse=True)
+        # Output dicts only for the businesses returned
+        ranked_businesses = []
+        for total, first, ev, mask in zip(totals.tolist(), first_seen.tolist(), evidence, tag_masks.tolist()):
+            r = results[first]
+            ranked_businesses.append({
+                "business_id": r["business_id"],
+                "business_name": r["business_name"],
+                "total_score": total,
+                "tag_mask": mask,
+                "evidence": [results[i] for i in ev.tolist()]
+            })
         return ranked_businesses
 
+def filter_key(filters):
+    """Hashable, order-insensitive form of a filters dict, for cache keys."""
+    items = []
+    for field, wanted in (filters or {}).items():
+        if wanted is None or wanted == "" or wanted == []:
+            continue
+        values = [wanted] if isinstance(wanted, str) else wanted
+        items.append((field, tuple(sorted(str(v).strip() for v in values))))
+    return tuple(sorted(items))
+
 if __name__ == "__main__":
     engine = SaferBitesEngine()
     q = "rat sighting"
@@ -0,0 +1,230 @@
+import json
+import os
+
+import numpy as np
+
+from index_store import (SOURCES, DocTable, SourceIndex, load_businesses, load_snapshot, read_manifest,
+                         snapshot_path)
+from lexical_index import LexicalIndex, select_top_k
+
+SEGMENTS_DIRNAME = "segments"
+BASE_SEGMENT = "base"
+
+
+def empty_state():
+    return {"generation": 0, "segments": [], "deleted": {}}
+
+
+def read_segment_state(snapshot_dir):
+    """
+    The delta segments published on top of a snapshot, oldest first, and the
+    tombstoned rows of every segment ({source: {segment: [rows]}}, the base
+    snapshot included).
+    """
+    path = os.path.join(snapshot_dir, "segments.json")
+    if not os.path.exists(path):
+        return empty_state()
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_segment_state(snapshot_dir, state):
+    # Replaced atomically; readers see the old or the new segment list
+    tmp = os.path.join(snapshot_dir, "segments.json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, os.path.join(snapshot_dir, "segments.json"))
+
+
+def segment_dir(snapshot_dir, name):
+    if name == BASE_SEGMENT:
+        return snapshot_dir
+    return os.path.join(snapshot_dir, SEGMENTS_DIRNAME, name)
+
+
+def index_version(data_dir):
+    """Changes whenever a new snapshot or delta segment is published."""
+    manifest = read_manifest(data_dir)
+    if manifest is None or "path" not in manifest:
+        return None
+    return manifest["path"], read_segment_state(snapshot_path(data_dir, manifest))["generation"]
+
+
+class SegmentedDocs:
+    """
+    The DocTables of a source's segments viewed as one table: rows are
+    numbered consecutively across segments and business codes refer to one
+    business table covering all of them.
+    """
+
+    def __init__(self, tables, businesses):
+        self.tables = tables
+        self.businesses = businesses
+        self.offsets = np.zeros(len(tables) + 1, dtype=np.int64)
+        np.cumsum([len(t) for t in tables], out=self.offsets[1:])
+        self.code_maps = [None if np.array_equal(t.businesses, businesses)
+                          else np.searchsorted(businesses, t.businesses).astype(np.int32)
+                          for t in tables]
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def empty(self):
+        return len(self) == 0
+
+    def locate(self, i):
+        """(segment, row within the segment) of a row."""
+        s = int(np.searchsorted(self.offsets, i, side="right")) - 1
+        return s, i - int(self.offsets[s])
+
+    def business_id(self, i):
+        s, row = self.locate(i)
+        return self.tables[s].business_id(row)
+
+    def row(self, i):
+        s, row = self.locate(i)
+        return self.tables[s].row(row)
+
+    def hit(self, i, score, source):
+        s, row = self.locate(i)
+        hit = self.tables[s].hit(row, score, source)
+        hit["row"] = i
+        if self.code_maps[s] is not None:
+            hit["business_code"] = int(self.code_maps[s][hit["business_code"]])
+        return hit
+
+
+def share_corpus_stats(indexes, term_keys=None):
+    """
+    Sets BM25 statistics (N, document frequencies, average length) of all
+    live documents of the given SourceIndexes on each of them, so that each
+    scores as part of one index rebuilt over them all. term_keys (one array
+    per index, a key per vocabulary term) orders the global vocabulary when
+    the indexes' documents are not simply consecutive; the idf's epsilon
+    floor averages over it, so the order decides the last bits of scores.
+    """
+    # Global term ids in first-seen order across indexes, as if their
+    # documents had been indexed one after the other
+    term_ids, parts = {}, []
+    corpus_size = total_len = 0
+    for index in indexes:
+        lexical, counts = index.lexical, index.live_counts
+        corpus_size += int(counts.sum())
+        total_len += int(np.dot(lexical.doc_len.astype(np.int64), counts))
+        ids = np.array([term_ids.setdefault(t, len(term_ids)) for t in lexical.vocab], dtype=np.int64)
+        parts.append((ids, lexical.corpus_df(counts)))
+    if term_keys is not None:
+        first = np.full(len(term_ids), np.iinfo(np.int64).max)
+        for (ids, _), keys in zip(parts, term_keys):
+            np.minimum.at(first, ids, keys)
+        rank = np.empty(len(term_ids), dtype=np.int64)
+        rank[np.argsort(first, kind="stable")] = np.arange(len(term_ids))
+        parts = [(rank[ids], local_df) for ids, local_df in parts]
+    df = np.zeros(len(term_ids))
+    for ids, local_df in parts:
+        df[ids] += local_df
+    # Terms left only in tombstoned documents are no longer in the corpus
+    present = df > 0
+    idf = np.zeros(len(term_ids))
+    idf[present] = LexicalIndex._calc_idf(df[present].astype(np.int64), corpus_size)
+    avgdl = float(total_len) / corpus_size if corpus_size else 0.0
+    for index, (ids, _) in zip(indexes, parts):
+        index.lexical.set_corpus_stats(idf[ids], avgdl)
+
+
+class SegmentedIndex:
+    """
+    A source's SourceIndex segments (base snapshot, then deltas) searched as
+    one. BM25 statistics (N, document frequencies, average length) are those
+    of all live documents together, so scores are the same as for one index
+    rebuilt over them.
+    """
+
+    def __init__(self, indexes, offsets):
+        self.indexes = indexes
+        self.offsets = offsets
+        if len(indexes) > 1 or any(index.live_rows is not None for index in indexes):
+            share_corpus_stats(indexes)
+
+    @property
+    def base(self):
+        """The snapshot segment; its rows come first, so they need no renumbering."""
+        return self.indexes[0]
+
+    def set_bm25_params(self, k1, b):
+        for index in self.indexes:
+            index.lexical.set_params(k1, b)
+
+    def facet_values(self, field):
+        return sorted(set().union(*[index.facets.values(field) for index in self.indexes]))
+
+    def allowed(self, rows, filters=None):
+        """Whether each (global) document row passes the filters."""
+        rows = np.asarray(rows, dtype=np.int64)
+        out = np.zeros(len(rows), dtype=bool)
+        seg = np.searchsorted(self.offsets, rows, side="right") - 1
+        for s in np.unique(seg).tolist():
+            picked = seg == s
+            out[picked] = self.indexes[s].allowed(rows[picked] - self.offsets[s], filters)
+        return out
+
+    def top_k(self, query_tokens, k, filters=None):
+        if len(self.indexes) == 1:
+            return self.base.top_k(query_tokens, k, filters)
+        # Each segment's top k, merged; ties still go to the lower row
+        parts = [index.top_k(query_tokens, k, filters) for index in self.indexes]
+        return self._merge(parts, k)
+
+    def top_k_batch(self, queries_tokens, k, filters=None):
+        if len(self.indexes) == 1:
+            return self.base.top_k_batch(queries_tokens, k, filters)
+        per_segment = [index.top_k_batch(queries_tokens, k, filters) for index in self.indexes]
+        return [self._merge(parts, k) for parts in zip(*per_segment)]
+
+    def _merge(self, parts, k):
+        rows = np.concatenate([r + self.offsets[s] for s, (r, _) in enumerate(parts)])
+        scores = np.concatenate([sc for _, sc in parts])
+        return select_top_k(rows, scores, k)
+
+
+def combine_segments(parts, deleted=None):
+    """
+    {source: [(segment name, DocTable, SourceIndex)]} ->
+    {source: (SegmentedDocs, SegmentedIndex)}, with tombstones applied.
+    """
+    deleted = deleted or {}
+    tables = [docs for segments in parts.values() for _, docs, _ in segments]
+    businesses = np.unique(np.concatenate([docs.businesses for docs in tables])) if tables else np.zeros(0, dtype=str)
+    combined = {}
+    for source, segments in parts.items():
+        for name, _, index in segments:
+            index.set_deleted(deleted.get(source, {}).get(name, []))
+        docs = SegmentedDocs([d for _, d, _ in segments], businesses)
+        combined[source] = (docs, SegmentedIndex([i for _, _, i in segments], docs.offsets))
+    return combined
+
+
+def load_segments(data_dir, manifest=None):
+    """
+    The snapshot plus every delta segment published on top of it, as
+    {source: (SegmentedDocs, SegmentedIndex)}; None when the snapshot is
+    missing or stale.
+    """
+    if manifest is None:
+        manifest = read_manifest(data_dir)
+    snapshot = load_snapshot(data_dir, manifest)
+    if snapshot is None:
+        return None
+    snapshot_dir = snapshot_path(data_dir, manifest)
+    state = read_segment_state(snapshot_dir)
+    parts = {source: [(BASE_SEGMENT, docs, index)] for source, (docs, index) in snapshot.items()}
+    for name in state["segments"]:
+        path = segment_dir(snapshot_dir, name)
+        businesses = load_businesses(path)
+        for source in SOURCES:
+            source_dir = os.path.join(path, source)
+            if os.path.isdir(source_dir):
+                parts.setdefault(source, []).append(
+                    (name, DocTable.load(source_dir, businesses), SourceIndex.load(source_dir)))
+    return combine_segments(parts, state["deleted"])
@@ -0,0 +1,511 @@
+"""
+Sharded serving: documents are partitioned by business id hash into N
+shards, each with its own BM25 index, document table and slice of the
+precomputed embeddings, and each served by its own worker process. A query
+fans out to every shard, each returns its top k, and the coordinator merges
+them into the global top k.
+
+Every shard scores with the BM25 statistics of the whole corpus (set at
+build time), so scores are comparable across shards and the merged ranking
+is the one a single index would give. A business' documents all live in one
+shard and business codes refer to one table shared by all shards, so
+aggregation across shards needs nothing extra.
+
+    python3 src/shards.py --data-dir data --shards 4
+    SAFERBITES_SHARDS=4 python3 ui/app.py
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import weakref
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+import pandas as pd
+
+from embeddings import EmbeddingStore, load_embeddings
+from index_store import (FORMAT_VERSION, INDEX_DIRNAME, SOURCES, DocTable, SourceIndex, business_table, is_stale,
+                         load_businesses, read_manifest, read_sources, save_businesses, snapshot_path,
+                         source_fingerprint, write_source)
+from lexical_index import select_top_k
+from facets import FACET_FIELDS, normalize_value
+from profiles import PROFILES_DIRNAME, ProfileTable, build_profiles
+from retrieval import IndexState, SaferBitesEngine
+from segments import read_segment_state, share_corpus_stats
+from tagger import TAG_BITS
+
+DEFAULT_SHARDS = 4
+SHARD_MANIFEST = "shards.json"
+# How long a replaced shard set keeps serving searches that started on it
+RETIRE_SECONDS = 60
+
+# Live pools, reset in forked children (see ShardPool)
+_pools = weakref.WeakSet()
+
+
+def _reset_pools():
+    for pool in list(_pools):
+        pool._reset()
+
+
+os.register_at_fork(after_in_child=_reset_pools)
+
+
+def shard_of(business_ids, n_shards):
+    """Shard of each business id; stable across runs and machines."""
+    hashes = pd.util.hash_pandas_object(pd.Series(business_ids, dtype=object).astype(str), index=False)
+    return (hashes.to_numpy() % np.uint64(n_shards)).astype(np.int32)
+
+
+def first_seen(index, source_rows):
+    """
+    Sort key of each vocabulary term of a shard's SourceIndex: the source
+    row where it first occurs, then its order within the shard's vocabulary.
+    """
+    lexical = index.lexical
+    # Texts are numbered by first occurrence, so a term's lowest text id is
+    # its earliest text
+    first_text = np.minimum.reduceat(np.asarray(lexical.doc_ids), np.asarray(lexical.offsets[:-1]))
+    first_row = source_rows[index.groups.first_rows()[first_text]]
+    return first_row.astype(np.int64) * len(lexical.vocab) + np.arange(len(lexical.vocab))
+
+
+def read_shard_manifest(data_dir):
+    path = os.path.join(data_dir, INDEX_DIRNAME, SHARD_MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def shard_path(data_dir, manifest, shard=None):
+    path = os.path.join(data_dir, INDEX_DIRNAME, manifest["path"])
+    return path if shard is None else os.path.join(path, f"shard-{shard}")
+
+
+def build_shards(data_dir, n_shards=DEFAULT_SHARDS):
+    """
+    Partitions the processed documents into n_shards shards under
+    data/index/shards-<time>/ and switches data/index/shards.json over to
+    them. Embeddings are sliced from the index snapshot when it has
+    up-to-date ones; otherwise the reranker encodes candidates per query.
+    """
+    index_dir = os.path.join(data_dir, INDEX_DIRNAME)
+    os.makedirs(index_dir, exist_ok=True)
+    name = f"shards-{time.time_ns()}"
+    manifest = {"format_version": FORMAT_VERSION, "created": time.time(), "path": name,
+                "num_shards": n_shards, "sources": {}}
+
+    frames = read_sources(data_dir)
+    if not frames:
+        raise FileNotFoundError(f"No processed CSVs in {data_dir}; run normalize.py first")
+    snapshot = read_manifest(data_dir)
+    stores = {}
+    if not is_stale(data_dir, snapshot):
+        # The snapshot was built from these CSVs, so its rows are theirs
+        stores = load_embeddings(data_dir, snapshot)
+        pending = read_segment_state(snapshot_path(data_dir, snapshot))["segments"]
+        if pending:
+            print(f"{len(pending)} delta segment(s) are not sharded; run `ingest.py --compact` first to include them.")
+
+    businesses = business_table(frames.values())
+    print(f"Partitioning {', '.join(SOURCES[s] for s in frames)} into {n_shards} shards...")
+    for source, df in frames.items():
+        assigned = shard_of(df["business_id"], n_shards)
+        parts = []
+        for shard in range(n_shards):
+            rows = np.flatnonzero(assigned == shard)
+            if len(rows):
+                part = df.iloc[rows].reset_index(drop=True)
+                parts.append((shard, rows, part, DocTable.from_frame(part, businesses), SourceIndex.build(part)))
+        # Every shard scores with the statistics of the whole source, its
+        # terms taken in the order one index over the source would see them
+        share_corpus_stats([index for *_, index in parts],
+                           [first_seen(index, rows) for _, rows, _, _, index in parts])
+        store = stores.get(source)
+        for shard, rows, part, docs, index in parts:
+            path = os.path.join(shard_path(data_dir, manifest, shard), source)
+            write_source(path, docs, index, part)
+            # Shard rows keep the order of the source's rows, so ties between
+            # shards break the same way as within one index
+            np.save(os.path.join(path, "source_rows.npy"), rows.astype(np.int64))
+            if store is not None:
+                # One vector per distinct text of the shard; the TextGroups'
+                # text_of_row is the store's row map
+                first = rows[index.groups.first_rows()]
+                np.save(os.path.join(path, "embeddings.npy"), np.asarray(store.vectors[store.row_map[first]]))
+        manifest["sources"][source] = {
+            "csv": SOURCES[source],
+            "num_docs": len(df),
+            "shard_docs": np.bincount(assigned, minlength=n_shards).tolist(),
+            "embeddings": store is not None,
+            **source_fingerprint(os.path.join(data_dir, SOURCES[source])),
+        }
+    save_businesses(shard_path(data_dir, manifest), businesses)
+    # Business profiles for the coordinator, of the same documents as the shards
+    build_profiles(frames).save(os.path.join(shard_path(data_dir, manifest), PROFILES_DIRNAME))
+
+    # Manifest last, as for snapshots; older shard sets may still be mapped
+    # by running workers, so their files are only unlinked
+    tmp = os.path.join(index_dir, SHARD_MANIFEST + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, os.path.join(index_dir, SHARD_MANIFEST))
+    for entry in os.listdir(index_dir):
+        if entry.startswith("shards-") and entry != name:
+            shutil.rmtree(os.path.join(index_dir, entry), ignore_errors=True)
+    print(f"Shards written to {shard_path(data_dir, manifest)}.")
+    return manifest
+
+
+def wanted_sources(filters):
+    wanted = (filters or {}).get("source")
+    return [wanted] if isinstance(wanted, str) else wanted
+
+
+class Shard:
+    """One shard's sources, as loaded by its worker process."""
+
+    def __init__(self, path):
+        businesses = load_businesses(os.path.dirname(path))
+        self.sources = {}
+        for source in SOURCES:
+            source_dir = os.path.join(path, source)
+            if not os.path.isdir(source_dir):
+                continue
+            store = None
+            if os.path.exists(os.path.join(source_dir, "embeddings.npy")):
+                store = EmbeddingStore.load(source_dir)
+            self.sources[source] = (DocTable.load(source_dir, businesses), SourceIndex.load(source_dir),
+                                    np.load(os.path.join(source_dir, "source_rows.npy"), mmap_mode="r"), store)
+
+    def search(self, query_tokens, k, filters=None, query_emb=None):
+        """
+        {source: hits} of this shard's top k per source. Hits are plain
+        dicts (text included) numbered by source row; with query_emb, those
+        with an embedding carry their cosine similarity to it.
+        """
+        wanted = wanted_sources(filters)
+        results = {}
+        for source, (docs, index, source_rows, store) in self.sources.items():
+            if wanted and source not in wanted:
+                continue
+            rows, scores = index.top_k(query_tokens, k, filters)
+            hits = [dict(docs.hit(row, score, source).materialize())
+                    for row, score in zip(rows.tolist(), scores.tolist())]
+            if store is not None and query_emb is not None and len(hits):
+                for hit, similarity in zip(hits, store.similarities(query_emb, rows).tolist()):
+                    hit["similarity"] = similarity
+            for hit, row in zip(hits, np.asarray(source_rows[rows]).tolist()):
+                hit["row"] = row
+            results[source] = hits
+        return results
+
+    def facet_values(self, field):
+        return sorted(set().union(*[index.facets.values(field) for _, index, _, _ in self.sources.values()]))
+
+    def set_bm25_params(self, k1, b):
+        for _, index, _, _ in self.sources.values():
+            index.lexical.set_params(k1, b)
+
+
+def _handle(shard, conn):
+    # One coordinator connection: (method, args) requests, (ok, result) replies
+    with conn:
+        while True:
+            try:
+                method, args = conn.recv()
+            except (EOFError, OSError):
+                return
+            try:
+                conn.send((True, getattr(shard, method)(*args)))
+            except Exception as e:
+                conn.send((False, f"{type(e).__name__}: {e}"))
+
+
+def _serve_shard(path, address, authkey, parent):
+    """Worker process main: loads one shard and answers every connection on a thread."""
+    try:
+        shard = Shard(path)
+        listener = Listener(address, family="AF_UNIX", authkey=authkey)
+    except Exception as e:
+        print(f"{type(e).__name__}: {e}", flush=True)
+        return
+    print("ready", flush=True)
+    # Nobody reads our stdout after startup
+    os.dup2(2, 1)
+
+    def orphaned():
+        # Exit with the process that started us, even if it was killed
+        while os.getppid() == parent:
+            time.sleep(1)
+        os._exit(0)
+
+    threading.Thread(target=orphaned, daemon=True).start()
+    while True:
+        conn = listener.accept()
+        threading.Thread(target=_handle, args=(shard, conn), daemon=True).start()
+
+
+class ShardPool:
+    """
+    Worker processes serving a shard set, one per shard, over Unix sockets.
+    Each request fans out to all shards at once. Connections are pooled per
+    process and thread-safe; server workers forked after the pool was
+    started open their own.
+    """
+
+    def __init__(self, data_dir, manifest):
+        self.num_shards = manifest["num_shards"]
+        self.authkey = os.urandom(16)
+        self.socket_dir = tempfile.mkdtemp(prefix="saferbites-shards-")
+        self.addresses = [os.path.join(self.socket_dir, f"shard-{i}") for i in range(self.num_shards)]
+        # Started as scripts rather than multiprocessing children, which
+        # would re-import the parent's main module (e.g. the app)
+        env = dict(os.environ, SAFERBITES_SHARD_AUTHKEY=self.authkey.hex())
+        self.processes = [
+            subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", shard_path(data_dir, manifest, i),
+                              address, "--parent", str(os.getpid())], stdout=subprocess.PIPE, env=env, text=True)
+            for i, address in enumerate(self.addresses)
+        ]
+        errors = []
+        for i, process in enumerate(self.processes):
+            status = process.stdout.readline().strip()
+            process.stdout.close()
+            if status != "ready":
+                errors.append(f"shard {i}: {status or 'worker exited'}")
+        if errors:
+            self.close()
+            raise RuntimeError("Shard workers failed to start: " + "; ".join(errors))
+        self._reset()
+        _pools.add(self)
+
+    def _reset(self):
+        # Also run in forked children: the parent's connections are not
+        # theirs to use, and its lock may have been held at the fork
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def _checkout(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return [Client(address, family="AF_UNIX", authkey=self.authkey) for address in self.addresses]
+
+    def call(self, method, *args):
+        """Calls a Shard method on every shard in parallel; returns the results in shard order."""
+        conns = self._checkout()
+        try:
+            for conn in conns:
+                conn.send((method, args))
+            replies = [conn.recv() for conn in conns]
+        except BaseException:
+            for conn in conns:
+                conn.close()
+            raise
+        with self._lock:
+            self._idle.append(conns)
+        for i, (ok, result) in enumerate(replies):
+            if not ok:
+                raise RuntimeError(f"Shard {i} failed: {result}")
+        return [result for _, result in replies]
+
+    def close(self):
+        for process in self.processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(self.socket_dir, ignore_errors=True)
+
+
+def hit_passes(hit, filters):
+    """Whether a hit's metadata passes the filters (same semantics as the facet bitmaps)."""
+    for field, wanted in (filters or {}).items():
+        if wanted is None or wanted == "" or wanted == []:
+            continue
+        values = [wanted] if isinstance(wanted, str) else wanted
+        if field == "source":
+            ok = hit["source"] in values
+        elif field == "tag":
+            ok = any(hit["tag_mask"] & TAG_BITS.get(normalize_value(v), 0) for v in values)
+        elif field in FACET_FIELDS:
+            ok = normalize_value(hit[field]) in {normalize_value(v) for v in values}
+        else:
+            continue
+        if not ok:
+            return False
+    return True
+
+
+class ShardedEngine(SaferBitesEngine):
+    """
+    SaferBitesEngine over a shard set served by worker processes (see the
+    module docstring). The shard set is built on first start if missing or
+    out of date; refresh() switches to one rebuilt by `shards.py`. Delta
+    segments are not sharded, so compact before rebuilding. Business
+    profiles are those of the shard set's documents.
+    """
+
+    PHASES = ("metadata", "shards", "profiles", "model")
+
+    def __init__(self, data_dir="data", shards=DEFAULT_SHARDS, **kwargs):
+        self.num_shards = shards
+        super().__init__(data_dir, **kwargs)
+
+    def _load_index(self):
+        with self._phase("metadata"):
+            manifest = read_shard_manifest(self.data_dir)
+            if is_stale(self.data_dir, manifest) or manifest["num_shards"] != self.num_shards:
+                print(f"Shard set missing or stale; building {self.num_shards} shards...")
+                manifest = build_shards(self.data_dir, self.num_shards)
+
+        with self._phase("shards"):
+            pool = ShardPool(self.data_dir, manifest)
+            print(f"Started {pool.num_shards} shard workers.")
+
+        with self._phase("profiles"):
+            self._switch(pool, manifest)
+
+    def _switch(self, pool, manifest):
+        profiles = ProfileTable.load(os.path.join(shard_path(self.data_dir, manifest), PROFILES_DIRNAME))
+        old = self.state
+        self._publish(IndexState((manifest["path"], manifest["num_shards"]), profiles=profiles, pool=pool))
+        if old is not None:
+            # Searches that took the old state finish on its workers
+            timer = threading.Timer(RETIRE_SECONDS, old.pool.close)
+            timer.daemon = True
+            timer.start()
+
+    def refresh(self):
+        """Switches to a shard set rebuilt since it was loaded. Returns True if it did."""
+        manifest = read_shard_manifest(self.data_dir)
+        if manifest is None or (manifest["path"], manifest["num_shards"]) == self.index_version:
+            return False
+        self._switch(ShardPool(self.data_dir, manifest), manifest)
+        return True
+
+    def close(self):
+        if self.state is not None:
+            self.state.pool.close()
+
+    def facet_values(self, field):
+        state = self.state
+        values = state.facets.get(field)
+        if values is None:
+            values = sorted(set().union(*state.pool.call("facet_values", field)))
+            state.facets[field] = values
+        return values
+
+    def set_bm25_params(self, k1, b):
+        """As SaferBitesEngine.set_bm25_params, on every shard worker (and so for every client of them)."""
+        self.state.pool.call("set_bm25_params", k1, b)
+        self.result_cache.clear()
+
+    def _index_gauges(self):
+        return [("saferbites_index_shards", "Shards the index is partitioned into.", [([], self.state.pool.num_shards)])]
+
+    def search_bm25(self, query, top_k=30, filters=None, state=None):
+        """
+        Fans out to every shard and merges their top k per source by score
+        (ties to the lower row, as in one index). While reranking, the query
+        embedding goes along and shards return candidates' similarities too.
+        """
+        query_emb = self.encode_query(query) if self.reranking else None
+        replies = (state or self.state).pool.call("search", self._tokenize(query), top_k, filters, query_emb)
+        results = []
+        for source in SOURCES:
+            hits = [hit for reply in replies for hit in reply.get(source, [])]
+            if not hits:
+                continue
+            by_row = {hit["row"]: hit for hit in hits}
+            rows, _ = select_top_k(np.array([hit["row"] for hit in hits], dtype=np.int64),
+                                   np.array([hit["score"] for hit in hits]), top_k)
+            results += [by_row[row] for row in rows.tolist()]
+        return results
+
+    def search_batch(self, queries, top_k=30, batch_size=64, filters=None):
+        queries = list(queries)
+        if self.reranking and queries:
+            # One batched encode for the queries; search_bm25 then hits the cache
+            self.encode_queries(queries, batch_size=batch_size)
+        state = self.state
+        return [self.aggregate_results(self.rerank(q, self.search_bm25(q, top_k, filters, state), state=state), q)
+                for q in queries]
+
+    def apply_filters(self, results, filters, state=None):
+        return [r for r in results if hit_passes(r, filters)]
+
+    def _doc_similarities(self, query_emb, results, candidate_embs=None, state=None):
+        # Shards computed similarities where they hold embeddings; the rest
+        # are encoded here
+        scores = np.array([r.get("similarity", 0.0) for r in results], dtype=np.float32)
+        pending = [i for i, r in enumerate(results) if "similarity" not in r]
+        if pending and candidate_embs is not None:
+            doc_embs = np.array([candidate_embs[(results[i]["source"], results[i]["row"])] for i in pending])
+            scores[pending] = doc_embs @ query_emb
+        elif pending:
+            doc_embs = self._encode([results[i]["text"] for i in pending])
+            scores[pending] = doc_embs @ query_emb
+        return scores
+
+    def _embedded(self, hit, state=None):
+        return "similarity" in hit
+
+
+def compare(data_dir="data", n_shards=DEFAULT_SHARDS, queries=None, top_k=30, repeat=3):
+    """
+    Checks a sharded engine against the single-index one on the labeled
+    queries (identical businesses and scores expected) and prints the BM25
+    latency of each.
+    """
+    if queries is None:
+        queries = pd.read_csv(os.path.join(data_dir, "labeled_queries.csv"))["query"].tolist()
+    options = dict(use_reranker=False, result_cache_size=0)
+    single = SaferBitesEngine(data_dir, **options)
+    sharded = ShardedEngine(data_dir, shards=n_shards, **options)
+    try:
+        same = 0
+        for q in queries:
+            a = [(b["business_id"], round(b["total_score"], 9)) for b in single.search(q, top_k)]
+            b = [(b["business_id"], round(b["total_score"], 9)) for b in sharded.search(q, top_k)]
+            same += a == b
+        print(f"Identical results: {same}/{len(queries)} queries")
+        for label, engine in (("single", single), (f"{n_shards} shards", sharded)):
+            best = float("inf")
+            for _ in range(repeat):
+                start = time.perf_counter()
+                for q in queries:
+                    engine.search_bm25(q, top_k)
+                best = min(best, time.perf_counter() - start)
+            print(f"{label:>10}: {best * 1000 / len(queries):.3f} ms/query")
+    finally:
+        sharded.close()
+    return same == len(queries)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Partition the index into shards served by worker processes.")
+    parser.add_argument("--data-dir", default="data")
+    parser.add_argument("--shards", type=int, default=DEFAULT_SHARDS)
+    parser.add_argument("--compare", action="store_true",
+                        help="Check the shards against the single index on the labeled queries and time both")
+    # Internal: run one shard worker (see ShardPool)
+    parser.add_argument("--serve", nargs=2, metavar=("SHARD_DIR", "SOCKET"), help=argparse.SUPPRESS)
+    parser.add_argument("--parent", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        _serve_shard(*args.serve, bytes.fromhex(os.environ["SAFERBITES_SHARD_AUTHKEY"]), args.parent)
+        sys.exit(1)
+    build_shards(args.data_dir, args.shards)
+    if args.compare:
+        compare(args.data_dir, args.shards)
@@ -0,0 +1,179 @@
+"""
+Local stand-in for the Socrata SODA endpoint that download_data.py pages
+through. It serves a CSV file, which needs an inspection_date column, and
+understands the SoQL subset download_data.py sends: count(*), $where on
+inspection_date, $order=:id, $limit and $offset.
+
+    python3 src/soda_standin.py data/inspections_raw.csv --port 8080
+    python3 src/download_data.py --base-url http://127.0.0.1:8080/resource/inspections.csv
+
+--check runs download_data.py against it on synthetic rows: a full download
+that is interrupted and then resumed from its checkpoint, an incremental
+sync whose $where is verified, and a corrupt state file.
+"""
+import argparse
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+
+WHERE = re.compile(r"^inspection_date >= '(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{3})'$")
+
+
+class StandIn(ThreadingHTTPServer):
+    """
+    Answers SODA requests from `rows` (a DataFrame of strings, in :id order).
+    Every request's parameters are kept in `requests`; a page request whose
+    $offset is in `fail_once` gets a 404 the first time, as an interrupted
+    download would.
+    """
+    daemon_threads = True
+
+    def __init__(self, rows, host="127.0.0.1", port=0):
+        super().__init__((host, port), Handler)
+        self.rows = rows
+        self.requests = []
+        self.fail_once = set()
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/resource/inspections.csv"
+
+    def answer(self, params):
+        """(status, CSV body) for one request's parameters."""
+        with self._lock:
+            self.requests.append(params)
+            offset = params.get("$offset")
+            if offset is not None and int(offset) in self.fail_once:
+                self.fail_once.discard(int(offset))
+                return 404, "page unavailable\n"
+        rows = self.rows
+        where = params.get("$where")
+        if where is not None:
+            match = WHERE.match(where)
+            if match is None:
+                return 400, f"unsupported $where: {where}\n"
+            rows = rows[pd.to_datetime(rows["inspection_date"]) >= pd.Timestamp(match.group(1))]
+        if params.get("$select") == "count(*) AS n":
+            return 200, f"n\n{len(rows)}\n"
+        if params.get("$order", ":id") != ":id":
+            return 400, f"unsupported $order: {params['$order']}\n"
+        offset = int(params.get("$offset", 0))
+        rows = rows.iloc[offset:offset + int(params.get("$limit", 1000))]
+        out = io.StringIO()
+        rows.to_csv(out, index=False)
+        return 200, out.getvalue()
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        params = {k: v[-1] for k, v in parse_qs(urlparse(self.path).query).items()}
+        status, body = self.server.answer(params)
+        body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/csv")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(rows, host="127.0.0.1", port=0):
+    """Starts a StandIn on a background thread and returns it (server.shutdown() stops it)."""
+    server = StandIn(rows, host, port)
+    threading.Thread(target=server.serve_forever, name="soda-standin", daemon=True).start()
+    return server
+
+
+def synthetic_rows(n, first_day, days, seed=0):
+    # Inspection rows spread over `days` days, in SODA's timestamp format
+    dates = pd.date_range(first_day, periods=days, freq="D").strftime("%Y-%m-%dT%H:%M:%S.000")
+    i = pd.RangeIndex(n)
+    return pd.DataFrame({
+        "camis": (40000000 + (i * 7919 + seed) % 997).astype(str),
+        "dba": "PLACE " + (i % 97).astype(str),
+        "violation_description": "Evidence of mice observed, row " + (i + seed).astype(str),
+        "inspection_date": dates[(i * 31 + seed) % days],
+        "violation_code": "04L",
+    })
+
+
+def check():
+    import download_data
+
+    with tempfile.TemporaryDirectory() as tmp:
+        download_data.DATA_DIR = tmp
+        base = synthetic_rows(1050, "2024-01-01", 20)
+        server = serve(base)
+        page_size = 100
+        try:
+            # Full download, interrupted by a page that fails
+            server.fail_once = {300}
+            download_data.download_nyc_inspections(workers=3, page_size=page_size, url=server.url)
+            output = os.path.join(tmp, "inspections_raw.csv")
+            assert not os.path.exists(output), "an interrupted download must not assemble the output"
+            kept = [name for name in os.listdir(output + ".parts") if name.startswith("page-")]
+            assert len(kept) == 10, kept
+
+            # Re-run: only the missing page is fetched, without counting again
+            server.requests.clear()
+            download_data.download_nyc_inspections(workers=3, page_size=page_size, url=server.url)
+            assert [r.get("$offset") for r in server.requests] == ["300"], server.requests
+            got = pd.read_csv(output, dtype=str, keep_default_na=False)
+            assert got.equals(base), "resumed download differs from the source rows"
+            last = base["inspection_date"].max()
+            assert download_data.read_state()["last_inspection_date"] == last
+            print(f"Resume: 1 of 11 pages re-fetched, {len(got)} rows match.")
+
+            # Incremental sync: rows published since, some on the last day again
+            new = synthetic_rows(230, last[:10], 5, seed=1)
+            server.rows = pd.concat([base, new], ignore_index=True)
+            server.requests.clear()
+            feed = download_data.sync_nyc_inspections(workers=3, page_size=page_size, url=server.url)
+            wheres = {r.get("$where") for r in server.requests}
+            assert wheres == {f"inspection_date >= '{last}'"}, wheres
+            want = server.rows[server.rows["inspection_date"] >= last].reset_index(drop=True)
+            got = pd.read_csv(feed, dtype=str, keep_default_na=False)
+            assert got.equals(want), "feed differs from the rows since the last download"
+            assert download_data.read_state()["last_inspection_date"] == new["inspection_date"].max()
+            print(f"Sync: $where {wheres.pop()!r}, {len(got)} rows match.")
+
+            # A state file that is not a date is refused before any request
+            with open(os.path.join(tmp, download_data.STATE_FILE), "w") as f:
+                json.dump({"last_inspection_date": "2024-01-01' OR '1'='1"}, f)
+            server.requests.clear()
+            assert download_data.sync_nyc_inspections(url=server.url) is None
+            assert server.requests == [], server.requests
+            print("Corrupt state: refused, no request sent.")
+        finally:
+            server.shutdown()
+            server.server_close()
+    print("OK")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a CSV as a local stand-in for the SODA API.")
+    parser.add_argument("csv", nargs="?", help="Rows to serve, in :id order")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--check", action="store_true",
+                        help="Run download_data.py against a stand-in (resume and incremental sync) and exit")
+    args = parser.parse_args()
+
+    if args.check:
+        check()
+    elif args.csv:
+        server = StandIn(pd.read_csv(args.csv, dtype=str, keep_default_na=False), args.host, args.port)
+        print(f"Serving {args.csv} at {server.url}")
+        server.serve_forever()
+    else:
+        parser.error("a CSV to serve, or --check, is required")
@@ -0,0 +1,76 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+KEYWORDS = {
+    "pests": ["rodent", "mouse", "mice", "roach", "insect", "rat", "fly", "flies", "vermin", "pest"],
+    "temperature": ["cold", "hot", "temp", "thermometer", "degree", "cooling", "holding", "refrigerat"],
+    "contamination": ["raw", "contam", "sanitize", "cross", "glove", "hand", "clean", "wash"]
+}
+
+TAG_CATEGORIES = list(KEYWORDS)
+TAG_BITS = {category: 1 << i for i, category in enumerate(TAG_CATEGORIES)}
+ALL_TAGS = (1 << len(TAG_CATEGORIES)) - 1
+
+
+def compile_tagger(keywords):
+    """
+    One regex matching every keyword as a substring at every position.
+
+    The zero-width lookahead lets matches overlap (so "refrigerat" does not
+    hide the "rat" inside it). At a given position only the longest keyword
+    is reported, so each keyword's mask also carries the categories of every
+    keyword that is a prefix of it. Together this tags exactly like a
+    `w in text` scan per keyword.
+    """
+    words = sorted({w for ws in keywords.values() for w in ws}, key=len, reverse=True)
+    word_bits = {}
+    for bit, (category, ws) in enumerate(keywords.items()):
+        for w in ws:
+            word_bits[w] = word_bits.get(w, 0) | (1 << bit)
+    masks = {w: 0 for w in words}
+    for w in words:
+        for prefix, bits in word_bits.items():
+            if w.startswith(prefix):
+                masks[w] |= bits
+    pattern = re.compile("(?=(" + "|".join(re.escape(w) for w in words) + "))")
+    return pattern, masks
+
+
+TAG_PATTERN, KEYWORD_MASKS = compile_tagger(KEYWORDS)
+
+
+def get_tag_mask(text):
+    mask = 0
+    for m in TAG_PATTERN.finditer(text):
+        mask |= KEYWORD_MASKS[m.group(1)]
+        if mask == ALL_TAGS:
+            break
+    return mask
+
+
+def tags_from_mask(mask):
+    return ",".join(c for c in TAG_CATEGORIES if mask & TAG_BITS[c])
+
+
+def mask_from_tags(tags):
+    return sum(TAG_BITS.get(t, 0) for t in set(str(tags).split(",")))
+
+
+def get_tags(text):
+    return tags_from_mask(get_tag_mask(text))
+
+
+def tag_masks(texts):
+    """Tag masks for a column of normalized texts; each distinct text is scanned once."""
+    codes, uniques = pd.factorize(pd.Series(texts, dtype=object))
+    masks = np.array([get_tag_mask(t) for t in uniques], dtype=np.uint32)
+    return masks[codes] if len(uniques) else np.zeros(len(codes), dtype=np.uint32)
+
+
+def tag_strings(masks):
+    """Comma-separated tag strings for an array of masks."""
+    uniques, inverse = np.unique(np.asarray(masks), return_inverse=True)
+    strings = np.array([tags_from_mask(int(m)) for m in uniques], dtype=object)
+    return strings[inverse.reshape(-1)]
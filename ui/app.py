@@ -1,16 +1,36 @@
-from flask import Flask, request, render_template_string
+from flask import Flask, Response, jsonify, request, render_template_string, stream_with_context
+import json
 import sys
 import os
 
 # Add src to path
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from src.retrieval import SaferBitesEngine
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+from paging import decode_cursor
+from retrieval import FIRST_STAGES, SaferBitesEngine
+from shards import ShardedEngine
+from tagger import TAG_CATEGORIES, tags_from_mask
 
 app = Flask(__name__)
 
-# Initialize Engine once
+# Initialize Engine once, in the background so the port opens right away;
+# searches are BM25-only until the reranker is loaded (see /ready)
 print("Initializing SaferBites Engine...")
-engine = SaferBitesEngine()
+engine_options = dict(encoder_backend=os.environ.get("SAFERBITES_ENCODER", "torch"),
+                      encoder_threads=int(os.environ.get("SAFERBITES_ENCODER_THREADS", 0)) or None,
+                      background=os.environ.get("SAFERBITES_BACKGROUND_INIT", "1") != "0",
+                      metrics=os.environ.get("SAFERBITES_METRICS", "1") != "0",
+                      slow_query_ms=float(os.environ["SAFERBITES_SLOW_QUERY_MS"])
+                      if os.environ.get("SAFERBITES_SLOW_QUERY_MS") else None,
+                      slow_query_log=os.environ.get("SAFERBITES_SLOW_QUERY_LOG"),
+                      # "hybrid": BM25 fused with the dense index as the first stage
+                      first_stage=os.environ.get("SAFERBITES_FIRST_STAGE", "bm25"))
+# SAFERBITES_SHARDS=N partitions the index across N shard worker processes
+if int(os.environ.get("SAFERBITES_SHARDS", 0)):
+    engine = ShardedEngine(shards=int(os.environ["SAFERBITES_SHARDS"]), **engine_options)
+else:
+    engine = SaferBitesEngine(**engine_options)
+# Pick up delta segments from ingest.py without restarting
+engine.start_index_watcher(interval=int(os.environ.get("SAFERBITES_REFRESH_SECONDS", 30)))
 
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -30,9 +50,26 @@ HTML_TEMPLATE = """
             <h1 class="text-center mb-4">SaferBites 🍽️🔍</h1>
             <p class="text-center text-muted">Find safe places to eat. Search for "rats", "dirty", "cold food"...</p>
             
-            <form action="/search" method="get" class="d-flex gap-2 mb-5">
-                <input type="text" name="q" class="form-control form-control-lg" placeholder="e.g. rodents in manhattan" value="{{ query }}">
-                <button type="submit" class="btn btn-primary btn-lg">Search</button>
+            <form action="/search" method="get" class="mb-5">
+                <div class="d-flex gap-2 mb-2">
+                    <input type="text" name="q" class="form-control form-control-lg" placeholder="e.g. rodents in manhattan" value="{{ query }}">
+                    <button type="submit" class="btn btn-primary btn-lg">Search</button>
+                </div>
+                <div class="d-flex gap-2">
+                    <select name="boro" class="form-select form-select-sm">
+                        <option value="">Any borough</option>
+                        {% for b in boros %}<option value="{{ b }}" {{ 'selected' if filters.boro == b }}>{{ b|title }}</option>{% endfor %}
+                    </select>
+                    <input type="text" name="zipcode" class="form-control form-control-sm" placeholder="Zipcode" value="{{ filters.zipcode or '' }}">
+                    <select name="source" class="form-select form-select-sm">
+                        <option value="">All sources</option>
+                        {% for s in ['violation', 'review'] %}<option value="{{ s }}" {{ 'selected' if filters.source == s }}>{{ s|title }}s</option>{% endfor %}
+                    </select>
+                    <select name="tag" class="form-select form-select-sm">
+                        <option value="">Any category</option>
+                        {% for t in tags %}<option value="{{ t }}" {{ 'selected' if filters.tag == t }}>{{ t|title }}</option>{% endfor %}
+                    </select>
+                </div>
             </form>
 
             {% if query %}
@@ -45,7 +82,9 @@ HTML_TEMPLATE = """
                                 <h4 class="card-title">{{ business.business_name }} 
                                     <span class="score float-end">Score: {{ "%.2f"|format(business.total_score) }}</span>
                                 </h4>
-                                <h6 class="card-subtitle mb-2 text-muted">ID: {{ business.business_id }}</h6>
+                                <h6 class="card-subtitle mb-2 text-muted">ID: {{ business.business_id }}
+                                    <a class="ms-2" href="/api/business/{{ business.business_id|urlencode }}">Safety profile</a>
+                                </h6>
                                 
                                 <div class="mt-3">
                                     <h6>Evidence:</h6>
@@ -59,6 +98,9 @@ HTML_TEMPLATE = """
                             </div>
                         </div>
                     {% endfor %}
+                    {% if next_cursor %}
+                        <a class="btn btn-outline-primary" href="/search?q={{ query|urlencode }}&cursor={{ next_cursor }}">Next page</a>
+                    {% endif %}
                 {% else %}
                     <p>No results found.</p>
                 {% endif %}
@@ -69,23 +111,199 @@ HTML_TEMPLATE = """
 </html>
 """
 
+FILTER_FIELDS = ["boro", "zipcode", "source", "tag"]
+
+PAGE_SIZE = 10
+# Most businesses one request may ask for
+MAX_RESULTS = 1000
+
+def render(query="", results=None, filters=None, next_cursor=None):
+    return render_template_string(HTML_TEMPLATE, query=query, results=results or [], filters=filters or {},
+                                  next_cursor=next_cursor,
+                                  boros=engine.facet_values("boro") if engine.index_ready.is_set() else [],
+                                  tags=TAG_CATEGORIES)
+
 @app.route("/")
 def home():
-    return render_template_string(HTML_TEMPLATE, query="", results=[])
+    return render()
+
+def parse_filters():
+    # Facet filters are applied inside the index, before scoring
+    return {f: request.args.get(f) for f in FILTER_FIELDS if request.args.get(f)}
+
+def size_arg(name, default=None):
+    # A positive count from the query string, capped at MAX_RESULTS
+    value = request.args.get(name, default, type=int)
+    if value is None:
+        return None
+    if value < 1:
+        raise ValueError(f"{name} must be a positive integer")
+    return min(value, MAX_RESULTS)
+
+def parse_stage():
+    # ?stage=bm25|hybrid overrides the engine's first stage
+    stage = request.args.get("stage") or None
+    if stage is not None and stage not in FIRST_STAGES:
+        raise ValueError(f"stage must be one of {', '.join(FIRST_STAGES)}")
+    return stage
+
+def business_json(b):
+    return {
+        "business_id": b["business_id"],
+        "business_name": b["business_name"],
+        "total_score": b["total_score"],
+        "tags": tags_from_mask(b["tag_mask"]).split(",") if b["tag_mask"] else [],
+        "evidence": [{
+            "doc_id": e["doc_id"],
+            "source": e["source"],
+            "text": e["text"],
+            "score": e["score"],
+            "rerank_score": e.get("rerank_score"),
+            "tags": e["tags"],
+            "boro": e["boro"],
+            "zipcode": e["zipcode"],
+        } for e in b["evidence"]],
+    }
+
+def starting_up():
+    return jsonify({"error": "starting up", **engine.readiness()}), 503
 
 @app.route("/search")
 def search():
+    if not engine.index_ready.is_set():
+        return starting_up()
+    query = request.args.get("q", "")
+    filters = parse_filters()
+    page = {"results": [], "next_cursor": None}
+    try:
+        if request.args.get("cursor"):
+            # Later pages carry the query and filters in the cursor
+            page = engine.search_page(cursor=request.args["cursor"])
+            filters = page_filters(request.args["cursor"])
+        elif query:
+            # Search -> Rerank -> Aggregate, one page at a time
+            page = engine.search_page(query, filters, page_size=PAGE_SIZE, max_evidence=3, first_stage=parse_stage())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return render(query, page["results"], filters, page["next_cursor"])
+
+def page_filters(cursor):
+    return decode_cursor(cursor).get("f") or {}
+
+@app.route("/api/search")
+def api_search():
+    # JSON version of /search: ?q=...&boro=...&top_n=10&evidence=3&stage=hybrid
+    if not engine.index_ready.is_set():
+        return starting_up()
     query = request.args.get("q", "")
-    results = []
-    if query:
-        # 1. Search
-        bm25_res = engine.search_bm25(query)
-        # 2. Rerank
-        reranked = engine.rerank(query, bm25_res)
-        # 3. Aggregate
-        results = engine.aggregate_results(reranked, query)
-        
-    return render_template_string(HTML_TEMPLATE, query=query, results=results)
+    filters = parse_filters()
+    results, page = [], {}
+    try:
+        if request.args.get("cursor") or request.args.get("page_size"):
+            # Paged: ?q=...&page_size=20, then ?cursor=<next_cursor> until it is null
+            page = engine.search_page(query, filters, page_size=size_arg("page_size", PAGE_SIZE),
+                                      cursor=request.args.get("cursor"),
+                                      max_evidence=size_arg("evidence", 3),
+                                      first_stage=parse_stage())
+            results = page["results"]
+            if request.args.get("cursor"):
+                filters = page_filters(request.args["cursor"])
+                query = decode_cursor(request.args["cursor"])["q"]
+        elif query:
+            results = engine.search(query, filters=filters, top_n=size_arg("top_n"),
+                                    max_evidence=size_arg("evidence", 3),
+                                    first_stage=parse_stage())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    response = {"query": query, "filters": filters, "reranked": engine.reranking,
+                "results": [business_json(b) for b in results]}
+    if page:
+        response["next_cursor"] = page["next_cursor"]
+    return jsonify(response)
+
+@app.route("/api/export")
+def api_export():
+    # Every matching business in rank order, streamed as JSON lines:
+    # ?q=...&boro=...&evidence=3&limit=5000&stage=hybrid
+    if not engine.index_ready.is_set():
+        return starting_up()
+    query = request.args.get("q", "")
+    if not query:
+        return jsonify({"error": "q is required"}), 400
+    try:
+        stage = parse_stage()
+        max_evidence = size_arg("evidence", 3)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    results = engine.iter_results(query, parse_filters(), max_evidence=max_evidence, first_stage=stage)
+    limit = request.args.get("limit", type=int)
+
+    def lines():
+        for i, b in enumerate(results):
+            if limit is not None and i >= limit:
+                return
+            yield json.dumps(business_json(b)) + "\n"
+
+    return Response(stream_with_context(lines()), mimetype="application/x-ndjson")
+
+@app.route("/api/business/<business_id>")
+def business_profile(business_id):
+    # Counts per source and tag, risk score and recent violations of one business
+    if not engine.index_ready.is_set():
+        return starting_up()
+    profile = engine.business_profile(business_id)
+    if profile is None:
+        return jsonify({"error": f"Unknown business {business_id}"}), 404
+    return jsonify(profile)
+
+@app.route("/api/leaderboard")
+def leaderboard():
+    # Riskiest businesses: ?tag=pests&zipcode=11201&boro=brooklyn&limit=10
+    if not engine.index_ready.is_set():
+        return starting_up()
+    args = {field: request.args.get(field) or None for field in ["tag", "zipcode", "boro"]}
+    try:
+        results = engine.top_risk(**args, limit=min(request.args.get("limit", 10, type=int), MAX_RESULTS))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({**args, "results": results})
+
+@app.route("/cache")
+def cache_stats():
+    # Hit/miss counters, for sizing the caches
+    return jsonify(engine.cache_stats())
+
+@app.route("/health")
+def health():
+    # Liveness: the process is up and answering
+    return jsonify({"status": "ok"})
+
+@app.route("/ready")
+def ready():
+    # Readiness: 200 once searches can be served (BM25-only while the
+    # reranker warms up), with the startup phase timings
+    status = engine.readiness()
+    return jsonify(status), 200 if status["index_ready"] else 503
+
+@app.route("/metrics")
+def metrics():
+    # Prometheus scrape target; each pre-forked worker reports its own
+    # numbers, labelled with its pid (sum by the other labels for totals)
+    text = engine.metrics_text()
+    if text is None:
+        return jsonify({"error": "metrics are disabled (SAFERBITES_METRICS=0)"}), 404
+    return Response(text, mimetype="text/plain; version=0.0.4")
+
+@app.route("/slow-queries")
+def slow_queries():
+    # The latest searches over SAFERBITES_SLOW_QUERY_MS, newest last
+    return jsonify(list(engine.metrics.slow_queries) if engine.metrics is not None else [])
+
+@app.route("/encoder")
+def encoder_stats():
+    # Micro-batch sizes and queue waits of the reranker's encoder
+    return jsonify(engine.encoder_stats())
 
 if __name__ == "__main__":
     app.run(debug=True, port=5000)
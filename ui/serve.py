@@ -0,0 +1,114 @@
+"""
+Production serving: pre-forked workers sharing one loaded engine.
+
+The parent process loads the index snapshot (memory-mapped .npy arrays) and
+the reranker model once, answering requests itself meanwhile, then forks the
+workers. The index lives in the page
+cache and the model weights are never written, so all workers share them
+copy-on-write and memory stays roughly flat as workers are added.
+gc.freeze() keeps the garbage collector from touching (and so copying) the
+parent's objects in every worker.
+
+Nothing may run on another thread across a fork: the parent answers
+requests inline, and once loaded it stops the engine's threads (loader,
+index watcher, encode scheduler) before forking. Each worker starts its
+own watcher; the encode scheduler restarts on a worker's first encode.
+
+    python3 ui/serve.py --workers 4 --port 8000
+"""
+import argparse
+import gc
+import os
+import signal
+
+from werkzeug.serving import make_server
+
+
+def run_worker(server, engine):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *_: os._exit(0))
+    if engine.watch_interval is not None:
+        # The parent's watcher was stopped before the fork
+        engine.start_index_watcher(engine.watch_interval)
+    try:
+        server.serve_forever()
+    finally:
+        os._exit(0)
+
+
+def serve(host, port, workers, threaded=False):
+    # Split the cores between workers instead of oversubscribing them; the
+    # encoder's thread pool is sized when the engine loads it, before the fork
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    os.environ.setdefault("SAFERBITES_ENCODER_THREADS", str(threads))
+    threads = int(os.environ["SAFERBITES_ENCODER_THREADS"])
+    # Importing the app starts building the engine, once, in the parent
+    from app import app, engine
+
+    # The listening socket is opened here and inherited by every worker;
+    # the kernel hands each connection to one of them.
+    server = make_server(host, port, app)
+    # Until the engine has finished loading the parent answers on its own
+    # (health checks, BM25-only searches), one request at a time so no
+    # request thread is left at the fork; workers are forked after, so
+    # they share the fully loaded engine
+    server.timeout = 0.1
+    while not engine.started.is_set():
+        server.handle_request()
+    engine.quiesce()
+    if threaded:
+        # Same listening socket, with a thread per request in the workers
+        server = make_server(host, port, app, threaded=True, fd=server.fileno())
+
+    gc.collect()
+    gc.freeze()
+    print(f"Serving on http://{host}:{port} with {workers} workers ({threads} threads each)")
+
+    children = set()
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            run_worker(server, engine)
+        children.add(pid)
+
+    for _ in range(workers):
+        spawn()
+
+    stopping = False
+
+    def stop(*_):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        if pid not in children:
+            # Not a server worker (e.g. a shard worker process of the engine)
+            continue
+        children.discard(pid)
+        if not stopping:
+            print(f"Worker {pid} exited ({status}); restarting")
+            spawn()
+    server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve SaferBites with pre-forked workers.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--threaded", action="store_true",
+                        help="Handle requests on threads within each worker (lets the encoder batch them)")
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers, args.threaded)